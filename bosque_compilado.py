@@ -0,0 +1,303 @@
+import argparse
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from estimador import (DIRECTORIO_MODELOS, MODELOS_REQUERIDOS, cargar_artefactos, predicciones_por_arbol,
+                       prefijo_modelos, resumir_arboles, verificar_transformacion)
+
+logger = logging.getLogger(__name__)
+
+ARCHIVO_COMPILADO = 'bosque_compilado.joblib'
+# Rows per block in batch evaluation, so the (rows x trees) node matrix stays around 8 MB
+NODOS_POR_BLOQUE = 1 << 20
+# Larger batches go to the sklearn forest when one is attached: its per-tree Cython traversal
+# is several times faster than the level-by-level NumPy descent, which walks every row down to
+# the maximum depth. Single rows and small batches such as the sensitivity curves stay on the
+# flat arrays
+FILAS_COMPILADAS = 64
+
+
+def ruta_bosque_compilado(tipo_propiedad, directorio=DIRECTORIO_MODELOS):
+    return os.path.join(directorio, f"{prefijo_modelos(tipo_propiedad)}{ARCHIVO_COMPILADO}")
+
+
+def huella_archivo(ruta):
+    # Content hash rather than mtime, so a fresh checkout of the same forest keeps its compiled copy
+    huella = hashlib.sha256()
+    with open(ruta, 'rb') as archivo:
+        for bloque in iter(lambda: archivo.read(1 << 20), b''):
+            huella.update(bloque)
+    return huella.hexdigest()
+
+
+class BosqueCompilado:
+    # Flat-array copy of a fitted RandomForestRegressor. All trees share one node table; leaves
+    # point to themselves so a fixed number of descent steps lands every row on its leaf.
+    # Inputs are cast to float32 and compared against float64 thresholds and the per-tree
+    # values are added in tree order, exactly as sklearn does, so predictions are identical
+    def __init__(self, izquierdos, derechos, caracteristicas, umbrales, valores, raices, profundidad, n_caracteristicas):
+        self.izquierdos = izquierdos
+        self.derechos = derechos
+        self.caracteristicas = caracteristicas
+        self.umbrales = umbrales
+        self.valores = valores
+        self.raices = raices
+        self.profundidad = int(profundidad)
+        self.n_caracteristicas = int(n_caracteristicas)
+        self.huella_origen = ""
+        # Callable returning the sklearn forest this one was compiled from; see bosque_lotes()
+        self.cargar_lotes = None
+        self._bosque_lotes = None
+        self._candado = threading.Lock()
+
+    @classmethod
+    def desde_sklearn(cls, bosque):
+        if getattr(bosque, 'n_outputs_', 1) != 1:
+            raise ValueError("Solo se pueden compilar bosques con una salida")
+        arboles = [estimador.tree_ for estimador in bosque.estimators_]
+        total_nodos = sum(arbol.node_count for arbol in arboles)
+        tipo_caracteristica = np.int8 if bosque.n_features_in_ < 128 else np.int32
+
+        izquierdos = np.empty(total_nodos, dtype=np.int32)
+        derechos = np.empty(total_nodos, dtype=np.int32)
+        caracteristicas = np.zeros(total_nodos, dtype=tipo_caracteristica)
+        umbrales = np.zeros(total_nodos, dtype=np.float64)
+        valores = np.empty(total_nodos, dtype=np.float64)
+        raices = np.empty(len(arboles), dtype=np.int32)
+
+        desplazamiento = 0
+        for indice, arbol in enumerate(arboles):
+            nodos = np.arange(arbol.node_count, dtype=np.int32) + desplazamiento
+            hojas = arbol.children_left == -1
+            tramo = slice(desplazamiento, desplazamiento + arbol.node_count)
+            izquierdos[tramo] = np.where(hojas, nodos, arbol.children_left + desplazamiento)
+            derechos[tramo] = np.where(hojas, nodos, arbol.children_right + desplazamiento)
+            caracteristicas[tramo] = np.where(hojas, 0, arbol.feature)
+            umbrales[tramo] = np.where(hojas, 0.0, arbol.threshold)
+            valores[tramo] = arbol.value[:, 0, 0]
+            raices[indice] = desplazamiento
+            desplazamiento += arbol.node_count
+
+        profundidad = max(arbol.max_depth for arbol in arboles)
+        return cls(izquierdos, derechos, caracteristicas, umbrales, valores, raices, profundidad, bosque.n_features_in_)
+
+    def __getstate__(self):
+        # The attached sklearn forest is not part of the compiled file
+        estado = self.__dict__.copy()
+        for nombre in ('cargar_lotes', '_bosque_lotes', '_candado'):
+            estado.pop(nombre, None)
+        return estado
+
+    def __setstate__(self, estado):
+        self.__dict__.update(estado)
+        self.cargar_lotes = None
+        self._bosque_lotes = None
+        self._candado = threading.Lock()
+
+    def guardar(self, ruta, huella_origen=""):
+        # Uncompressed joblib stores the arrays raw and aligned, so they can be loaded with mmap_mode
+        import joblib
+
+        self.huella_origen = huella_origen
+        temporal = ruta + '.tmp'
+        joblib.dump(self, temporal)
+        os.replace(temporal, ruta)
+
+    @classmethod
+    def cargar(cls, ruta, huella_origen=None, mmap_mode=None):
+        import joblib
+
+        bosque = joblib.load(ruta, mmap_mode=mmap_mode)
+        if not isinstance(bosque, cls):
+            raise ValueError(f"{ruta} no contiene un bosque compilado")
+        if huella_origen is not None and getattr(bosque, 'huella_origen', None) != huella_origen:
+            raise ValueError(f"{ruta} fue compilado a partir de otra versión del bosque")
+        return bosque
+
+    @property
+    def n_arboles(self):
+        return len(self.raices)
+
+    def bytes_en_memoria(self):
+        return sum(arreglo.nbytes for arreglo in (self.izquierdos, self.derechos, self.caracteristicas,
+                                                  self.umbrales, self.valores, self.raices))
+
+    def _validar(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_caracteristicas:
+            raise ValueError(f"Se esperaban {self.n_caracteristicas} características, se recibió la forma {X.shape}")
+        if not np.isfinite(X).all():
+            raise ValueError("La entrada contiene NaN o infinitos")
+        return X
+
+    def bosque_lotes(self):
+        # The sklearn forest, loaded on the first large batch: processes that only estimate
+        # single rows never load it and keep sharing the mapped arrays
+        if self._bosque_lotes is None and self.cargar_lotes is not None:
+            with self._candado:
+                if self._bosque_lotes is None:
+                    self._bosque_lotes = self.cargar_lotes()
+        return self._bosque_lotes
+
+    def hojas(self, X):
+        # Leaf value of every tree for every row, shape (rows, trees)
+        X = self._validar(X)
+        bosque = self.bosque_lotes() if len(X) > FILAS_COMPILADAS else None
+        if bosque is None:
+            return self._descender(X)
+        # Same float32 input and the same per-tree values, so the result is identical
+        X = np.ascontiguousarray(X)
+        return np.column_stack([arbol.predict(X, check_input=False) for arbol in bosque.estimators_])
+
+    def hojas_compiladas(self, X):
+        # Always the flat-array traversal, e.g. to verify it against sklearn
+        return self._descender(self._validar(X))
+
+    def _descender(self, X):
+        resultado = np.empty((len(X), self.n_arboles), dtype=np.float64)
+        filas_por_bloque = max(1, NODOS_POR_BLOQUE // self.n_arboles)
+        for inicio in range(0, len(X), filas_por_bloque):
+            bloque = X[inicio:inicio + filas_por_bloque]
+            filas = np.arange(len(bloque))[:, None]
+            nodos = np.broadcast_to(self.raices, (len(bloque), self.n_arboles)).copy()
+            for _ in range(self.profundidad):
+                a_la_izquierda = bloque[filas, self.caracteristicas[nodos]] <= self.umbrales[nodos]
+                nodos = np.where(a_la_izquierda, self.izquierdos[nodos], self.derechos[nodos])
+            resultado[inicio:inicio + len(bloque)] = self.valores[nodos]
+        return resultado
+
+    def predecir(self, X):
+        X = self._validar(X)
+        if len(X) == 1:
+            return np.array([self.predecir_fila(X[0])])
+        hojas = self.hojas(X)
+        suma = np.zeros(len(X), dtype=np.float64)
+        for arbol in range(self.n_arboles):
+            suma += hojas[:, arbol]
+        suma /= self.n_arboles
+        return suma
+
+    # Same interface as the sklearn model, so it can replace modelos['modelo']
+    predict = predecir
+
+    def hojas_fila(self, fila):
+        # Leaf value of every tree for a single row: every tree takes one step per level straight
+        # on the node arrays, which may be mapped from disk, without copying them
+        x = np.asarray(fila, dtype=np.float32)
+        nodos = self.raices
+        for _ in range(self.profundidad):
+            nodos = np.where(x[self.caracteristicas[nodos]] <= self.umbrales[nodos],
+                             self.izquierdos[nodos], self.derechos[nodos])
+        return self.valores[nodos]
+
+    def predecir_fila(self, fila):
+        suma = 0.0
+        for valor in self.hojas_fila(fila).tolist():
+            suma += valor
+        return suma / self.n_arboles
+
+
+def cargar_bosque_compilado(tipo_propiedad, directorio=DIRECTORIO_MODELOS):
+    # Returns None when there is no compiled file or it is older than the .joblib forest
+    ruta = ruta_bosque_compilado(tipo_propiedad, directorio)
+    if not os.path.exists(ruta):
+        return None
+    origen = os.path.join(directorio, f"{prefijo_modelos(tipo_propiedad)}{MODELOS_REQUERIDOS['modelo']}")
+    try:
+        return BosqueCompilado.cargar(ruta, huella_archivo(origen))
+    except (OSError, ValueError) as e:
+        logger.warning(f"Se ignora el bosque compilado {ruta}: {str(e)}")
+        return None
+
+
+def compilar_bosque(tipo_propiedad, directorio=DIRECTORIO_MODELOS):
+    # Writes the compiled copy of the sklearn forest next to it, tagged with the forest's hash
+    import joblib
+
+    origen = os.path.join(directorio, f"{prefijo_modelos(tipo_propiedad)}{MODELOS_REQUERIDOS['modelo']}")
+    compilado = BosqueCompilado.desde_sklearn(joblib.load(origen))
+    compilado.guardar(ruta_bosque_compilado(tipo_propiedad, directorio), huella_archivo(origen))
+    return compilado
+
+
+def muestras_verificacion(n_muestras, n_caracteristicas, semilla=0):
+    # Preprocessed features are standardized, so a wide normal sample covers the split thresholds
+    generador = np.random.default_rng(semilla)
+    return generador.normal(0.0, 2.0, size=(n_muestras, n_caracteristicas))
+
+
+def muestras_crudas(estadisticas, n_muestras, proporcion_faltantes=0.05, semilla=0):
+    # Raw features scattered around the imputer means, with some missing values to impute
+    generador = np.random.default_rng(semilla)
+    datos = np.asarray(estadisticas) * generador.lognormal(0.0, 0.5, size=(n_muestras, len(estadisticas)))
+    datos[generador.random(datos.shape) < proporcion_faltantes] = np.nan
+    return datos
+
+
+def verificar(bosque, compilado, X):
+    import pandas as pd
+
+    columnas = getattr(bosque, 'feature_names_in_', None)
+    entrada = pd.DataFrame(X, columns=columnas) if columnas is not None else X
+    inicio = time.perf_counter()
+    esperado = bosque.predict(entrada)
+    tiempo_sklearn = time.perf_counter() - inicio
+    inicio = time.perf_counter()
+    obtenido = compilado.predecir(X)
+    tiempo_compilado = time.perf_counter() - inicio
+    filas = [compilado.predecir_fila(fila) for fila in X[:200]]
+    # The per-tree pass used for the price range must reproduce predict() for both forests
+    medias_sklearn = resumir_arboles(predicciones_por_arbol(bosque, entrada))[0]
+    medias_compilado = resumir_arboles(compilado.hojas_compiladas(X))[0]
+    return {
+        'muestras': len(X),
+        'identicos': bool(np.array_equal(esperado, obtenido) and np.array_equal(esperado[:200], filas)
+                          and np.array_equal(esperado, medias_sklearn) and np.array_equal(esperado, medias_compilado)),
+        'diferencia_maxima': float(np.max(np.abs(esperado - obtenido))) if len(X) else 0.0,
+        'segundos_sklearn': tiempo_sklearn,
+        'segundos_compilado': tiempo_compilado,
+    }
+
+
+def main(argumentos=None):
+    parser = argparse.ArgumentParser(
+        description="Compila el bosque aleatorio a arreglos planos y verifica las rutas rápidas contra sklearn.")
+    parser.add_argument('comando', choices=['convertir', 'verificar'])
+    parser.add_argument('--tipo', choices=["Casa", "Departamento"], default="Departamento")
+    parser.add_argument('--directorio', default=DIRECTORIO_MODELOS)
+    parser.add_argument('--muestras', type=int, default=20000)
+    argumentos = parser.parse_args(argumentos)
+
+    modelos = cargar_artefactos(argumentos.tipo, argumentos.directorio)
+    bosque = modelos['modelo']
+    ruta = ruta_bosque_compilado(argumentos.tipo, argumentos.directorio)
+    if argumentos.comando == 'convertir':
+        compilado = BosqueCompilado.desde_sklearn(bosque)
+        origen = os.path.join(argumentos.directorio, f"{prefijo_modelos(argumentos.tipo)}{MODELOS_REQUERIDOS['modelo']}")
+        compilado.guardar(ruta, huella_archivo(origen))
+        logger.info(f"Bosque compilado en {ruta}: {compilado.n_arboles} árboles, "
+                    f"{len(compilado.valores)} nodos, {compilado.bytes_en_memoria() / 1e6:.1f} MB")
+    else:
+        compilado = cargar_bosque_compilado(argumentos.tipo, argumentos.directorio)
+        if compilado is None:
+            parser.error(f"No hay un bosque compilado vigente en {ruta}; ejecute 'convertir' primero")
+
+    resultado = verificar(bosque, compilado, muestras_verificacion(argumentos.muestras, compilado.n_caracteristicas))
+    logger.info(f"Verificación: {resultado}")
+    if not resultado['identicos']:
+        raise SystemExit("Las predicciones del bosque compilado no coinciden con sklearn")
+
+    crudos = muestras_crudas(modelos['imputador'].statistics_, argumentos.muestras)
+    if not verificar_transformacion(modelos, crudos):
+        raise SystemExit("La transformación fusionada no coincide con imputador -> escalador")
+    logger.info("Transformación fusionada idéntica a imputador -> escalador")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,78 @@
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+CAPACIDAD_PREDICCIONES = 10000
+# Five decimals is about one metre, well below the size of a location cluster
+DECIMALES_COORDENADAS = 5
+
+
+class CachePredicciones:
+    # LRU of final (precio, precio_min, precio_max) tuples keyed on the normalized property
+    # features and the version of the model set that computed them. obtener_version returns the
+    # version the registry is serving for a property type, so a reload invalidates the entries
+    def __init__(self, obtener_version, capacidad=CAPACIDAD_PREDICCIONES, decimales=DECIMALES_COORDENADAS):
+        self.obtener_version = obtener_version
+        self.capacidad = capacidad
+        self.decimales = decimales
+        self._entradas = OrderedDict()
+        self._versiones = {}
+        self._candado = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.invalidaciones = 0
+
+    def version(self, tipo_propiedad):
+        nueva_version = self.obtener_version(tipo_propiedad)
+        with self._candado:
+            version = self._versiones.get(tipo_propiedad)
+            if version is not None and nueva_version != version:
+                self._invalidar(tipo_propiedad)
+            self._versiones[tipo_propiedad] = nueva_version
+        return nueva_version
+
+    def _invalidar(self, tipo_propiedad):
+        obsoletas = [clave for clave in self._entradas if clave[0] == tipo_propiedad]
+        for clave in obsoletas:
+            del self._entradas[clave]
+        self.invalidaciones += 1
+        logger.info(f"Modelos de {tipo_propiedad} recargados, {len(obsoletas)} predicciones descartadas")
+
+    def clave(self, tipo_propiedad, latitud, longitud, terreno, construccion, habitaciones, banos):
+        redondear = lambda valor: None if valor is None else round(float(valor), self.decimales)
+        return (tipo_propiedad, self.version(tipo_propiedad), redondear(latitud), redondear(longitud),
+                float(terreno), float(construccion), float(habitaciones), float(banos))
+
+    def obtener_o_calcular(self, tipo_propiedad, latitud, longitud, terreno, construccion, habitaciones, banos,
+                           calcular):
+        clave = self.clave(tipo_propiedad, latitud, longitud, terreno, construccion, habitaciones, banos)
+        with self._candado:
+            resultado = self._entradas.get(clave)
+            if resultado is not None:
+                self._entradas.move_to_end(clave)
+                self.aciertos += 1
+                return resultado
+            self.fallos += 1
+
+        resultado = calcular()
+        # Failed predictions are not cached so that the next attempt recomputes them
+        if resultado is not None and resultado[0] is not None:
+            with self._candado:
+                self._entradas[clave] = resultado
+                self._entradas.move_to_end(clave)
+                while len(self._entradas) > self.capacidad:
+                    self._entradas.popitem(last=False)
+        return resultado
+
+    def estadisticas(self):
+        with self._candado:
+            consultas = self.aciertos + self.fallos
+            return {
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+                'tasa_aciertos': self.aciertos / consultas if consultas else 0.0,
+                'invalidaciones': self.invalidaciones,
+                'entradas': len(self._entradas),
+            }
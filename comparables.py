@@ -0,0 +1,157 @@
+import argparse
+import logging
+import os
+
+import numpy as np
+
+from registro_modelos import RUTA_MANIFIESTO, RegistroModelos
+
+logger = logging.getLogger(__name__)
+
+RUTA_COMPARABLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'comparables.parquet')
+RADIO_TIERRA_KM = 6371.0088
+RADIO_KM = 2.0
+COMPARABLES = 5
+
+COLUMNAS_NUMERICAS = ['Latitud', 'Longitud', 'Terreno', 'Construccion', 'Habitaciones', 'Banos', 'Precio']
+COLUMNAS_COMPARABLES = ['tipo_propiedad', 'Direccion'] + COLUMNAS_NUMERICAS + ['GrupoUbicacion']
+# Physical features compared after standardization; a different GrupoUbicacion adds PENALIZACION_GRUPO
+CARACTERISTICAS_SIMILITUD = ['Terreno', 'Construccion', 'Habitaciones', 'Banos']
+PENALIZACION_GRUPO = 1.0
+
+
+class IndiceComparables:
+    # Reference properties of one type. A haversine ball tree over the coordinates answers the
+    # radius query; the properties inside the radius are then ranked by how similar their
+    # features are, so a search touches only the neighbourhood of the property
+    def __init__(self, columnas):
+        from sklearn.neighbors import BallTree
+
+        self.columnas = columnas
+        coordenadas = np.radians(np.column_stack((columnas['Latitud'], columnas['Longitud'])).astype(np.float64))
+        self._arbol = BallTree(coordenadas, metric='haversine')
+        caracteristicas = np.column_stack([columnas[nombre] for nombre in CARACTERISTICAS_SIMILITUD]).astype(np.float64)
+        self._escala = caracteristicas.std(axis=0)
+        self._escala[self._escala == 0] = 1.0
+        self._caracteristicas = caracteristicas / self._escala
+
+    def __len__(self):
+        return len(self.columnas['Latitud'])
+
+    def buscar(self, latitud, longitud, terreno, construccion, habitaciones, banos, grupo=None,
+               k=COMPARABLES, radio_km=RADIO_KM):
+        # Up to k comparables within radio_km, most similar first, as a list of dicts
+        if not len(self):
+            return []
+        indices, distancias = self._arbol.query_radius(
+            np.radians([[latitud, longitud]]), r=radio_km / RADIO_TIERRA_KM, return_distance=True)
+        indices, distancias = indices[0], distancias[0] * RADIO_TIERRA_KM
+        if not len(indices):
+            return []
+
+        consulta = np.array([terreno, construccion, habitaciones, banos], dtype=np.float64) / self._escala
+        diferencias = np.sqrt(((self._caracteristicas[indices] - consulta) ** 2).sum(axis=1))
+        if grupo is not None:
+            diferencias += PENALIZACION_GRUPO * (self.columnas['GrupoUbicacion'][indices] != grupo)
+        # Ties in similarity go to the closest property
+        comparables = []
+        for posicion in np.lexsort((distancias, diferencias))[:k]:
+            indice = indices[posicion]
+            comparable = {'Direccion': str(self.columnas['Direccion'][indice])}
+            comparable.update({nombre: float(self.columnas[nombre][indice]) for nombre in COLUMNAS_NUMERICAS})
+            comparable['distancia_km'] = float(distancias[posicion])
+            comparables.append(comparable)
+        return comparables
+
+
+def cargar_comparables(ruta=RUTA_COMPARABLES):
+    # {tipo_propiedad: IndiceComparables}, built once at startup from the columnar file
+    import pyarrow.parquet as pq
+
+    tabla = pq.read_table(ruta, columns=COLUMNAS_COMPARABLES)
+    tipos = tabla.column('tipo_propiedad').to_numpy(zero_copy_only=False)
+    indices = {}
+    for tipo_propiedad in np.unique(tipos):
+        filas = np.flatnonzero(tipos == tipo_propiedad)
+        columnas = {nombre: tabla.column(nombre).to_numpy(zero_copy_only=False)[filas]
+                    for nombre in COLUMNAS_COMPARABLES if nombre != 'tipo_propiedad'}
+        indices[str(tipo_propiedad)] = IndiceComparables(columnas)
+        logger.info(f"{len(filas)} comparables de {tipo_propiedad} indexados")
+    return indices
+
+
+def importar(entrada, salida=RUTA_COMPARABLES, ruta_manifiesto=RUTA_MANIFIESTO):
+    # Converts a CSV of reference properties into the compact Parquet file, adding the
+    # GrupoUbicacion of each property with the cluster model of its type
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    tabla = pd.read_csv(entrada)
+    faltantes = [columna for columna in ['tipo_propiedad'] + COLUMNAS_NUMERICAS if columna not in tabla.columns]
+    if faltantes:
+        raise ValueError(f"Columnas faltantes en {entrada}: {', '.join(faltantes)}")
+    if 'Direccion' not in tabla.columns:
+        tabla['Direccion'] = ""
+    for columna in COLUMNAS_NUMERICAS:
+        tabla[columna] = pd.to_numeric(tabla[columna], errors='coerce')
+    tabla = tabla.dropna(subset=COLUMNAS_NUMERICAS)
+
+    registro = RegistroModelos(ruta_manifiesto, tipos=tabla['tipo_propiedad'].unique()).cargar()
+    tabla['GrupoUbicacion'] = -1
+    for tipo_propiedad in registro.disponibles():
+        filas = tabla['tipo_propiedad'] == tipo_propiedad
+        indice = registro.obtener(tipo_propiedad).modelos['indice_ubicaciones']
+        tabla.loc[filas, 'GrupoUbicacion'] = indice.etiquetar(tabla.loc[filas, 'Latitud'].to_numpy(),
+                                                              tabla.loc[filas, 'Longitud'].to_numpy())
+
+    # float32 keeps coordinates to well under a metre; prices keep full precision
+    esquema = pa.schema(
+        [('tipo_propiedad', pa.string()), ('Direccion', pa.string())]
+        + [(columna, pa.float64() if columna == 'Precio' else pa.float32()) for columna in COLUMNAS_NUMERICAS]
+        + [('GrupoUbicacion', pa.int16())]
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(salida)), exist_ok=True)
+    pq.write_table(pa.Table.from_pandas(tabla[esquema.names], schema=esquema, preserve_index=False), salida,
+                   compression='zstd')
+    return len(tabla)
+
+
+def main(argumentos=None):
+    parser = argparse.ArgumentParser(description="Administra el archivo de propiedades comparables.")
+    subcomandos = parser.add_subparsers(dest='comando', required=True)
+    importacion = subcomandos.add_parser('importar', help="Convierte un CSV de referencia al archivo columnar")
+    importacion.add_argument('entrada', help="CSV con columnas tipo_propiedad, " + ", ".join(COLUMNAS_NUMERICAS)
+                             + " y opcionalmente Direccion")
+    importacion.add_argument('--salida', default=RUTA_COMPARABLES)
+    importacion.add_argument('--manifiesto', default=RUTA_MANIFIESTO)
+    busqueda = subcomandos.add_parser('buscar', help="Muestra los comparables de una propiedad")
+    busqueda.add_argument('tipo', choices=["Casa", "Departamento"])
+    busqueda.add_argument('latitud', type=float)
+    busqueda.add_argument('longitud', type=float)
+    busqueda.add_argument('terreno', type=float)
+    busqueda.add_argument('construccion', type=float)
+    busqueda.add_argument('habitaciones', type=float)
+    busqueda.add_argument('banos', type=float)
+    busqueda.add_argument('--ruta', default=RUTA_COMPARABLES)
+    busqueda.add_argument('-k', type=int, default=COMPARABLES)
+    busqueda.add_argument('--radio-km', type=float, default=RADIO_KM)
+    argumentos = parser.parse_args(argumentos)
+
+    if argumentos.comando == 'importar':
+        filas = importar(argumentos.entrada, argumentos.salida, argumentos.manifiesto)
+        logger.info(f"{filas} propiedades de referencia escritas en {argumentos.salida}")
+        return
+
+    indice = cargar_comparables(argumentos.ruta).get(argumentos.tipo)
+    if indice is None:
+        parser.error(f"No hay comparables de {argumentos.tipo} en {argumentos.ruta}")
+    for comparable in indice.buscar(argumentos.latitud, argumentos.longitud, argumentos.terreno,
+                                    argumentos.construccion, argumentos.habitaciones, argumentos.banos,
+                                    k=argumentos.k, radio_km=argumentos.radio_km):
+        logger.info(comparable)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,440 @@
+# numpy, pandas, joblib and scikit-learn are imported inside the functions that use them so
+# that importing this module stays cheap for workers that only need part of the pipeline
+import argparse
+import hashlib
+import logging
+import math
+import os
+from typing import Any, Dict, Optional, Tuple
+
+from instrumentacion import depurar, tramo
+
+logger = logging.getLogger(__name__)
+
+DIRECTORIO_MODELOS = os.path.dirname(os.path.abspath(__file__))
+
+MODELOS_REQUERIDOS = {
+    'modelo': 'bosque_aleatorio.joblib',
+    'escalador': 'escalador.joblib',
+    'imputador': 'imputador.joblib',
+    'agrupamiento': 'agrupamiento.joblib'
+}
+# Derived structures that replace the sklearn objects they are built from, e.g. in a model bundle
+SUSTITUTOS = {'escalador': 'transformacion', 'imputador': 'transformacion', 'agrupamiento': 'indice_ubicaciones'}
+
+COLUMNAS_ENTRADA = ['Latitud', 'Longitud', 'Terreno', 'Construccion', 'Habitaciones', 'Banos']
+COLUMNAS_CARACTERISTICAS = ['Terreno', 'Construccion', 'Habitaciones', 'Banos', 'GrupoUbicacion']
+
+FACTOR_AJUSTE = 0.63
+# Quantiles of the individual tree predictions that bound the price range
+CUANTILES_RANGO = (0.10, 0.90)
+# Step of each feature in the sensitivity curves, in its own units, and points on each side
+PASOS_SENSIBILIDAD = {'Construccion': 10.0, 'Terreno': 20.0, 'Habitaciones': 1.0, 'Banos': 1.0}
+PUNTOS_SENSIBILIDAD = 4
+
+
+def prefijo_modelos(tipo_propiedad):
+    return "renta_" if tipo_propiedad == "Departamento" else ""
+
+
+def version_artefactos(tipo_propiedad, directorio=DIRECTORIO_MODELOS):
+    # Cheap fingerprint of the artifact files (name, size, mtime); changes whenever one is replaced
+    prefijo = prefijo_modelos(tipo_propiedad)
+    huella = hashlib.sha1()
+    for nombre_archivo in MODELOS_REQUERIDOS.values():
+        try:
+            estado = os.stat(os.path.join(directorio, f"{prefijo}{nombre_archivo}"))
+            huella.update(f"{nombre_archivo}:{estado.st_size}:{estado.st_mtime_ns};".encode())
+        except FileNotFoundError:
+            huella.update(f"{nombre_archivo}:ausente;".encode())
+    return huella.hexdigest()[:12]
+
+
+def cargar_artefactos(tipo_propiedad, directorio=DIRECTORIO_MODELOS):
+    import joblib
+
+    prefijo = prefijo_modelos(tipo_propiedad)
+    modelos = {}
+    for nombre_modelo, nombre_archivo in MODELOS_REQUERIDOS.items():
+        ruta_archivo = os.path.join(directorio, f"{prefijo}{nombre_archivo}")
+        if not os.path.exists(ruta_archivo):
+            raise FileNotFoundError(f"Archivo de modelo no encontrado: {ruta_archivo}")
+        modelos[nombre_modelo] = joblib.load(ruta_archivo)
+    modelos['transformacion'] = TransformacionFusionada.desde_modelos(modelos)
+    modelos['indice_ubicaciones'] = _obtener_indice_ubicaciones(modelos)
+    return modelos
+
+
+class TransformacionFusionada:
+    # imputador -> escalador chain collapsed into one in-place NumPy pass: missing values are
+    # replaced by the imputer statistics, then the scaler mean is subtracted and its scale
+    # divided, the same operations in the same order as sklearn, so results are identical
+    def __init__(self, estadisticas, media, escala, valor_faltante=float('nan')):
+        import numpy as np
+
+        self.estadisticas = np.asarray(estadisticas, dtype=np.float64)
+        self.media = None if media is None else np.asarray(media, dtype=np.float64)
+        self.escala = None if escala is None else np.asarray(escala, dtype=np.float64)
+        self.valor_faltante = valor_faltante
+
+    @classmethod
+    def desde_modelos(cls, modelos):
+        import numpy as np
+
+        imputador, escalador = modelos['imputador'], modelos['escalador']
+        estadisticas = np.asarray(imputador.statistics_, dtype=np.float64)
+        # Columns the imputer would drop or flag change the output shape and cannot be fused
+        if getattr(imputador, 'add_indicator', False) or np.isnan(estadisticas).any():
+            raise ValueError("El imputador no se puede fusionar con el escalador")
+        media = escalador.mean_ if escalador.with_mean else None
+        escala = escalador.scale_ if escalador.with_std else None
+        return cls(estadisticas, media, escala, imputador.missing_values)
+
+    def transformar(self, datos):
+        # datos is a C-contiguous float64 (rows, 5) buffer, modified in place and returned
+        import numpy as np
+
+        if self.valor_faltante != self.valor_faltante:
+            faltantes = np.isnan(datos)
+        else:
+            faltantes = datos == self.valor_faltante
+        if faltantes.any():
+            np.copyto(datos, np.broadcast_to(self.estadisticas, datos.shape), where=faltantes)
+        if self.media is not None:
+            datos -= self.media
+        if self.escala is not None:
+            datos /= self.escala
+        return datos
+
+
+def verificar_transformacion(modelos, datos):
+    # True when the fused transform reproduces imputador -> escalador bit for bit on datos
+    import numpy as np
+    import pandas as pd
+
+    esperado = modelos['escalador'].transform(
+        modelos['imputador'].transform(pd.DataFrame(datos, columns=COLUMNAS_CARACTERISTICAS)))
+    obtenido = _obtener_transformacion(modelos).transformar(np.array(datos, dtype=np.float64))
+    return bool(np.array_equal(esperado, obtenido))
+
+
+def _entrada_modelo(datos, modelo):
+    # sklearn models fitted on a DataFrame expect the column names; the compiled forest does not
+    if getattr(modelo, 'feature_names_in_', None) is None:
+        return datos
+    import pandas as pd
+
+    return pd.DataFrame(datos, columns=COLUMNAS_CARACTERISTICAS)
+
+
+def _obtener_indice_ubicaciones(modelos):
+    if 'indice_ubicaciones' not in modelos:
+        from indice_ubicaciones import IndiceUbicaciones
+
+        modelos['indice_ubicaciones'] = IndiceUbicaciones.desde_modelo(modelos['agrupamiento'])
+    return modelos['indice_ubicaciones']
+
+
+def _obtener_transformacion(modelos):
+    if 'transformacion' not in modelos:
+        modelos['transformacion'] = TransformacionFusionada.desde_modelos(modelos)
+    return modelos['transformacion']
+
+
+def validar_cuantiles(cuantiles):
+    inferior, superior = (float(cuantil) for cuantil in cuantiles)
+    if not 0.0 <= inferior < superior <= 1.0:
+        raise ValueError(f"Cuantiles de rango inválidos: {inferior}, {superior}")
+    return inferior, superior
+
+
+def predicciones_por_arbol(modelo, datos):
+    # (rows, trees) prediction of every tree of the forest. Adding the columns in tree order and
+    # dividing by the number of trees is exactly what predict() does, so the mean, the range and
+    # the estimate all come from this one pass
+    import numpy as np
+
+    if hasattr(modelo, 'hojas'):
+        if len(datos) == 1:
+            return np.array([modelo.hojas_fila(np.asarray(datos)[0])])
+        return modelo.hojas(datos)
+    # Same float32 input that the forest's own predict() hands to its trees
+    X = np.ascontiguousarray(np.asarray(datos), dtype=np.float32)
+    return np.column_stack([arbol.predict(X, check_input=False) for arbol in modelo.estimators_])
+
+
+def resumir_arboles(predicciones, cuantiles=CUANTILES_RANGO):
+    import numpy as np
+
+    medias = np.zeros(len(predicciones), dtype=np.float64)
+    for arbol in range(predicciones.shape[1]):
+        medias += predicciones[:, arbol]
+    medias /= predicciones.shape[1]
+    inferiores, superiores = np.quantile(predicciones, cuantiles, axis=1)
+    return medias, inferiores, superiores
+
+
+def agregar_caracteristica_grupo(latitud, longitud, modelos):
+    try:
+        with tramo('agrupar'):
+            grupo = _obtener_indice_ubicaciones(modelos).etiqueta(latitud, longitud)
+            if grupo is None:
+                raise ValueError(f"Coordenadas inválidas: {latitud}, {longitud}")
+        return grupo
+    except Exception as e:
+        logger.error(f"Error al agregar característica de grupo: {str(e)}")
+        return None
+
+
+def preprocesar_datos(latitud, longitud, terreno, construccion, habitaciones, banos, modelos):
+    import numpy as np
+
+    try:
+        with tramo('preprocesar'):
+            grupo_ubicacion = agregar_caracteristica_grupo(latitud, longitud, modelos)
+
+            # Convert all values to float explicitly
+            terreno_val = float(terreno) if terreno is not None else 0.0
+            construccion_val = float(construccion) if construccion is not None else 0.0
+            habitaciones_val = float(habitaciones) if habitaciones is not None else 0.0
+            banos_val = float(banos) if banos is not None else 0.0
+            grupo_val = float(grupo_ubicacion) if grupo_ubicacion is not None else 0.0
+
+            datos = np.array([[terreno_val, construccion_val, habitaciones_val, banos_val, grupo_val]])
+            depurar(logger, "preprocesar.entrada", lambda: dict(zip(COLUMNAS_CARACTERISTICAS, datos[0].tolist())))
+            _obtener_transformacion(modelos).transformar(datos)
+            depurar(logger, "preprocesar.salida", lambda: datos[0].tolist())
+
+            return _entrada_modelo(datos, modelos['modelo'])
+    except Exception as e:
+        logger.error(f"Error al preprocesar datos: {str(e)}")
+        return None
+
+
+def predecir_precio(datos_procesados, modelos):
+    try:
+        with tramo('predecir'):
+            predicciones = predicciones_por_arbol(modelos['modelo'], datos_procesados)
+            precio_bruto, inferior_bruto, superior_bruto = (
+                float(valores[0]) for valores in
+                resumir_arboles(predicciones, modelos.get('cuantiles', CUANTILES_RANGO))
+            )
+
+            # Apply 63% adjustment to the raw prediction
+            precio_ajustado = precio_bruto * FACTOR_AJUSTE
+
+            # Round the adjusted price
+            precio_redondeado = math.floor(precio_ajustado / 1000) * 1000
+
+            # The range is the spread of the individual trees, adjusted and rounded outwards like
+            # the estimate and widened when needed so that it contains the estimate
+            rango_precio_min = max(0, min(math.floor((inferior_bruto * FACTOR_AJUSTE) / 1000) * 1000, precio_redondeado))
+            rango_precio_max = max(math.ceil((superior_bruto * FACTOR_AJUSTE) / 1000) * 1000, precio_redondeado)
+
+        depurar(logger, "predecir", lambda: {
+            'precio_bruto': precio_bruto, 'cuantiles_brutos': [inferior_bruto, superior_bruto],
+            'precio': precio_redondeado, 'rango': [rango_precio_min, rango_precio_max],
+        })
+        return precio_redondeado, rango_precio_min, rango_precio_max
+    except Exception as e:
+        logger.error(f"Error al predecir el precio: {str(e)}")
+        return None, None, None
+
+
+def agrupar_ubicaciones(latitudes, longitudes, modelos):
+    # Rows without valid coordinates get group 0.0, as agregar_caracteristica_grupo does
+    etiquetas = _obtener_indice_ubicaciones(modelos).etiquetar(latitudes, longitudes)
+    etiquetas[etiquetas < 0] = 0
+    return etiquetas.astype('float64')
+
+
+def preprocesar_lote(entradas, modelos):
+    import numpy as np
+    import pandas as pd
+
+    columnas = {
+        columna: pd.to_numeric(np.asarray(entradas[columna]), errors='coerce').astype(np.float64)
+        for columna in COLUMNAS_ENTRADA
+    }
+    grupos = agrupar_ubicaciones(columnas['Latitud'], columnas['Longitud'], modelos)
+
+    # Features are written straight into one preallocated buffer that is transformed in place;
+    # missing values become 0.0, matching the None handling of preprocesar_datos
+    datos = np.empty((len(grupos), len(COLUMNAS_CARACTERISTICAS)), dtype=np.float64)
+    for posicion, columna in enumerate(COLUMNAS_CARACTERISTICAS[:-1]):
+        valores = columnas[columna]
+        valores[np.isnan(valores)] = 0.0
+        datos[:, posicion] = valores
+    datos[:, -1] = grupos
+
+    _obtener_transformacion(modelos).transformar(datos)
+    return _entrada_modelo(datos, modelos['modelo'])
+
+
+def ajustar_precios(precios_brutos, inferiores_brutos, superiores_brutos):
+    import numpy as np
+
+    precios = np.floor((np.asarray(precios_brutos, dtype=np.float64) * FACTOR_AJUSTE) / 1000) * 1000
+    minimos = np.maximum(0, np.minimum(
+        np.floor((np.asarray(inferiores_brutos, dtype=np.float64) * FACTOR_AJUSTE) / 1000) * 1000, precios))
+    maximos = np.maximum(
+        np.ceil((np.asarray(superiores_brutos, dtype=np.float64) * FACTOR_AJUSTE) / 1000) * 1000, precios)
+
+    # predecir_precio fails as a whole when any of the three values is not finite
+    invalidos = ~(np.isfinite(precios) & np.isfinite(minimos) & np.isfinite(maximos))
+    precios[invalidos] = np.nan
+    minimos[invalidos] = np.nan
+    maximos[invalidos] = np.nan
+    return precios, minimos, maximos
+
+
+def estimar_lote(entradas, modelos):
+    # Batches are timed as their own stages so they do not skew the single-row distributions
+    with tramo('preprocesar_lote'):
+        datos_procesados = preprocesar_lote(entradas, modelos)
+    with tramo('predecir_lote'):
+        predicciones = predicciones_por_arbol(modelos['modelo'], datos_procesados)
+        precios_brutos, inferiores_brutos, superiores_brutos = resumir_arboles(
+            predicciones, modelos.get('cuantiles', CUANTILES_RANGO))
+    return ajustar_precios(precios_brutos, inferiores_brutos, superiores_brutos)
+
+
+def curvas_sensibilidad(latitud, longitud, terreno, construccion, habitaciones, banos, modelos,
+                        pasos=PASOS_SENSIBILIDAD, puntos=PUNTOS_SENSIBILIDAD):
+    # {caracteristica: (valores, precios, minimos, maximos)} moving one feature at a time by
+    # -puntos..puntos steps around the user's inputs, negative values left out. The location
+    # group is computed once and every point of every curve goes through the transform and the
+    # forest as one matrix, so the offset 0 point of each curve equals predecir_precio
+    import numpy as np
+
+    with tramo('sensibilidad'):
+        grupo = agregar_caracteristica_grupo(latitud, longitud, modelos)
+        base = np.array([0.0 if valor is None else float(valor)
+                         for valor in (terreno, construccion, habitaciones, banos, grupo)])
+        desplazamientos = np.arange(-puntos, puntos + 1, dtype=np.float64)
+
+        curvas = []
+        for caracteristica, paso in pasos.items():
+            posicion = COLUMNAS_CARACTERISTICAS.index(caracteristica)
+            valores = base[posicion] + desplazamientos * paso
+            curvas.append((caracteristica, posicion, valores[valores >= 0]))
+
+        datos = np.repeat(base[np.newaxis, :], sum(len(valores) for _, _, valores in curvas), axis=0)
+        inicio = 0
+        for _, posicion, valores in curvas:
+            datos[inicio:inicio + len(valores), posicion] = valores
+            inicio += len(valores)
+        _obtener_transformacion(modelos).transformar(datos)
+        predicciones = predicciones_por_arbol(modelos['modelo'], _entrada_modelo(datos, modelos['modelo']))
+        precios, minimos, maximos = ajustar_precios(
+            *resumir_arboles(predicciones, modelos.get('cuantiles', CUANTILES_RANGO)))
+
+    resultado = {}
+    inicio = 0
+    for caracteristica, _, valores in curvas:
+        fin = inicio + len(valores)
+        resultado[caracteristica] = (valores, precios[inicio:fin], minimos[inicio:fin], maximos[inicio:fin])
+        inicio = fin
+    return resultado
+
+
+class Estimador:
+    def __init__(self, tipo_propiedad: str, modelos: Dict[str, Any], version: Optional[str] = None,
+                 cuantiles: Optional[Tuple[float, float]] = None) -> None:
+        faltantes = [nombre for nombre in MODELOS_REQUERIDOS
+                     if nombre not in modelos and SUSTITUTOS.get(nombre) not in modelos]
+        if faltantes:
+            raise ValueError(f"Faltan modelos para {tipo_propiedad}: {', '.join(faltantes)}")
+        self.tipo_propiedad = tipo_propiedad
+        self.modelos = modelos
+        self.version = version
+        # Kept in modelos so that predecir_precio and estimar_lote use them when given only modelos
+        if cuantiles is not None:
+            modelos['cuantiles'] = validar_cuantiles(cuantiles)
+        self.cuantiles = modelos.get('cuantiles', CUANTILES_RANGO)
+        # Derived structures are built up front so concurrent requests only ever read modelos
+        _obtener_transformacion(modelos)
+        _obtener_indice_ubicaciones(modelos)
+
+    @classmethod
+    def cargar(cls, tipo_propiedad: str, directorio: str = DIRECTORIO_MODELOS,
+               compilado: bool = False) -> "Estimador":
+        version = version_artefactos(tipo_propiedad, directorio)
+        modelos = cargar_artefactos(tipo_propiedad, directorio)
+        if compilado:
+            from bosque_compilado import cargar_bosque_compilado
+
+            # The compiled forest has the same predict() interface and identical output
+            bosque = cargar_bosque_compilado(tipo_propiedad, directorio)
+            if bosque is not None:
+                bosque.cargar_lotes = lambda bosque_sklearn=modelos['modelo']: bosque_sklearn
+                modelos['modelo'] = bosque
+        return cls(tipo_propiedad, modelos, version)
+
+    def estimar(self, latitud: Optional[float], longitud: Optional[float], terreno: float,
+                construccion: float, habitaciones: float,
+                banos: float) -> Tuple[Optional[int], Optional[int], Optional[int]]:
+        datos_procesados = preprocesar_datos(latitud, longitud, terreno, construccion, habitaciones, banos, self.modelos)
+        if datos_procesados is None:
+            return None, None, None
+        return predecir_precio(datos_procesados, self.modelos)
+
+    def estimar_lote(self, entradas: Any) -> Tuple[Any, Any, Any]:
+        return estimar_lote(entradas, self.modelos)
+
+    def calentar(self) -> None:
+        # One estimate at the first cluster center builds whatever is derived lazily (such as the
+        # location index) and touches the pages of mapped arrays before any request needs them
+        latitud, longitud = _obtener_indice_ubicaciones(self.modelos).centros[0]
+        self.estimar(float(latitud), float(longitud), 100.0, 100.0, 2.0, 1.0)
+
+    def curvas_sensibilidad(self, latitud: Optional[float], longitud: Optional[float], terreno: float,
+                            construccion: float, habitaciones: float,
+                            banos: float) -> Dict[str, Tuple[Any, Any, Any, Any]]:
+        return curvas_sensibilidad(latitud, longitud, terreno, construccion, habitaciones, banos, self.modelos)
+
+
+def leer_tabla(ruta):
+    import pandas as pd
+
+    if ruta.endswith('.parquet'):
+        return pd.read_parquet(ruta)
+    return pd.read_csv(ruta)
+
+
+def escribir_tabla(tabla, ruta):
+    if ruta.endswith('.parquet'):
+        tabla.to_parquet(ruta, index=False)
+    else:
+        tabla.to_csv(ruta, index=False)
+
+
+def main(argumentos=None):
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description="Estimación de precios por lotes desde CSV o Parquet.")
+    parser.add_argument('entrada', help="Archivo CSV o Parquet con columnas " + ", ".join(COLUMNAS_ENTRADA))
+    parser.add_argument('salida', help="Archivo CSV o Parquet de resultados")
+    parser.add_argument('--tipo', choices=["Casa", "Departamento"], default="Casa")
+    parser.add_argument('--compilado', action='store_true',
+                        help="Usa el bosque compilado con bosque_compilado.py si está disponible")
+    argumentos = parser.parse_args(argumentos)
+
+    tabla = leer_tabla(argumentos.entrada)
+    faltantes = [columna for columna in COLUMNAS_ENTRADA if columna not in tabla.columns]
+    if faltantes:
+        parser.error(f"Columnas faltantes en {argumentos.entrada}: {', '.join(faltantes)}")
+
+    estimador = Estimador.cargar(argumentos.tipo, compilado=argumentos.compilado)
+    precios, minimos, maximos = estimador.estimar_lote(tabla)
+
+    tabla['precio_estimado'] = pd.Series(precios, index=tabla.index).astype('Int64')
+    tabla['precio_minimo'] = pd.Series(minimos, index=tabla.index).astype('Int64')
+    tabla['precio_maximo'] = pd.Series(maximos, index=tabla.index).astype('Int64')
+    escribir_tabla(tabla, argumentos.salida)
+    logger.info(f"{len(tabla)} propiedades estimadas en {argumentos.salida}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,38 @@
+import logging
+
+from instrumentacion import METRICAS
+
+logger = logging.getLogger(__name__)
+
+PREFIJO_ETAPA = "flujo_"
+
+EJECUCIONES_ETAPAS = METRICAS.contador('flujo_etapas_total', "Etapas del asistente calculadas o reutilizadas",
+                                       ('etapa', 'resultado'))
+
+
+class FlujoSesion:
+    # Incremental evaluation of the wizard stages (address -> coordinates -> prediction -> lead).
+    # Each stage keeps its last result in the session next to the inputs that produced it, and
+    # calcular() runs the stage again only when those inputs change. A stage lists the results of
+    # the stages it depends on among its inputs, so a change flows down the chain and a plain
+    # Streamlit rerun reuses everything
+    def __init__(self, estado, prefijo=PREFIJO_ETAPA):
+        self.estado = estado
+        self.prefijo = prefijo
+
+    def calcular(self, etapa, entradas, funcion, valido=None):
+        # entradas must be comparable with ==. Results that are None, or that valido() rejects,
+        # are returned but not kept, so a failed stage is attempted again on the next rerun
+        clave = self.prefijo + etapa
+        guardado = self.estado.get(clave)
+        if guardado is not None and guardado[0] == entradas:
+            EJECUCIONES_ETAPAS.incrementar(etapa, "reutilizada")
+            return guardado[1]
+
+        EJECUCIONES_ETAPAS.incrementar(etapa, "calculada")
+        resultado = funcion()
+        if resultado is None or (valido is not None and not valido(resultado)):
+            self.estado.pop(clave, None)
+        else:
+            self.estado[clave] = (entradas, resultado)
+        return resultado
@@ -0,0 +1,479 @@
+import bisect
+import csv
+import difflib
+import heapq
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from itertools import accumulate
+
+from geopy.exc import GeocoderRateLimited, GeocoderTimedOut, GeocoderUnavailable
+from geopy.location import Location
+
+logger = logging.getLogger(__name__)
+
+RUTA_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'geocodificacion.sqlite3')
+
+TTL_POSITIVO = 30 * 24 * 3600
+TTL_NEGATIVO = 24 * 3600
+CAPACIDAD_MEMORIA = 2048
+
+# Nominatim's usage policy allows one request per second per application
+TASA_SOLICITUDES = 1.0
+RAFAGA_SOLICITUDES = 2
+REINTENTOS = 3
+ESPERA_BASE_REINTENTO = 0.5
+ERRORES_TRANSITORIOS = (GeocoderTimedOut, GeocoderUnavailable, GeocoderRateLimited)
+
+# Words the app appends to every query that a gazetteer entry may omit
+PALABRAS_OPCIONALES = {"mexico"}
+
+
+def normalizar_direccion(direccion):
+    texto = unicodedata.normalize('NFKD', direccion or "")
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    texto = re.sub(r'[^\w]+', ' ', texto.casefold())
+    return " ".join(texto.split())
+
+
+def _serializar_ubicacion(ubicacion):
+    return [ubicacion.address, ubicacion.latitude, ubicacion.longitude, ubicacion.raw]
+
+
+def _deserializar_ubicacion(datos):
+    direccion, latitud, longitud, crudo = datos
+    return Location(direccion, (latitud, longitud), crudo)
+
+
+class CacheGeocodificacion:
+    def __init__(self, ruta=RUTA_CACHE, capacidad=CAPACIDAD_MEMORIA, ttl=TTL_POSITIVO, ttl_negativo=TTL_NEGATIVO):
+        self.capacidad = capacidad
+        self.ttl = ttl
+        self.ttl_negativo = ttl_negativo
+        self._memoria = OrderedDict()
+        self._candado = threading.Lock()
+        self.aciertos_memoria = 0
+        self.aciertos_disco = 0
+        self.aciertos_negativos = 0
+        self.fallos = 0
+
+        self._conexion = None
+        if ruta:
+            os.makedirs(os.path.dirname(os.path.abspath(ruta)), exist_ok=True)
+            self._conexion = sqlite3.connect(ruta, check_same_thread=False)
+            self._conexion.execute(
+                "CREATE TABLE IF NOT EXISTS geocodificaciones "
+                "(clave TEXT PRIMARY KEY, valor TEXT, expira REAL NOT NULL)"
+            )
+            self._conexion.commit()
+            self.purgar_expirados()
+
+    def obtener(self, clave):
+        # Returns (encontrado, valor); a found value of None is a cached negative result
+        ahora = time.time()
+        with self._candado:
+            entrada = self._memoria.get(clave)
+            if entrada is not None:
+                valor, expira = entrada
+                if expira > ahora:
+                    self._memoria.move_to_end(clave)
+                    self.aciertos_memoria += 1
+                    if valor is None:
+                        self.aciertos_negativos += 1
+                    return True, valor
+                del self._memoria[clave]
+
+            if self._conexion is not None:
+                fila = self._conexion.execute(
+                    "SELECT valor, expira FROM geocodificaciones WHERE clave = ?", (clave,)
+                ).fetchone()
+                if fila is not None:
+                    valor_json, expira = fila
+                    if expira > ahora:
+                        valor = json.loads(valor_json)
+                        self._guardar_en_memoria(clave, valor, expira)
+                        self.aciertos_disco += 1
+                        if valor is None:
+                            self.aciertos_negativos += 1
+                        return True, valor
+                    self._conexion.execute("DELETE FROM geocodificaciones WHERE clave = ?", (clave,))
+                    self._conexion.commit()
+
+            self.fallos += 1
+            return False, None
+
+    def guardar(self, clave, valor):
+        expira = time.time() + (self.ttl if valor is not None else self.ttl_negativo)
+        with self._candado:
+            self._guardar_en_memoria(clave, valor, expira)
+            if self._conexion is not None:
+                self._conexion.execute(
+                    "INSERT OR REPLACE INTO geocodificaciones (clave, valor, expira) VALUES (?, ?, ?)",
+                    (clave, json.dumps(valor), expira)
+                )
+                self._conexion.commit()
+
+    def _guardar_en_memoria(self, clave, valor, expira):
+        self._memoria[clave] = (valor, expira)
+        self._memoria.move_to_end(clave)
+        while len(self._memoria) > self.capacidad:
+            self._memoria.popitem(last=False)
+
+    def purgar_expirados(self):
+        ahora = time.time()
+        with self._candado:
+            for clave in [clave for clave, (_, expira) in self._memoria.items() if expira <= ahora]:
+                del self._memoria[clave]
+            if self._conexion is not None:
+                self._conexion.execute("DELETE FROM geocodificaciones WHERE expira <= ?", (ahora,))
+                self._conexion.commit()
+
+    def estadisticas(self):
+        with self._candado:
+            aciertos = self.aciertos_memoria + self.aciertos_disco
+            consultas = aciertos + self.fallos
+            return {
+                'aciertos_memoria': self.aciertos_memoria,
+                'aciertos_disco': self.aciertos_disco,
+                'aciertos_negativos': self.aciertos_negativos,
+                'fallos': self.fallos,
+                'tasa_aciertos': aciertos / consultas if consultas else 0.0,
+                'entradas_memoria': len(self._memoria),
+            }
+
+
+class GeocodificadorCacheado:
+    # Drop-in replacement for a geopy geocoder: only successful answers and "not found"
+    # results are cached, timeouts and unavailability errors still propagate
+    def __init__(self, geolocalizador, cache):
+        self.geolocalizador = geolocalizador
+        self.cache = cache
+
+    def geocode(self, consulta, exactly_one=True, limit=None):
+        clave = f"{'uno' if exactly_one else f'varios:{limit}'}|{normalizar_direccion(consulta)}"
+        encontrado, valor = self.cache.obtener(clave)
+        if encontrado:
+            logger.debug("Geocodificación desde cache: %s", clave)
+            return self._reconstruir(valor, exactly_one)
+
+        resultado = self.geolocalizador.geocode(consulta, exactly_one=exactly_one, limit=limit)
+        if not resultado:
+            self.cache.guardar(clave, None)
+        elif exactly_one:
+            self.cache.guardar(clave, _serializar_ubicacion(resultado))
+        else:
+            self.cache.guardar(clave, [_serializar_ubicacion(ubicacion) for ubicacion in resultado])
+        return resultado
+
+    @staticmethod
+    def _reconstruir(valor, exactly_one):
+        if valor is None:
+            return None
+        if exactly_one:
+            return _deserializar_ubicacion(valor)
+        return [_deserializar_ubicacion(datos) for datos in valor]
+
+
+class LimitadorTasa:
+    # Token bucket shared by every thread that talks to the same geocoder
+    def __init__(self, tasa=TASA_SOLICITUDES, capacidad=RAFAGA_SOLICITUDES, reloj=time.monotonic, dormir=time.sleep):
+        self.tasa = tasa
+        self.capacidad = capacidad
+        self._reloj = reloj
+        self._dormir = dormir
+        self._fichas = float(capacidad)
+        self._ultima_recarga = reloj()
+        self._candado = threading.Lock()
+
+    def adquirir(self):
+        while True:
+            with self._candado:
+                ahora = self._reloj()
+                self._fichas = min(self.capacidad, self._fichas + (ahora - self._ultima_recarga) * self.tasa)
+                self._ultima_recarga = ahora
+                if self._fichas >= 1:
+                    self._fichas -= 1
+                    return
+                espera = (1 - self._fichas) / self.tasa
+            self._dormir(espera)
+
+
+class _ConsultaEnVuelo:
+    def __init__(self):
+        self.terminada = threading.Event()
+        self.resultado = None
+        self.error = None
+
+
+class ClienteGeocodificacion:
+    # Shared geopy-compatible client: identical concurrent queries are merged into one
+    # request, every request goes through the token bucket and transient errors are retried
+    def __init__(self, geolocalizador, limitador=None, reintentos=REINTENTOS, espera_base=ESPERA_BASE_REINTENTO,
+                 capacidad_prefijos=256, dormir=time.sleep):
+        self.geolocalizador = geolocalizador
+        self.limitador = limitador or LimitadorTasa()
+        self.reintentos = reintentos
+        self.espera_base = espera_base
+        self.capacidad_prefijos = capacidad_prefijos
+        self._dormir = dormir
+        self._en_vuelo = {}
+        self._sugerencias_recientes = OrderedDict()
+        self._candado = threading.Lock()
+        self.solicitudes = 0
+        self.consultas_fusionadas = 0
+        self.respuestas_por_prefijo = 0
+
+    def geocode(self, consulta, exactly_one=True, limit=None):
+        if not exactly_one:
+            reutilizadas = self._sugerencias_por_prefijo(consulta, limit)
+            if reutilizadas is not None:
+                return reutilizadas
+
+        clave = (exactly_one, limit, normalizar_direccion(consulta))
+        with self._candado:
+            vuelo = self._en_vuelo.get(clave)
+            lider = vuelo is None
+            if lider:
+                vuelo = self._en_vuelo[clave] = _ConsultaEnVuelo()
+            else:
+                self.consultas_fusionadas += 1
+
+        if not lider:
+            vuelo.terminada.wait()
+            if vuelo.error is not None:
+                raise vuelo.error
+            return vuelo.resultado
+
+        try:
+            vuelo.resultado = self._consultar(consulta, exactly_one, limit)
+            if not exactly_one:
+                self._recordar_sugerencias(clave[2], vuelo.resultado or [], limit)
+            return vuelo.resultado
+        except Exception as e:
+            vuelo.error = e
+            raise
+        finally:
+            with self._candado:
+                del self._en_vuelo[clave]
+            vuelo.terminada.set()
+
+    def _consultar(self, consulta, exactly_one, limit):
+        for intento in range(self.reintentos + 1):
+            self.limitador.adquirir()
+            with self._candado:
+                self.solicitudes += 1
+            try:
+                return self.geolocalizador.geocode(consulta, exactly_one=exactly_one, limit=limit)
+            except ERRORES_TRANSITORIOS as e:
+                if intento == self.reintentos:
+                    raise
+                espera = getattr(e, 'retry_after', None) or self.espera_base * 2 ** intento
+                logger.warning(f"Geocodificador no disponible, reintento {intento + 1} en {espera:.1f}s")
+                self._dormir(espera)
+
+    def _recordar_sugerencias(self, consulta_normalizada, ubicaciones, limite):
+        with self._candado:
+            self._sugerencias_recientes[consulta_normalizada] = (list(ubicaciones), limite)
+            self._sugerencias_recientes.move_to_end(consulta_normalizada)
+            while len(self._sugerencias_recientes) > self.capacidad_prefijos:
+                self._sugerencias_recientes.popitem(last=False)
+
+    def _sugerencias_por_prefijo(self, consulta, limite):
+        # "Calle Princ, México" can be answered from the results of "Calle Prin, México" when
+        # that answer was not truncated by the limit, or when every result still matches
+        palabras = normalizar_direccion(consulta).split()
+        with self._candado:
+            candidatas = list(self._sugerencias_recientes.items())
+        for consulta_previa, (ubicaciones, limite_previo) in reversed(candidatas):
+            palabras_previas = consulta_previa.split()
+            if limite_previo != limite or len(palabras_previas) != len(palabras):
+                continue
+            if palabras_previas == palabras or not all(
+                    actual.startswith(previa) for previa, actual in zip(palabras_previas, palabras)):
+                continue
+            coincidentes = [u for u in ubicaciones if _coincide_con_palabras(u.address, palabras)]
+            completa = limite is None or len(ubicaciones) < limite
+            if coincidentes and (completa or len(coincidentes) == len(ubicaciones)):
+                with self._candado:
+                    self.respuestas_por_prefijo += 1
+                return coincidentes
+        return None
+
+    def estadisticas(self):
+        with self._candado:
+            return {
+                'solicitudes': self.solicitudes,
+                'consultas_fusionadas': self.consultas_fusionadas,
+                'respuestas_por_prefijo': self.respuestas_por_prefijo,
+            }
+
+
+def _coincide_con_palabras(direccion, palabras):
+    palabras_direccion = normalizar_direccion(direccion).split()
+    return all(any(candidata.startswith(palabra) for candidata in palabras_direccion) for palabra in palabras)
+
+
+class GeocodificadorLocal:
+    # Offline geopy-compatible geocoder over a gazetteer CSV with columns direccion, latitud
+    # and longitud. Every word of the query is matched as a prefix against an inverted
+    # index of sorted words, with a fuzzy fallback for misspelled words. Addresses are numbered
+    # in ranking order (shorter keys first, then file order), so posting lists are already
+    # sorted by rank: buscar() reads the postings of the rarest query word in that order, checks
+    # each address against the other words and stops once it has limite results
+    def __init__(self, direcciones):
+        filas = [(normalizar_direccion(direccion), direccion, float(latitud), float(longitud))
+                 for direccion, latitud, longitud in direcciones]
+        # Stable sort: equal lengths keep the file order
+        filas.sort(key=lambda fila: len(fila[0]))
+        self.nombres = []
+        self.claves = []
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+        publicaciones = {}
+        for identificador, (clave, direccion, latitud, longitud) in enumerate(filas):
+            self.nombres.append(direccion)
+            self.claves.append(clave)
+            self.latitudes.append(latitud)
+            self.longitudes.append(longitud)
+            for palabra in set(clave.split()):
+                publicaciones.setdefault(palabra, array('i')).append(identificador)
+        self.vocabulario = sorted(publicaciones)
+        self.publicaciones = [publicaciones[palabra] for palabra in self.vocabulario]
+        # Running total of posting lengths: the postings of a prefix range are counted in O(1)
+        self.acumulados = array('q', accumulate((len(lista) for lista in self.publicaciones), initial=0))
+        # Keys in alphabetical order, to find the addresses that start with the whole query
+        orden = sorted(range(len(self.claves)), key=self.claves.__getitem__)
+        self.claves_ordenadas = [self.claves[identificador] for identificador in orden]
+        self.orden_claves = array('i', orden)
+
+    @classmethod
+    def desde_archivo(cls, ruta):
+        with open(ruta, newline='', encoding='utf-8') as archivo:
+            filas = csv.DictReader(archivo)
+            geocodificador = cls((fila['direccion'], fila['latitud'], fila['longitud']) for fila in filas)
+        logger.info(f"Nomenclátor cargado desde {ruta}: {len(geocodificador.nombres)} direcciones")
+        return geocodificador
+
+    @staticmethod
+    def _rango(ordenados, prefijo):
+        inicio = bisect.bisect_left(ordenados, prefijo)
+        fin = bisect.bisect_left(ordenados, prefijo + '\uffff', lo=inicio)
+        return inicio, fin
+
+    def _rango_prefijo(self, prefijo):
+        return self._rango(self.vocabulario, prefijo)
+
+    def _coincidencias_palabra(self, palabra):
+        # (number of postings, vocabulary positions, test for one word of an address) of a query
+        # word: the words it prefixes, or its close spellings when it prefixes none
+        inicio, fin = self._rango_prefijo(palabra)
+        if inicio < fin:
+            return (self.acumulados[fin] - self.acumulados[inicio], range(inicio, fin),
+                    lambda candidata: candidata.startswith(palabra))
+        vecinos_inicio, vecinos_fin = self._rango_prefijo(palabra[:2])
+        parecidas = set(difflib.get_close_matches(
+            palabra, self.vocabulario[vecinos_inicio:vecinos_fin], n=3, cutoff=0.75))
+        posiciones = [bisect.bisect_left(self.vocabulario, parecida) for parecida in parecidas]
+        return sum(len(self.publicaciones[posicion]) for posicion in posiciones), posiciones, parecidas.__contains__
+
+    def buscar(self, consulta, limite=5):
+        # Identifiers of the matching addresses, best first: those whose key starts with the
+        # whole query, then the rest, each group in rank order
+        clave_consulta = normalizar_direccion(consulta)
+        palabras = clave_consulta.split()
+        if not palabras:
+            return []
+
+        coincidencias = []
+        for palabra in palabras:
+            frecuencia, posiciones, coincide = self._coincidencias_palabra(palabra)
+            if not frecuencia:
+                if palabra in PALABRAS_OPCIONALES:
+                    continue
+                return []
+            coincidencias.append((frecuencia, posiciones, coincide))
+        if not coincidencias:
+            return []
+
+        # A key that starts with the whole query matches every word, so these come straight from
+        # the sorted keys
+        inicio, fin = self._rango(self.claves_ordenadas, clave_consulta)
+        prefijos = self.orden_claves[inicio:fin]
+        resultado = heapq.nsmallest(limite, prefijos) if limite else sorted(prefijos)
+        if limite and len(resultado) >= limite:
+            return resultado
+
+        coincidencias.sort(key=lambda coincidencia: coincidencia[0])
+        _, posiciones, _ = coincidencias[0]
+        pruebas = [coincide for _, _, coincide in coincidencias[1:]]
+        anterior = None
+        for identificador in heapq.merge(*(self.publicaciones[posicion] for posicion in posiciones)):
+            # An address appears once per query-word prefix it contains
+            if identificador == anterior:
+                continue
+            anterior = identificador
+            clave = self.claves[identificador]
+            if clave.startswith(clave_consulta):
+                continue
+            palabras_direccion = clave.split()
+            if all(any(coincide(candidata) for candidata in palabras_direccion) for coincide in pruebas):
+                resultado.append(identificador)
+                if limite and len(resultado) >= limite:
+                    break
+        return resultado
+
+    def geocode(self, consulta, exactly_one=True, limit=None, **kwargs):
+        identificadores = self.buscar(consulta, 1 if exactly_one else limit)
+        ubicaciones = [
+            Location(self.nombres[i], (self.latitudes[i], self.longitudes[i]), {'display_name': self.nombres[i]})
+            for i in identificadores
+        ]
+        if not ubicaciones:
+            return None
+        return ubicaciones[0] if exactly_one else ubicaciones
+
+
+class GeocodificadorConRespaldo:
+    # Asks the primary geocoder first and only falls back when it has no answer or fails
+    def __init__(self, primario, respaldo):
+        self.primario = primario
+        self.respaldo = respaldo
+
+    def geocode(self, consulta, exactly_one=True, limit=None):
+        try:
+            resultado = self.primario.geocode(consulta, exactly_one=exactly_one, limit=limit)
+            if resultado:
+                return resultado
+        except ERRORES_TRANSITORIOS:
+            logger.warning("Geocodificador primario no disponible, usando respaldo")
+        if self.respaldo is None:
+            return None
+        return self.respaldo.geocode(consulta, exactly_one=exactly_one, limit=limit)
+
+
+def crear_geocodificador(configuracion=None, user_agent="aplicacion_propiedades"):
+    # configuracion["modo"]: "nominatim" (default), "local" (gazetteer with Nominatim as
+    # fallback) or "solo_local"; configuracion["nomenclator"] is the gazetteer CSV path
+    from geopy.geocoders import Nominatim
+
+    configuracion = configuracion or {}
+    modo = configuracion.get("modo", "nominatim")
+    en_linea = GeocodificadorCacheado(
+        ClienteGeocodificacion(Nominatim(user_agent=user_agent)),
+        CacheGeocodificacion(configuracion.get("cache", RUTA_CACHE))
+    )
+    if modo == "nominatim":
+        return en_linea
+    local = GeocodificadorLocal.desde_archivo(configuracion["nomenclator"])
+    if modo == "solo_local":
+        return local
+    if modo == "local":
+        return GeocodificadorConRespaldo(local, en_linea)
+    raise ValueError(f"Modo de geocodificación desconocido: {modo}")
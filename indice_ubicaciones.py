@@ -0,0 +1,112 @@
+import argparse
+import logging
+import time
+
+import numpy as np
+
+from estimador import DIRECTORIO_MODELOS, cargar_artefactos
+
+logger = logging.getLogger(__name__)
+
+# Above this many centers a KD-tree prunes enough to beat the dense distance matrix
+CENTROS_PARA_ARBOL = 64
+FILAS_POR_BLOQUE = 1 << 16
+# Bounding box of Mexico as (sur, oeste, norte, este)
+LIMITES_MEXICO = (14.5, -118.4, 32.7, -86.7)
+
+
+class IndiceUbicaciones:
+    # Maps (Latitud, Longitud) to the GrupoUbicacion label of the fitted KMeans without going
+    # through sklearn. Distances use KMeans' own expansion ||c||^2 - 2 x.c, so the argmin and
+    # its tie-breaking match predict(); verificar() reports any coordinate that disagrees
+    def __init__(self, centros):
+        self.centros = np.ascontiguousarray(centros, dtype=np.float64)
+        self.normas = np.einsum('ij,ij->i', self.centros, self.centros)
+        self._arbol = None
+        if len(self.centros) > CENTROS_PARA_ARBOL:
+            from scipy.spatial import cKDTree
+
+            self._arbol = cKDTree(self.centros)
+        self._centros_lista = self.centros.tolist()
+        self._normas_lista = self.normas.tolist()
+
+    @classmethod
+    def desde_modelo(cls, agrupamiento):
+        return cls(agrupamiento.cluster_centers_)
+
+    def etiquetar(self, latitudes, longitudes):
+        # Vectorized labels for any number of coordinates; non-finite coordinates get -1
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        etiquetas = np.full(len(latitudes), -1, dtype=np.int32)
+        validas = np.flatnonzero(np.isfinite(latitudes) & np.isfinite(longitudes))
+        for inicio in range(0, len(validas), FILAS_POR_BLOQUE):
+            filas = validas[inicio:inicio + FILAS_POR_BLOQUE]
+            puntos = np.column_stack((latitudes[filas], longitudes[filas]))
+            if self._arbol is not None:
+                _, etiquetas[filas] = self._arbol.query(puntos)
+            else:
+                distancias = self.normas - 2.0 * (puntos @ self.centros.T)
+                etiquetas[filas] = np.argmin(distancias, axis=1)
+        return etiquetas
+
+    def etiqueta(self, latitud, longitud):
+        # Single coordinate in plain Python; None when it cannot be labelled
+        if latitud is None or longitud is None:
+            return None
+        latitud, longitud = float(latitud), float(longitud)
+        if not (np.isfinite(latitud) and np.isfinite(longitud)):
+            return None
+        if self._arbol is not None:
+            return int(self._arbol.query((latitud, longitud))[1])
+        mejor, mejor_distancia = 0, None
+        for indice, ((centro_latitud, centro_longitud), norma) in enumerate(zip(self._centros_lista, self._normas_lista)):
+            distancia = norma - 2.0 * (latitud * centro_latitud + longitud * centro_longitud)
+            if mejor_distancia is None or distancia < mejor_distancia:
+                mejor, mejor_distancia = indice, distancia
+        return mejor
+
+    def verificar(self, agrupamiento, latitudes, longitudes):
+        import pandas as pd
+
+        inicio = time.perf_counter()
+        esperado = agrupamiento.predict(pd.DataFrame({'Latitud': latitudes, 'Longitud': longitudes}))
+        tiempo_sklearn = time.perf_counter() - inicio
+        inicio = time.perf_counter()
+        obtenido = self.etiquetar(latitudes, longitudes)
+        tiempo_indice = time.perf_counter() - inicio
+        filas = [self.etiqueta(latitud, longitud) for latitud, longitud in zip(latitudes[:1000], longitudes[:1000])]
+        return {
+            'coordenadas': len(latitudes),
+            'diferencias': int(np.count_nonzero(esperado != obtenido)),
+            'diferencias_fila': int(np.count_nonzero(esperado[:1000] != np.array(filas))),
+            'segundos_sklearn': tiempo_sklearn,
+            'segundos_indice': tiempo_indice,
+        }
+
+
+def coordenadas_mexico(n_coordenadas, semilla=0):
+    # Uniform sample over the bounding box of Mexico
+    sur, oeste, norte, este = LIMITES_MEXICO
+    generador = np.random.default_rng(semilla)
+    return generador.uniform(sur, norte, n_coordenadas), generador.uniform(oeste, este, n_coordenadas)
+
+
+def main(argumentos=None):
+    parser = argparse.ArgumentParser(description="Verifica el índice de GrupoUbicacion contra KMeans.predict.")
+    parser.add_argument('--tipo', choices=["Casa", "Departamento"], default="Departamento")
+    parser.add_argument('--directorio', default=DIRECTORIO_MODELOS)
+    parser.add_argument('--coordenadas', type=int, default=1000000)
+    argumentos = parser.parse_args(argumentos)
+
+    agrupamiento = cargar_artefactos(argumentos.tipo, argumentos.directorio)['agrupamiento']
+    indice = IndiceUbicaciones.desde_modelo(agrupamiento)
+    resultado = indice.verificar(agrupamiento, *coordenadas_mexico(argumentos.coordenadas))
+    logger.info(f"Verificación: {resultado}")
+    if resultado['diferencias'] or resultado['diferencias_fila']:
+        raise SystemExit("El índice de ubicaciones no coincide con KMeans.predict")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,198 @@
+import bisect
+import json
+import logging
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# In-process metrics for the estimation path, rendered on demand in the Prometheus text format.
+# Only the standard library is used so that every module can import it at no cost
+
+LIMITES_SEGUNDOS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1.0, 2.5, 5.0, 10.0)
+TIPO_CONTENIDO = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Fraction of debug events whose payload is built and logged; 0 disables them entirely
+_tasa_muestreo = float(os.environ.get('ESTIMADOR_MUESTREO_DEPURACION', 0.0))
+
+
+def _escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _etiquetas(nombres, valores, extra=""):
+    pares = [f'{nombre}="{_escapar(valor)}"' for nombre, valor in zip(nombres, valores)]
+    if extra:
+        pares.append(extra)
+    return "{" + ",".join(pares) + "}" if pares else ""
+
+
+def _numero(valor):
+    if valor == float('inf'):
+        return "+Inf"
+    return repr(float(valor)) if isinstance(valor, float) else str(valor)
+
+
+class Contador:
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._valores = {}
+        self._candado = threading.Lock()
+
+    def incrementar(self, *valores_etiquetas, cantidad=1):
+        with self._candado:
+            self._valores[valores_etiquetas] = self._valores.get(valores_etiquetas, 0) + cantidad
+
+    def valor(self, *valores_etiquetas):
+        with self._candado:
+            return self._valores.get(valores_etiquetas, 0)
+
+    def exponer(self):
+        with self._candado:
+            valores = sorted(self._valores.items())
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} counter"]
+        lineas += [f"{self.nombre}{_etiquetas(self.etiquetas, clave)} {_numero(valor)}" for clave, valor in valores]
+        return lineas
+
+
+class Histograma:
+    # Per-bucket counts are stored non-cumulative and accumulated only when exposed
+    def __init__(self, nombre, ayuda, etiquetas=(), limites=LIMITES_SEGUNDOS):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self.limites = tuple(sorted(limites))
+        self._series = {}
+        self._candado = threading.Lock()
+
+    def observar(self, valor, *valores_etiquetas):
+        posicion = bisect.bisect_left(self.limites, valor)
+        with self._candado:
+            serie = self._series.get(valores_etiquetas)
+            if serie is None:
+                serie = self._series[valores_etiquetas] = [[0] * (len(self.limites) + 1), 0.0, 0]
+            serie[0][posicion] += 1
+            serie[1] += valor
+            serie[2] += 1
+
+    def exponer(self):
+        with self._candado:
+            series = sorted((clave, (list(cubetas), suma, cuenta)) for clave, (cubetas, suma, cuenta) in self._series.items())
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} histogram"]
+        for clave, (cubetas, suma, cuenta) in series:
+            acumulado = 0
+            for limite, cubeta in zip(self.limites + (float('inf'),), cubetas):
+                acumulado += cubeta
+                le = f'le="{_numero(limite)}"'
+                lineas.append(f"{self.nombre}_bucket{_etiquetas(self.etiquetas, clave, le)} {acumulado}")
+            lineas.append(f"{self.nombre}_sum{_etiquetas(self.etiquetas, clave)} {_numero(suma)}")
+            lineas.append(f"{self.nombre}_count{_etiquetas(self.etiquetas, clave)} {cuenta}")
+        return lineas
+
+
+class Metricas:
+    def __init__(self):
+        self._metricas = {}
+        self._candado = threading.Lock()
+
+    def _registrar(self, metrica):
+        with self._candado:
+            existente = self._metricas.get(metrica.nombre)
+            if existente is not None:
+                if type(existente) is not type(metrica) or existente.etiquetas != metrica.etiquetas:
+                    raise ValueError(f"La métrica {metrica.nombre} ya existe con otra definición")
+                return existente
+            self._metricas[metrica.nombre] = metrica
+            return metrica
+
+    def contador(self, nombre, ayuda, etiquetas=()):
+        return self._registrar(Contador(nombre, ayuda, etiquetas))
+
+    def histograma(self, nombre, ayuda, etiquetas=(), limites=LIMITES_SEGUNDOS):
+        return self._registrar(Histograma(nombre, ayuda, etiquetas, limites))
+
+    def exponer(self):
+        with self._candado:
+            metricas = [self._metricas[nombre] for nombre in sorted(self._metricas)]
+        lineas = []
+        for metrica in metricas:
+            lineas += metrica.exponer()
+        return "\n".join(lineas) + "\n"
+
+
+METRICAS = Metricas()
+DURACION_ETAPAS = METRICAS.histograma('estimador_etapa_segundos', "Duración de cada etapa de la estimación",
+                                      ('etapa',))
+ERRORES_ETAPAS = METRICAS.contador('estimador_etapa_errores_total', "Etapas que terminaron con una excepción",
+                                   ('etapa',))
+
+
+class _Tramo:
+    __slots__ = ('etapa', 'inicio')
+
+    def __init__(self, etapa):
+        self.etapa = etapa
+
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, tipo, valor, traza):
+        DURACION_ETAPAS.observar(time.perf_counter() - self.inicio, self.etapa)
+        if tipo is not None:
+            ERRORES_ETAPAS.incrementar(self.etapa)
+        return False
+
+
+def tramo(etapa):
+    # with tramo("predecir"): ... records the duration of the block and counts it as failed when
+    # it raises; the exception is never swallowed
+    return _Tramo(etapa)
+
+
+def depurar(registrador, evento, construir):
+    # construir() builds the payload and is only called for the sampled fraction of events
+    # when DEBUG is enabled on registrador, so a disabled call costs one comparison
+    if not _tasa_muestreo or random.random() >= _tasa_muestreo or not registrador.isEnabledFor(logging.DEBUG):
+        return
+    registrador.debug("%s %s", evento, json.dumps(construir(), ensure_ascii=False, default=str))
+
+
+class _ManejadorMetricas(BaseHTTPRequestHandler):
+    def do_GET(self):
+        cuerpo = METRICAS.exponer().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', TIPO_CONTENIDO)
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, formato, *argumentos):
+        pass
+
+
+def iniciar_servidor_metricas(puerto, host='0.0.0.0'):
+    # Serves METRICAS on every path from a daemon thread, for processes without an HTTP server
+    servidor = ThreadingHTTPServer((host, puerto), _ManejadorMetricas)
+    threading.Thread(target=servidor.serve_forever, name="servidor-metricas", daemon=True).start()
+    logger.info(f"Métricas disponibles en http://{host}:{puerto}/metrics")
+    return servidor
+
+
+def configurar(configuracion=None):
+    # configuracion: "nivel_log" (default INFO), "muestreo_depuracion" (fraction of debug
+    # payloads to log, default 0) and "puerto_metricas" (optional port for the metrics server)
+    global _tasa_muestreo
+
+    configuracion = configuracion or {}
+    logging.basicConfig(level=str(configuracion.get('nivel_log', 'INFO')).upper())
+    _tasa_muestreo = float(configuracion.get('muestreo_depuracion', _tasa_muestreo))
+    if configuracion.get('puerto_metricas'):
+        return iniciar_servidor_metricas(int(configuracion['puerto_metricas']))
+    return None
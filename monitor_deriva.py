@@ -0,0 +1,482 @@
+import argparse
+import atexit
+import glob
+import json
+import logging
+import math
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from estimador import COLUMNAS_CARACTERISTICAS
+from registro_modelos import RUTA_MANIFIESTO, RegistroModelos
+
+logger = logging.getLogger(__name__)
+
+# Streaming drift monitor for the wizard. Every estimate updates, per property type and location
+# cluster, a fixed-size summary of each input feature and of the estimated price: count, running
+# moments and a quantile sketch. Summaries are mergeable, so each replica checkpoints its own file
+# and the files are combined later without going back to the leads. Observations first go to the
+# current window, which is folded into the history every DURACION_VENTANA seconds; drift is the
+# window compared with the history and, for the features, with the training moments kept by the
+# scaler
+
+DIRECTORIO_DERIVA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'deriva')
+VARIABLES = COLUMNAS_CARACTERISTICAS[:-1] + ['Precio']
+
+PRECISION_CUANTILES = 0.01
+MAX_CUBETAS = 2048
+INTERVALO_PUNTO_CONTROL = 60.0
+DURACION_VENTANA = 24 * 3600.0
+
+# Thresholds of evaluar(): mean shift in reference standard deviations, ratio of variances,
+# relative change of the 95th percentile and change in the share of a cluster
+MINIMO_OBSERVACIONES = 200
+UMBRAL_MEDIA = 0.5
+UMBRAL_VARIANZA = 2.0
+UMBRAL_COLA = 0.25
+UMBRAL_PARTICIPACION = 0.10
+
+
+class Momentos:
+    # Count, mean and sum of squared deviations updated with Welford's method; two sets of
+    # moments combine exactly with Chan's parallel formula
+    __slots__ = ('cuenta', 'media', 'm2', 'minimo', 'maximo')
+
+    def __init__(self, cuenta=0, media=0.0, m2=0.0, minimo=math.inf, maximo=-math.inf):
+        self.cuenta = cuenta
+        self.media = media
+        self.m2 = m2
+        self.minimo = minimo
+        self.maximo = maximo
+
+    def observar(self, valor):
+        self.cuenta += 1
+        delta = valor - self.media
+        self.media += delta / self.cuenta
+        self.m2 += delta * (valor - self.media)
+        self.minimo = min(self.minimo, valor)
+        self.maximo = max(self.maximo, valor)
+
+    def combinar(self, otro):
+        if not otro.cuenta:
+            return self
+        cuenta = self.cuenta + otro.cuenta
+        delta = otro.media - self.media
+        self.media += delta * otro.cuenta / cuenta
+        self.m2 += otro.m2 + delta * delta * self.cuenta * otro.cuenta / cuenta
+        self.cuenta = cuenta
+        self.minimo = min(self.minimo, otro.minimo)
+        self.maximo = max(self.maximo, otro.maximo)
+        return self
+
+    @property
+    def varianza(self):
+        # Population variance, the same definition as StandardScaler.var_
+        return self.m2 / self.cuenta if self.cuenta else None
+
+    def a_dict(self):
+        return {'cuenta': self.cuenta, 'media': self.media, 'm2': self.m2,
+                'minimo': self.minimo if self.cuenta else None, 'maximo': self.maximo if self.cuenta else None}
+
+    @classmethod
+    def desde_dict(cls, datos):
+        if not datos['cuenta']:
+            return cls()
+        return cls(datos['cuenta'], datos['media'], datos['m2'], datos['minimo'], datos['maximo'])
+
+
+class BosquejoCuantiles:
+    # Log-bucketed quantile sketch in the style of DDSketch: a positive value falls in bucket
+    # ceil(log_gamma(valor)), so every quantile is returned within a relative error of precision
+    # and two sketches merge by adding their counts. Beyond max_cubetas buckets the lowest ones are
+    # collapsed, which only loses accuracy at the low end. Values at or below zero share one
+    # bucket; every monitored variable is non-negative
+    def __init__(self, precision=PRECISION_CUANTILES, max_cubetas=MAX_CUBETAS):
+        self.precision = precision
+        self.max_cubetas = max_cubetas
+        self.gamma = (1 + precision) / (1 - precision)
+        self._log_gamma = math.log(self.gamma)
+        self.cubetas = {}
+        self.ceros = 0
+        self.cuenta = 0
+
+    def observar(self, valor):
+        self.cuenta += 1
+        if valor <= 0:
+            self.ceros += 1
+            return
+        indice = math.ceil(math.log(valor) / self._log_gamma)
+        self.cubetas[indice] = self.cubetas.get(indice, 0) + 1
+        if len(self.cubetas) > self.max_cubetas:
+            self._colapsar()
+
+    def _colapsar(self):
+        indices = sorted(self.cubetas)
+        sobrantes = indices[:len(indices) - self.max_cubetas + 1]
+        self.cubetas[sobrantes[-1]] += sum(self.cubetas.pop(indice) for indice in sobrantes[:-1])
+
+    def combinar(self, otro):
+        if otro.precision != self.precision:
+            raise ValueError(f"Bosquejos con precisiones distintas: {self.precision} y {otro.precision}")
+        for indice, cuenta in otro.cubetas.items():
+            self.cubetas[indice] = self.cubetas.get(indice, 0) + cuenta
+        self.ceros += otro.ceros
+        self.cuenta += otro.cuenta
+        if len(self.cubetas) > self.max_cubetas:
+            self._colapsar()
+        return self
+
+    def cuantil(self, fraccion):
+        if not self.cuenta:
+            return None
+        rango = fraccion * (self.cuenta - 1)
+        acumulado = self.ceros
+        if rango < acumulado:
+            return 0.0
+        for indice in sorted(self.cubetas):
+            acumulado += self.cubetas[indice]
+            if acumulado > rango:
+                break
+        # Midpoint of the bucket in relative terms, so the error is at most precision either way
+        return 2 * self.gamma ** indice / (self.gamma + 1)
+
+    def a_dict(self):
+        return {'precision': self.precision, 'max_cubetas': self.max_cubetas, 'ceros': self.ceros,
+                'cubetas': {str(indice): cuenta for indice, cuenta in sorted(self.cubetas.items())}}
+
+    @classmethod
+    def desde_dict(cls, datos):
+        bosquejo = cls(datos['precision'], datos['max_cubetas'])
+        bosquejo.cubetas = {int(indice): cuenta for indice, cuenta in datos['cubetas'].items()}
+        bosquejo.ceros = datos['ceros']
+        bosquejo.cuenta = bosquejo.ceros + sum(bosquejo.cubetas.values())
+        return bosquejo
+
+
+class Resumen:
+    # Moments and quantile sketch of one variable
+    __slots__ = ('momentos', 'bosquejo')
+
+    def __init__(self, momentos=None, bosquejo=None):
+        self.momentos = momentos or Momentos()
+        self.bosquejo = bosquejo or BosquejoCuantiles()
+
+    def observar(self, valor):
+        self.momentos.observar(valor)
+        self.bosquejo.observar(valor)
+
+    def combinar(self, otro):
+        self.momentos.combinar(otro.momentos)
+        self.bosquejo.combinar(otro.bosquejo)
+        return self
+
+    @property
+    def cuenta(self):
+        return self.momentos.cuenta
+
+    def a_dict(self):
+        return {'momentos': self.momentos.a_dict(), 'bosquejo': self.bosquejo.a_dict()}
+
+    @classmethod
+    def desde_dict(cls, datos):
+        return cls(Momentos.desde_dict(datos['momentos']), BosquejoCuantiles.desde_dict(datos['bosquejo']))
+
+
+def _combinar_grupos(destino, origen):
+    # {(tipo, grupo): {variable: Resumen}} merged into destino in place
+    for clave, resumenes in origen.items():
+        existentes = destino.setdefault(clave, {})
+        for variable, resumen in resumenes.items():
+            existentes.setdefault(variable, Resumen()).combinar(resumen)
+    return destino
+
+
+def _grupos_a_lista(grupos):
+    return [{'tipo': tipo, 'grupo': grupo,
+             'variables': {variable: resumen.a_dict() for variable, resumen in resumenes.items()}}
+            for (tipo, grupo), resumenes in sorted(grupos.items(), key=lambda par: (par[0][0], str(par[0][1])))]
+
+
+def _grupos_desde_lista(lista):
+    return {(entrada['tipo'], entrada['grupo']):
+            {variable: Resumen.desde_dict(datos) for variable, datos in entrada['variables'].items()}
+            for entrada in lista}
+
+
+def _por_tipo(grupos):
+    # Cluster summaries of each type merged into one, plus the observations of each cluster
+    tipos, cuentas = {}, {}
+    for (tipo, grupo), resumenes in grupos.items():
+        _combinar_grupos(tipos, {(tipo, None): resumenes})
+        cuentas.setdefault(tipo, {})[grupo] = max((resumen.cuenta for resumen in resumenes.values()), default=0)
+    return {tipo: resumenes for (tipo, _), resumenes in tipos.items()}, cuentas
+
+
+def ruta_replica(directorio=DIRECTORIO_DERIVA):
+    return os.path.join(directorio, f"{socket.gethostname()}-{os.getpid()}.json")
+
+
+class MonitorDeriva:
+    # Thread-safe; observar() also writes the checkpoint every intervalo seconds, folding the
+    # window into the history first when it is older than duracion_ventana
+    def __init__(self, ruta=None, intervalo=INTERVALO_PUNTO_CONTROL, duracion_ventana=DURACION_VENTANA,
+                 reloj=time.time):
+        self.ruta = ruta
+        self.intervalo = intervalo
+        self.duracion_ventana = duracion_ventana
+        self._reloj = reloj
+        self._historico = {}
+        self._ventana = {}
+        self.inicio_ventana = reloj()
+        self._ultimo_punto_control = reloj()
+        self._candado = threading.Lock()
+        # Serializes checkpoints; reentrant because a periodic checkpoint goes through guardar()
+        self._candado_guardado = threading.RLock()
+        if ruta:
+            if os.path.exists(ruta):
+                try:
+                    self.combinar(self.cargar(ruta))
+                except (OSError, ValueError, KeyError) as e:
+                    logger.warning(f"Punto de control de deriva ilegible en {ruta}, se empieza de cero: {str(e)}")
+            atexit.register(self.guardar)
+
+    def observar(self, tipo_propiedad, grupo, caracteristicas, precio):
+        # caracteristicas: {Terreno, Construccion, Habitaciones, Banos} as given to preprocesar_datos;
+        # missing or non-finite values are skipped
+        valores = dict(caracteristicas, Precio=precio)
+        clave = (tipo_propiedad, None if grupo is None else int(grupo))
+        with self._candado:
+            resumenes = self._ventana.setdefault(clave, {})
+            for variable in VARIABLES:
+                valor = valores.get(variable)
+                if valor is None:
+                    continue
+                valor = float(valor)
+                if math.isfinite(valor):
+                    resumenes.setdefault(variable, Resumen()).observar(valor)
+        if self.ruta and self._reloj() - self._ultimo_punto_control >= self.intervalo:
+            self._punto_control()
+
+    def _punto_control(self):
+        # Sessions that cross the interval together write one checkpoint between them
+        with self._candado_guardado:
+            if self._reloj() - self._ultimo_punto_control >= self.intervalo:
+                self.guardar()
+
+    def rotar(self):
+        with self._candado:
+            _combinar_grupos(self._historico, self._ventana)
+            self._ventana = {}
+            self.inicio_ventana = self._reloj()
+
+    def combinar(self, otro):
+        # A window that started more than duracion_ventana ago, such as the last one checkpointed
+        # by a process that has since stopped, is merged into the history
+        vencida = self._reloj() - otro.inicio_ventana >= self.duracion_ventana
+        with self._candado:
+            _combinar_grupos(self._historico, otro._historico)
+            if vencida:
+                _combinar_grupos(self._historico, otro._ventana)
+            else:
+                _combinar_grupos(self._ventana, otro._ventana)
+                self.inicio_ventana = min(self.inicio_ventana, otro.inicio_ventana)
+        return self
+
+    def a_dict(self):
+        with self._candado:
+            return {'inicio_ventana': self.inicio_ventana, 'historico': _grupos_a_lista(self._historico),
+                    'ventana': _grupos_a_lista(self._ventana)}
+
+    @classmethod
+    def desde_dict(cls, datos):
+        monitor = cls()
+        monitor._historico = _grupos_desde_lista(datos['historico'])
+        monitor._ventana = _grupos_desde_lista(datos['ventana'])
+        monitor.inicio_ventana = datos['inicio_ventana']
+        return monitor
+
+    def guardar(self, ruta=None):
+        ruta = ruta or self.ruta
+        with self._candado_guardado:
+            if self.ruta and self._reloj() - self.inicio_ventana >= self.duracion_ventana:
+                self.rotar()
+            datos = self.a_dict()
+            directorio = os.path.dirname(os.path.abspath(ruta))
+            os.makedirs(directorio, exist_ok=True)
+            # A temporary file of its own in the same directory, so the replace is atomic
+            descriptor, temporal = tempfile.mkstemp(prefix=f".{os.path.basename(ruta)}.", suffix='.tmp',
+                                                    dir=directorio)
+            try:
+                with os.fdopen(descriptor, 'w', encoding='utf-8') as archivo:
+                    json.dump(datos, archivo)
+                os.replace(temporal, ruta)
+            except BaseException:
+                if os.path.exists(temporal):
+                    os.remove(temporal)
+                raise
+            self._ultimo_punto_control = self._reloj()
+
+    @classmethod
+    def cargar(cls, ruta):
+        with open(ruta, encoding='utf-8') as archivo:
+            return cls.desde_dict(json.load(archivo))
+
+    def evaluar(self, referencias=None, minimo=MINIMO_OBSERVACIONES):
+        # List of alerts {tipo, grupo, variable, prueba, valor}. Per type the window is compared
+        # with the training moments in referencias ({tipo: {variable: (media, varianza)}}) and with
+        # the history; per cluster, with the history of that cluster
+        referencias = referencias or {}
+        with self._candado:
+            ventana = _combinar_grupos({}, self._ventana)
+            historico = _combinar_grupos({}, self._historico)
+        ventana_tipos, cuentas_ventana = _por_tipo(ventana)
+        historico_tipos, cuentas_historico = _por_tipo(historico)
+
+        alertas = []
+
+        def alertar(tipo, grupo, variable, prueba, valor):
+            alertas.append({'tipo': tipo, 'grupo': grupo, 'variable': variable, 'prueba': prueba, 'valor': valor})
+
+        for tipo, resumenes in ventana_tipos.items():
+            for variable, (media, varianza) in referencias.get(tipo, {}).items():
+                resumen = resumenes.get(variable)
+                if resumen is None or resumen.cuenta < minimo or not varianza:
+                    continue
+                desplazamiento = abs(resumen.momentos.media - media) / math.sqrt(varianza)
+                if desplazamiento > UMBRAL_MEDIA:
+                    alertar(tipo, None, variable, 'media_entrenamiento', desplazamiento)
+                proporcion = resumen.momentos.varianza / varianza
+                if not 1 / UMBRAL_VARIANZA <= proporcion <= UMBRAL_VARIANZA:
+                    alertar(tipo, None, variable, 'varianza_entrenamiento', proporcion)
+            for variable, prueba, valor in _cambios_historicos(resumenes, historico_tipos.get(tipo, {}), minimo):
+                alertar(tipo, None, variable, prueba, valor)
+
+            # GrupoUbicacion is categorical: its drift is a change in the share of each cluster
+            total_ventana = sum(cuentas_ventana[tipo].values())
+            total_historico = sum(cuentas_historico.get(tipo, {}).values())
+            if total_ventana >= minimo and total_historico >= minimo:
+                for grupo in set(cuentas_ventana[tipo]) | set(cuentas_historico[tipo]):
+                    cambio = (cuentas_ventana[tipo].get(grupo, 0) / total_ventana
+                              - cuentas_historico[tipo].get(grupo, 0) / total_historico)
+                    if abs(cambio) > UMBRAL_PARTICIPACION:
+                        alertar(tipo, grupo, 'GrupoUbicacion', 'participacion_historica', cambio)
+
+        for (tipo, grupo), resumenes in ventana.items():
+            for variable, prueba, valor in _cambios_historicos(resumenes, historico.get((tipo, grupo), {}), minimo):
+                alertar(tipo, grupo, variable, prueba, valor)
+        return alertas
+
+    def resumen(self):
+        # {tipo: {variable: {cuenta, media, p05, p50, p95}}} over history and window together
+        with self._candado:
+            grupos = _combinar_grupos(_combinar_grupos({}, self._historico), self._ventana)
+        tipos, _ = _por_tipo(grupos)
+        return {
+            tipo: {variable: {'cuenta': resumen.cuenta, 'media': resumen.momentos.media,
+                              'p05': resumen.bosquejo.cuantil(0.05), 'p50': resumen.bosquejo.cuantil(0.50),
+                              'p95': resumen.bosquejo.cuantil(0.95)}
+                   for variable, resumen in resumenes.items()}
+            for tipo, resumenes in tipos.items()
+        }
+
+
+def _cambios_historicos(ventana, historico, minimo):
+    # (variable, prueba, valor) for the window means that moved more than UMBRAL_MEDIA historical
+    # standard deviations and the 95th percentiles that changed more than UMBRAL_COLA
+    for variable, resumen in ventana.items():
+        referencia = historico.get(variable)
+        if resumen.cuenta < minimo or referencia is None or referencia.cuenta < minimo:
+            continue
+        varianza = referencia.momentos.varianza
+        if varianza:
+            desplazamiento = (resumen.momentos.media - referencia.momentos.media) / math.sqrt(varianza)
+            if abs(desplazamiento) > UMBRAL_MEDIA:
+                yield variable, 'media_historica', desplazamiento
+        cola = referencia.bosquejo.cuantil(0.95)
+        if cola > 0:
+            cambio = resumen.bosquejo.cuantil(0.95) / cola - 1
+            if abs(cambio) > UMBRAL_COLA:
+                yield variable, 'p95_historico', cambio
+
+
+def referencias_entrenamiento(registro):
+    # {tipo: {variable: (media, varianza)}} from the StandardScaler of each loaded set, which saw
+    # the training features in COLUMNAS_CARACTERISTICAS order; bundles carry the same moments
+    referencias = {}
+    for tipo_propiedad in registro.disponibles():
+        modelos = registro.obtener(tipo_propiedad).modelos
+        if 'momentos_entrenamiento' in modelos:
+            medias, varianzas = modelos['momentos_entrenamiento']
+        else:
+            medias = modelos['escalador'].mean_
+            varianzas = getattr(modelos['escalador'], 'var_', None)
+        if varianzas is None:
+            continue
+        referencias[tipo_propiedad] = {
+            variable: (float(medias[posicion]), float(varianzas[posicion]))
+            for posicion, variable in enumerate(COLUMNAS_CARACTERISTICAS[:-1])
+        }
+    return referencias
+
+
+def combinar_puntos_control(rutas):
+    monitor = MonitorDeriva()
+    for ruta in rutas:
+        monitor.combinar(MonitorDeriva.cargar(ruta))
+    return monitor
+
+
+def _expandir(rutas):
+    # Directories stand for every checkpoint they contain
+    archivos = []
+    for ruta in rutas:
+        archivos += sorted(glob.glob(os.path.join(ruta, '*.json'))) if os.path.isdir(ruta) else [ruta]
+    return archivos
+
+
+def main(argumentos=None):
+    parser = argparse.ArgumentParser(description="Combina y evalúa los puntos de control del monitor de deriva.")
+    subcomandos = parser.add_subparsers(dest='comando', required=True)
+    combinacion = subcomandos.add_parser('combinar', help="Combina los puntos de control de varias réplicas")
+    combinacion.add_argument('salida')
+    combinacion.add_argument('entradas', nargs='+', help="Archivos o directorios de puntos de control")
+    evaluacion = subcomandos.add_parser('evaluar', help="Señala la deriva de la ventana actual")
+    evaluacion.add_argument('entradas', nargs='*', default=[DIRECTORIO_DERIVA],
+                            help="Archivos o directorios de puntos de control")
+    evaluacion.add_argument('--manifiesto', default=RUTA_MANIFIESTO)
+    evaluacion.add_argument('--minimo', type=int, default=MINIMO_OBSERVACIONES,
+                            help="Observaciones necesarias para comparar una distribución")
+    argumentos = parser.parse_args(argumentos)
+
+    rutas = _expandir(argumentos.entradas)
+    if not rutas:
+        parser.error("No se encontraron puntos de control")
+    monitor = combinar_puntos_control(rutas)
+
+    if argumentos.comando == 'combinar':
+        monitor.guardar(argumentos.salida)
+        logger.info(f"{len(rutas)} puntos de control combinados en {argumentos.salida}")
+        return
+
+    for tipo_propiedad, variables in monitor.resumen().items():
+        for variable, estadisticas in variables.items():
+            logger.info(f"{tipo_propiedad} {variable}: {estadisticas['cuenta']} observaciones, "
+                        f"media {estadisticas['media']:.4g}, p05 {estadisticas['p05']:.4g}, "
+                        f"p50 {estadisticas['p50']:.4g}, p95 {estadisticas['p95']:.4g}")
+    alertas = monitor.evaluar(referencias_entrenamiento(RegistroModelos(argumentos.manifiesto).cargar()),
+                              argumentos.minimo)
+    for alerta in alertas:
+        grupo = "" if alerta['grupo'] is None else f" grupo {alerta['grupo']}"
+        logger.warning(f"Deriva en {alerta['tipo']}{grupo} {alerta['variable']}: "
+                       f"{alerta['prueba']} = {alerta['valor']:.3g}")
+    if alertas:
+        raise SystemExit(1)
+    logger.info("Sin deriva detectada")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,238 @@
+import argparse
+import json
+import logging
+import math
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from estimador import estimar_lote
+from indice_ubicaciones import LIMITES_MEXICO
+from registro_modelos import RUTA_MANIFIESTO, RegistroModelos
+
+logger = logging.getLogger(__name__)
+
+# Price per m2 map tiles. The forest only sees the location through GrupoUbicacion, so the
+# price of a standard profile is a function of the cluster: the offline job estimates every
+# (cluster, profile) pair once and the tiles store the cluster of each grid cell. The map is
+# rendered from those two arrays without calling the model
+
+DIRECTORIO_MOSAICOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'mosaicos')
+# Cell side in degrees (about 550 m) and cells per tile side
+RESOLUCION = 0.005
+CELDAS_POR_MOSAICO = 64
+RADIO_MAPA = 0.03
+CAPACIDAD_MOSAICOS = 256
+COLORES_MAPA = ['#2c7bb6', '#abd9e9', '#ffffbf', '#fdae61', '#d7191c']
+
+PERFILES = {
+    "Casa": [
+        {'nombre': "Casa chica", 'terreno': 120, 'construccion': 90, 'habitaciones': 2, 'banos': 1},
+        {'nombre': "Casa mediana", 'terreno': 200, 'construccion': 160, 'habitaciones': 3, 'banos': 2},
+        {'nombre': "Casa grande", 'terreno': 350, 'construccion': 300, 'habitaciones': 4, 'banos': 3},
+    ],
+    "Departamento": [
+        {'nombre': "Departamento chico", 'terreno': 55, 'construccion': 55, 'habitaciones': 1, 'banos': 1},
+        {'nombre': "Departamento mediano", 'terreno': 85, 'construccion': 85, 'habitaciones': 2, 'banos': 2},
+        {'nombre': "Departamento grande", 'terreno': 130, 'construccion': 130, 'habitaciones': 3, 'banos': 2},
+    ],
+}
+
+
+def directorio_version(directorio, tipo_propiedad, version):
+    return os.path.join(directorio, tipo_propiedad, version)
+
+
+def precios_m2_por_grupo(estimador, perfiles):
+    # (clusters, profiles) price per built m2, estimated in one batch from the cluster centers
+    indice = estimador.modelos['indice_ubicaciones']
+    centros = indice.centros
+    n_grupos = len(centros)
+    if not np.array_equal(indice.etiquetar(centros[:, 0], centros[:, 1]), np.arange(n_grupos)):
+        raise ValueError("Hay centros de grupo duplicados; no se puede asignar un precio por grupo")
+    entradas = {
+        'Latitud': np.tile(centros[:, 0], len(perfiles)),
+        'Longitud': np.tile(centros[:, 1], len(perfiles)),
+        'Terreno': np.repeat([float(perfil['terreno']) for perfil in perfiles], n_grupos),
+        'Construccion': np.repeat([float(perfil['construccion']) for perfil in perfiles], n_grupos),
+        'Habitaciones': np.repeat([float(perfil['habitaciones']) for perfil in perfiles], n_grupos),
+        'Banos': np.repeat([float(perfil['banos']) for perfil in perfiles], n_grupos),
+    }
+    precios, _, _ = estimar_lote(entradas, estimador.modelos)
+    return (precios / entradas['Construccion']).reshape(len(perfiles), n_grupos).T.astype(np.float32)
+
+
+def generar_mosaicos(estimador, directorio=DIRECTORIO_MOSAICOS, resolucion=RESOLUCION, limites=LIMITES_MEXICO,
+                     celdas=CELDAS_POR_MOSAICO):
+    indice = estimador.modelos['indice_ubicaciones']
+    if len(indice.centros) > np.iinfo(np.uint16).max:
+        raise ValueError("Demasiados grupos para mosaicos de 16 bits")
+    perfiles = PERFILES[estimador.tipo_propiedad]
+    sur, oeste, norte, este = limites
+    filas = math.ceil((norte - sur) / resolucion / celdas)
+    columnas = math.ceil((este - oeste) / resolucion / celdas)
+
+    destino = directorio_version(directorio, estimador.tipo_propiedad, estimador.version)
+    temporal = destino + '.tmp'
+    shutil.rmtree(temporal, ignore_errors=True)
+    os.makedirs(temporal)
+    np.save(os.path.join(temporal, 'precios_m2.npy'), precios_m2_por_grupo(estimador, perfiles))
+
+    # Cell centers of one tile relative to its corner; each tile is labelled as one vectorized batch
+    desplazamientos = (np.arange(celdas) + 0.5) * resolucion
+    for fila in range(filas):
+        latitudes = sur + fila * celdas * resolucion + desplazamientos
+        for columna in range(columnas):
+            longitudes = oeste + columna * celdas * resolucion + desplazamientos
+            malla_latitudes, malla_longitudes = np.meshgrid(latitudes, longitudes, indexing='ij')
+            grupos = indice.etiquetar(malla_latitudes.ravel(), malla_longitudes.ravel())
+            # Neighbouring cells mostly share a cluster, so the labels compress very well
+            np.savez_compressed(os.path.join(temporal, f"mosaico_{fila}_{columna}.npz"),
+                                grupos=grupos.astype(np.uint16).reshape(celdas, celdas))
+
+    with open(os.path.join(temporal, 'indice.json'), 'w', encoding='utf-8') as archivo:
+        json.dump({
+            'tipo_propiedad': estimador.tipo_propiedad, 'version': estimador.version,
+            'resolucion': resolucion, 'celdas': celdas, 'sur': sur, 'oeste': oeste,
+            'filas': filas, 'columnas': columnas, 'perfiles': [perfil['nombre'] for perfil in perfiles],
+        }, archivo, indent=2, ensure_ascii=False)
+    shutil.rmtree(destino, ignore_errors=True)
+    os.replace(temporal, destino)
+    return filas * columnas
+
+
+class MosaicosPrecio:
+    # Read side of the tiles of one model version. Tiles are loaded on first use and kept in an
+    # LRU shared by every session
+    def __init__(self, ruta, capacidad=CAPACIDAD_MOSAICOS):
+        self.ruta = ruta
+        with open(os.path.join(ruta, 'indice.json'), encoding='utf-8') as archivo:
+            self.indice = json.load(archivo)
+        self.precios_m2 = np.load(os.path.join(ruta, 'precios_m2.npy'))
+        self.perfiles = self.indice['perfiles']
+        self.resolucion = self.indice['resolucion']
+        self.celdas = self.indice['celdas']
+        self.capacidad = capacidad
+        self._mosaicos = OrderedDict()
+        self._candado = threading.Lock()
+
+    @classmethod
+    def abrir(cls, tipo_propiedad, version, directorio=DIRECTORIO_MOSAICOS):
+        # None when no tiles were generated for this model version
+        ruta = directorio_version(directorio, tipo_propiedad, version)
+        if not os.path.exists(os.path.join(ruta, 'indice.json')):
+            return None
+        return cls(ruta)
+
+    def _mosaico(self, fila, columna):
+        clave = (fila, columna)
+        with self._candado:
+            grupos = self._mosaicos.get(clave)
+            if grupos is not None:
+                self._mosaicos.move_to_end(clave)
+                return grupos
+        with np.load(os.path.join(self.ruta, f"mosaico_{fila}_{columna}.npz")) as archivo:
+            grupos = archivo['grupos']
+        with self._candado:
+            self._mosaicos[clave] = grupos
+            while len(self._mosaicos) > self.capacidad:
+                self._mosaicos.popitem(last=False)
+        return grupos
+
+    def ventana(self, latitud, longitud, radio=RADIO_MAPA, perfil=0):
+        # Price per m2 of the cells within radio degrees, rows from south to north, and the
+        # (sur, oeste, norte, este) bounds they cover; None outside the tiled area
+        total_filas = self.indice['filas'] * self.celdas
+        total_columnas = self.indice['columnas'] * self.celdas
+        fila_inicial = max(0, math.floor((latitud - radio - self.indice['sur']) / self.resolucion))
+        fila_final = min(total_filas, math.floor((latitud + radio - self.indice['sur']) / self.resolucion) + 1)
+        columna_inicial = max(0, math.floor((longitud - radio - self.indice['oeste']) / self.resolucion))
+        columna_final = min(total_columnas, math.floor((longitud + radio - self.indice['oeste']) / self.resolucion) + 1)
+        if fila_inicial >= fila_final or columna_inicial >= columna_final:
+            return None
+
+        grupos = np.empty((fila_final - fila_inicial, columna_final - columna_inicial), dtype=np.uint16)
+        for fila in range(fila_inicial // self.celdas, (fila_final - 1) // self.celdas + 1):
+            for columna in range(columna_inicial // self.celdas, (columna_final - 1) // self.celdas + 1):
+                mosaico = self._mosaico(fila, columna)
+                desde_fila = max(fila_inicial, fila * self.celdas)
+                hasta_fila = min(fila_final, (fila + 1) * self.celdas)
+                desde_columna = max(columna_inicial, columna * self.celdas)
+                hasta_columna = min(columna_final, (columna + 1) * self.celdas)
+                grupos[desde_fila - fila_inicial:hasta_fila - fila_inicial,
+                       desde_columna - columna_inicial:hasta_columna - columna_inicial] = mosaico[
+                    desde_fila - fila * self.celdas:hasta_fila - fila * self.celdas,
+                    desde_columna - columna * self.celdas:hasta_columna - columna * self.celdas]
+
+        limites = (self.indice['sur'] + fila_inicial * self.resolucion,
+                   self.indice['oeste'] + columna_inicial * self.resolucion,
+                   self.indice['sur'] + fila_final * self.resolucion,
+                   self.indice['oeste'] + columna_final * self.resolucion)
+        return self.precios_m2[grupos, perfil], limites
+
+
+def crear_mapa(mosaicos, latitud, longitud, perfil=0, radio=RADIO_MAPA):
+    # folium map centered on the property with the price per m2 grid as one image overlay;
+    # panning and zooming happen in the browser without touching the server
+    import branca.colormap
+    import folium
+
+    mapa = folium.Map(location=[latitud, longitud], zoom_start=14, tiles="OpenStreetMap")
+    folium.Marker([latitud, longitud]).add_to(mapa)
+    resultado = mosaicos.ventana(latitud, longitud, radio, perfil)
+    if resultado is None:
+        return mapa
+    precios_m2, (sur, oeste, norte, este) = resultado
+    validos = np.isfinite(precios_m2)
+    if not validos.any():
+        return mapa
+
+    minimo, maximo = np.percentile(precios_m2[validos], [5, 95])
+    maximo = max(maximo, minimo + 1)
+    escala = branca.colormap.LinearColormap(COLORES_MAPA, vmin=minimo, vmax=maximo,
+                                            caption=f"Precio por m² ({mosaicos.perfiles[perfil]})")
+    # 256-entry lookup table instead of evaluating the colormap cell by cell
+    tabla_colores = np.array([escala.rgba_bytes_tuple(minimo + (maximo - minimo) * i / 255) for i in range(256)],
+                             dtype=np.uint8)
+    posiciones = np.clip((precios_m2 - minimo) / (maximo - minimo) * 255, 0, 255)
+    imagen = tabla_colores[np.where(validos, posiciones, 0).astype(np.uint8)]
+    imagen[..., 3] = np.where(validos, 140, 0)
+
+    # Grid rows are evenly spaced in latitude but the map stretches the image evenly in Web
+    # Mercator, so the rows are picked again at even Mercator steps. Whole rows are taken, which
+    # keeps the uint8 colors and the alpha channel intact
+    mercator = lambda latitud_grados: np.log(np.tan(np.pi / 4 + np.radians(latitud_grados) / 2))
+    filas = imagen.shape[0]
+    pasos = np.linspace(mercator(sur), mercator(norte), filas + 1)
+    latitudes = np.degrees(2 * np.arctan(np.exp((pasos[:-1] + pasos[1:]) / 2)) - np.pi / 2)
+    imagen = imagen[np.clip(((latitudes - sur) / (norte - sur) * filas).astype(np.intp), 0, filas - 1)]
+
+    folium.raster_layers.ImageOverlay(imagen, bounds=[[sur, oeste], [norte, este]], origin='lower').add_to(mapa)
+    escala.add_to(mapa)
+    return mapa
+
+
+def main(argumentos=None):
+    parser = argparse.ArgumentParser(description="Genera los mosaicos de precio por m² para el mapa.")
+    parser.add_argument('--tipo', choices=["Casa", "Departamento"], action='append',
+                        help="Conjunto a procesar; por defecto todos los disponibles")
+    parser.add_argument('--manifiesto', default=RUTA_MANIFIESTO)
+    parser.add_argument('--directorio', default=DIRECTORIO_MOSAICOS)
+    parser.add_argument('--resolucion', type=float, default=RESOLUCION, help="Lado de la celda en grados")
+    parser.add_argument('--limites', type=float, nargs=4, default=LIMITES_MEXICO,
+                        metavar=('SUR', 'OESTE', 'NORTE', 'ESTE'))
+    argumentos = parser.parse_args(argumentos)
+
+    registro = RegistroModelos(argumentos.manifiesto, tipos=argumentos.tipo).cargar()
+    for tipo_propiedad in registro.disponibles():
+        estimador = registro.obtener(tipo_propiedad)
+        total = generar_mosaicos(estimador, argumentos.directorio, argumentos.resolucion, tuple(argumentos.limites))
+        logger.info(f"{total} mosaicos de {tipo_propiedad} versión {estimador.version} generados")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
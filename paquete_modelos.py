@@ -0,0 +1,215 @@
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import struct
+import time
+
+import numpy as np
+
+from bosque_compilado import BosqueCompilado, muestras_crudas, muestras_verificacion, verificar
+from estimador import (DIRECTORIO_MODELOS, MODELOS_REQUERIDOS, Estimador, TransformacionFusionada,
+                       cargar_artefactos, prefijo_modelos, verificar_transformacion)
+from indice_ubicaciones import IndiceUbicaciones
+from registro_modelos import sha256_archivo
+
+logger = logging.getLogger(__name__)
+
+# Single-file model set. The file starts with MAGIA, the length of a JSON header as a
+# little-endian uint64 and the header itself; every array follows at an offset aligned to
+# ALINEACION bytes and described in the header by dtype, shape and offset. Loading parses the
+# header and maps the arrays straight out of the file, so it costs no unpickling and no sklearn
+# import, and processes that open the same file share its pages. The flat forest is only fast for
+# single rows and small batches: larger batches use the sklearn forest the bundle was built from,
+# which the manifest declares next to it and which is loaded when the first such batch arrives
+
+ARCHIVO_PAQUETE = 'modelos.paquete'
+MAGIA = b'EVIPAQ\x00\x00'
+FORMATO = 1
+ALINEACION = 64
+
+CAMPOS_BOSQUE = ('izquierdos', 'derechos', 'caracteristicas', 'umbrales', 'valores', 'raices')
+
+
+def ruta_paquete(tipo_propiedad, directorio=DIRECTORIO_MODELOS):
+    return os.path.join(directorio, f"{prefijo_modelos(tipo_propiedad)}{ARCHIVO_PAQUETE}")
+
+
+def _alinear(desplazamiento):
+    return -(-desplazamiento // ALINEACION) * ALINEACION
+
+
+def escribir_paquete(ruta, cabecera, arreglos):
+    # cabecera: JSON-serializable metadata; arreglos: {nombre: ndarray}, stored little-endian
+    descripciones, datos, desplazamiento = {}, [], 0
+    for nombre, arreglo in arreglos.items():
+        arreglo = np.ascontiguousarray(arreglo, dtype=np.asarray(arreglo).dtype.newbyteorder('<'))
+        desplazamiento = _alinear(desplazamiento)
+        descripciones[nombre] = {'dtype': arreglo.dtype.str, 'forma': list(arreglo.shape),
+                                 'desplazamiento': desplazamiento}
+        datos.append((desplazamiento, arreglo))
+        desplazamiento += arreglo.nbytes
+    texto = json.dumps(dict(cabecera, formato=FORMATO, arreglos=descripciones), ensure_ascii=False).encode('utf-8')
+    inicio_datos = _alinear(len(MAGIA) + 8 + len(texto))
+
+    temporal = ruta + '.tmp'
+    with open(temporal, 'wb') as archivo:
+        archivo.write(MAGIA + struct.pack('<Q', len(texto)) + texto)
+        for desplazamiento, arreglo in datos:
+            archivo.write(b'\0' * (inicio_datos + desplazamiento - archivo.tell()))
+            archivo.write(arreglo.tobytes())
+    os.replace(temporal, ruta)
+
+
+def leer_cabecera(ruta):
+    # (cabecera, inicio de los datos) reading only the start of the file
+    with open(ruta, 'rb') as archivo:
+        inicio = archivo.read(len(MAGIA) + 8)
+        if len(inicio) < len(MAGIA) + 8 or inicio[:len(MAGIA)] != MAGIA:
+            raise ValueError(f"{ruta} no es un paquete de modelos")
+        (longitud,) = struct.unpack('<Q', inicio[len(MAGIA):])
+        cabecera = json.loads(archivo.read(longitud).decode('utf-8'))
+    if cabecera.get('formato') != FORMATO:
+        raise ValueError(f"{ruta} usa el formato {cabecera.get('formato')}, se esperaba {FORMATO}")
+    return cabecera, _alinear(len(MAGIA) + 8 + longitud)
+
+
+def leer_arreglos(ruta, mmap=True):
+    # ({nombre: read-only ndarray}, cabecera); with mmap the arrays are views of the mapped file
+    cabecera, inicio_datos = leer_cabecera(ruta)
+    if mmap:
+        contenido = np.memmap(ruta, dtype=np.uint8, mode='r')
+    else:
+        with open(ruta, 'rb') as archivo:
+            contenido = archivo.read()
+    arreglos = {}
+    for nombre, descripcion in cabecera['arreglos'].items():
+        forma = tuple(descripcion['forma'])
+        arreglos[nombre] = np.frombuffer(contenido, dtype=np.dtype(descripcion['dtype']), count=math.prod(forma),
+                                         offset=inicio_datos + descripcion['desplazamiento']).reshape(forma)
+    return arreglos, cabecera
+
+
+def cargar_paquete(ruta, mmap=True):
+    # (modelos, cabecera) with the structures Estimador uses in place of the sklearn objects:
+    # the compiled forest, the fused transform and the location index
+    arreglos, cabecera = leer_arreglos(ruta, mmap)
+    parametros = cabecera['parametros']
+    bosque = BosqueCompilado(*(arreglos[f'bosque.{campo}'] for campo in CAMPOS_BOSQUE),
+                             parametros['profundidad'], parametros['n_caracteristicas'])
+    bosque.huella_origen = cabecera['origen'].get('modelo') or ""
+    valor_faltante = parametros['valor_faltante']
+    modelos = {
+        'modelo': bosque,
+        'transformacion': TransformacionFusionada(
+            arreglos['transformacion.estadisticas'], arreglos.get('transformacion.media'),
+            arreglos.get('transformacion.escala'), float('nan') if valor_faltante is None else valor_faltante),
+        'indice_ubicaciones': IndiceUbicaciones(arreglos['ubicaciones.centros']),
+        'momentos_entrenamiento': (arreglos['entrenamiento.media'], arreglos['entrenamiento.varianza']),
+    }
+    return modelos, cabecera
+
+
+def cargar_estimador(ruta, mmap=True, cuantiles=None, ruta_bosque=None):
+    # ruta_bosque: the sklearn forest the bundle was built from, used for large batches
+    modelos, cabecera = cargar_paquete(ruta, mmap)
+    if ruta_bosque is not None:
+        import joblib
+
+        if sha256_archivo(ruta_bosque) != modelos['modelo'].huella_origen:
+            raise ValueError(f"{ruta} se construyó a partir de otro bosque que {ruta_bosque}")
+        modelos['modelo'].cargar_lotes = lambda: joblib.load(ruta_bosque)
+    return Estimador(cabecera['tipo_propiedad'], modelos, cabecera['version'], cuantiles)
+
+
+def empaquetar(tipo_propiedad, directorio=DIRECTORIO_MODELOS, salida=None):
+    modelos = cargar_artefactos(tipo_propiedad, directorio)
+    transformacion = modelos['transformacion']
+    escalador = modelos['escalador']
+    bosque = BosqueCompilado.desde_sklearn(modelos['modelo'])
+
+    prefijo = prefijo_modelos(tipo_propiedad)
+    origen = {nombre: sha256_archivo(os.path.join(directorio, f"{prefijo}{archivo}"))
+              for nombre, archivo in MODELOS_REQUERIDOS.items()}
+    # Same sources and format give the same version, wherever the bundle is built
+    version = hashlib.sha256(json.dumps([FORMATO, origen], sort_keys=True).encode()).hexdigest()[:12]
+
+    arreglos = {f'bosque.{campo}': getattr(bosque, campo) for campo in CAMPOS_BOSQUE}
+    arreglos['transformacion.estadisticas'] = transformacion.estadisticas
+    if transformacion.media is not None:
+        arreglos['transformacion.media'] = transformacion.media
+    if transformacion.escala is not None:
+        arreglos['transformacion.escala'] = transformacion.escala
+    arreglos['entrenamiento.media'] = np.asarray(escalador.mean_, dtype=np.float64)
+    arreglos['entrenamiento.varianza'] = np.asarray(escalador.var_, dtype=np.float64)
+    arreglos['ubicaciones.centros'] = np.asarray(modelos['agrupamiento'].cluster_centers_, dtype=np.float64)
+
+    valor_faltante = transformacion.valor_faltante
+    cabecera = {
+        'tipo_propiedad': tipo_propiedad,
+        'version': version,
+        'origen': origen,
+        'parametros': {
+            'profundidad': bosque.profundidad,
+            'n_caracteristicas': bosque.n_caracteristicas,
+            'n_arboles': bosque.n_arboles,
+            # NaN has no JSON form; null stands for it
+            'valor_faltante': None if valor_faltante != valor_faltante else valor_faltante,
+        },
+    }
+    salida = salida or ruta_paquete(tipo_propiedad, directorio)
+    escribir_paquete(salida, cabecera, arreglos)
+    return salida, modelos
+
+
+def verificar_paquete(ruta, modelos, n_muestras=20000):
+    # The bundle must reproduce the sklearn artifacts it was built from bit for bit
+    empaquetados, _ = cargar_paquete(ruta)
+    resultado = verificar(modelos['modelo'], empaquetados['modelo'],
+                          muestras_verificacion(n_muestras, empaquetados['modelo'].n_caracteristicas))
+    crudos = muestras_crudas(modelos['imputador'].statistics_, n_muestras)
+    resultado['transformacion_identica'] = verificar_transformacion(
+        dict(modelos, transformacion=empaquetados['transformacion']), crudos)
+    resultado['centros_identicos'] = bool(np.array_equal(
+        modelos['agrupamiento'].cluster_centers_, empaquetados['indice_ubicaciones'].centros))
+    return resultado
+
+
+def main(argumentos=None):
+    parser = argparse.ArgumentParser(description="Empaqueta un conjunto de modelos en un solo archivo mapeable.")
+    subcomandos = parser.add_subparsers(dest='comando', required=True)
+    empaquetado = subcomandos.add_parser('empaquetar', help="Crea el paquete a partir de los archivos .joblib")
+    empaquetado.add_argument('--tipo', choices=["Casa", "Departamento"], default="Departamento")
+    empaquetado.add_argument('--directorio', default=DIRECTORIO_MODELOS)
+    empaquetado.add_argument('--salida', help="Ruta del paquete (por defecto, junto a los .joblib)")
+    empaquetado.add_argument('--muestras', type=int, default=20000)
+    inspeccion = subcomandos.add_parser('inspeccionar', help="Muestra la cabecera y el tiempo de carga")
+    inspeccion.add_argument('ruta')
+    argumentos = parser.parse_args(argumentos)
+
+    if argumentos.comando == 'empaquetar':
+        ruta, modelos = empaquetar(argumentos.tipo, argumentos.directorio, argumentos.salida)
+        resultado = verificar_paquete(ruta, modelos, argumentos.muestras)
+        logger.info(f"Verificación: {resultado}")
+        if not (resultado['identicos'] and resultado['transformacion_identica'] and resultado['centros_identicos']):
+            os.remove(ruta)
+            raise SystemExit("El paquete no reproduce los modelos originales")
+        logger.info(f"Paquete escrito en {ruta} ({os.path.getsize(ruta) / 1e6:.1f} MB); "
+                    f"ejecute 'registro_modelos.py generar' para declararlo en el manifiesto")
+        return
+
+    inicio = time.perf_counter()
+    estimador = cargar_estimador(argumentos.ruta)
+    carga = time.perf_counter() - inicio
+    cabecera, _ = leer_cabecera(argumentos.ruta)
+    logger.info(f"{estimador.tipo_propiedad} versión {estimador.version}, formato {cabecera['formato']}, "
+                f"{cabecera['parametros']['n_arboles']} árboles; cargado en {carga * 1000:.1f} ms")
+    for nombre, descripcion in cabecera['arreglos'].items():
+        logger.info(f"  {nombre}: {descripcion['dtype']} {descripcion['forma']}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,76 @@
+import logging
+
+from estimador import agregar_caracteristica_grupo, curvas_sensibilidad, predecir_precio, preprocesar_datos
+from instrumentacion import tramo
+
+logger = logging.getLogger(__name__)
+
+# Step 3 of the wizard without Streamlit, so that prueba_carga.py runs exactly what a session
+# runs: the cached prediction and its drift observation, the sensitivity curves and the
+# comparable properties. Errors are logged and reported as None, as the page shows them
+
+
+class PasoResultados:
+    # The step 3 work over the resources one server process shares: cargar_modelos(tipo) returns
+    # the model dict ({} when unavailable), comparables maps each property type to its spatial
+    # index, and the drift monitor is optional
+    def __init__(self, cargar_modelos, cache_predicciones, monitor_deriva=None, comparables=None):
+        self.cargar_modelos = cargar_modelos
+        self.cache_predicciones = cache_predicciones
+        self.monitor_deriva = monitor_deriva
+        self.comparables = comparables or {}
+
+    def predecir(self, tipo_propiedad, latitud, longitud, terreno, construccion, habitaciones, banos):
+        caracteristicas = (tipo_propiedad, latitud, longitud, terreno, construccion, habitaciones, banos)
+
+        def calcular_prediccion():
+            modelos = self.cargar_modelos(tipo_propiedad)
+            datos_procesados = preprocesar_datos(latitud, longitud, float(terreno), float(construccion),
+                                                 float(habitaciones), float(banos), modelos)
+            if datos_procesados is None:
+                return None
+            resultado = predecir_precio(datos_procesados, modelos)
+            # Only computed predictions are observed, so reruns and cache hits are not counted twice
+            if resultado[0] is not None:
+                self.registrar_deriva(*caracteristicas, modelos, resultado[0])
+            return resultado
+
+        return self.cache_predicciones.obtener_o_calcular(*caracteristicas, calcular_prediccion)
+
+    def registrar_deriva(self, tipo_propiedad, latitud, longitud, terreno, construccion, habitaciones, banos,
+                         modelos, precio):
+        if self.monitor_deriva is None:
+            return
+        try:
+            self.monitor_deriva.observar(
+                tipo_propiedad,
+                agregar_caracteristica_grupo(latitud, longitud, modelos),
+                {'Terreno': terreno, 'Construccion': construccion, 'Habitaciones': habitaciones, 'Banos': banos},
+                precio
+            )
+        except Exception as e:
+            logger.error(f"Error al registrar la deriva: {str(e)}")
+
+    def sensibilidad(self, tipo_propiedad, latitud, longitud, terreno, construccion, habitaciones, banos):
+        modelos = self.cargar_modelos(tipo_propiedad)
+        if not modelos:
+            return None
+        try:
+            return curvas_sensibilidad(latitud, longitud, float(terreno), float(construccion), float(habitaciones),
+                                       float(banos), modelos)
+        except Exception as e:
+            logger.error(f"Error al calcular la sensibilidad: {str(e)}")
+            return None
+
+    def buscar_comparables(self, tipo_propiedad, latitud, longitud, terreno, construccion, habitaciones, banos):
+        indice = self.comparables.get(tipo_propiedad)
+        if indice is None or latitud is None or longitud is None:
+            return None
+        try:
+            with tramo('comparables'):
+                grupo = agregar_caracteristica_grupo(latitud, longitud, self.cargar_modelos(tipo_propiedad))
+                return indice.buscar(latitud, longitud, float(terreno), float(construccion), float(habitaciones),
+                                     float(banos), grupo=grupo)
+        except Exception as e:
+            logger.error(f"Error al buscar propiedades comparables: {str(e)}")
+            return None
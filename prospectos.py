@@ -0,0 +1,474 @@
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+from instrumentacion import METRICAS, tramo
+
+logger = logging.getLogger(__name__)
+
+DIRECTORIO_DATOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache')
+RUTA_SPOOL = os.path.join(DIRECTORIO_DATOS, 'prospectos_pendientes.jsonl')
+RUTA_SQLITE = os.path.join(DIRECTORIO_DATOS, 'prospectos.sqlite3')
+RUTA_PARQUET = os.path.join(DIRECTORIO_DATOS, 'prospectos')
+
+CAMPOS_PROSPECTO = [
+    'tipo_propiedad', 'direccion', 'terreno', 'construccion', 'habitaciones', 'banos',
+    'nombre', 'correo', 'telefono', 'interes_venta', 'precio_estimado'
+]
+COLUMNAS_PROSPECTO = ['timestamp'] + CAMPOS_PROSPECTO
+
+TAMANO_LOTE = 50
+INTERVALO_ENVIO = 5.0
+CAPACIDAD_COLA = 1000
+ESPERA_MAXIMA_REINTENTO = 300.0
+CONFIRMACIONES_POR_COMPACTACION = 500
+
+PROSPECTOS_ENVIADOS = METRICAS.contador('prospectos_enviados_total', "Prospectos confirmados por el almacén")
+
+
+def identificador_prospecto(data):
+    # Same submission, same id: Streamlit reruns of the results page and spool replays must not
+    # duplicate rows. 'id_envio' is a nonce the page draws each time the form is submitted, so
+    # a user repeating the same estimate later is a new lead; without it the id is the content
+    contenido = json.dumps([str(data.get('id_envio'))] + [str(data.get(campo)) for campo in CAMPOS_PROSPECTO],
+                           ensure_ascii=False)
+    return hashlib.sha1(contenido.encode('utf-8')).hexdigest()
+
+
+def fila_prospecto(data, timestamp=None):
+    timestamp = timestamp or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    return [timestamp] + [data[campo] for campo in CAMPOS_PROSPECTO]
+
+
+class AlmacenProspectos(ABC):
+    # Lead storage backend. Instances are callables so they can be passed directly as the
+    # escribir_lote function of EscritorProspectos
+    @abstractmethod
+    def guardar_lote(self, filas):
+        pass
+
+    @abstractmethod
+    def exportar(self, desde=None, hasta=None, tipo_propiedad=None, correo=None):
+        pass
+
+    def __call__(self, filas):
+        self.guardar_lote(filas)
+
+
+def _columna_hoja(numero):
+    letras = ""
+    while numero:
+        numero, resto = divmod(numero - 1, 26)
+        letras = chr(ord('A') + resto) + letras
+    return letras
+
+
+def _coincide_filtros(fila, desde, hasta, tipo_propiedad, correo):
+    timestamp = str(fila[0])
+    return ((desde is None or timestamp >= desde) and (hasta is None or timestamp < hasta)
+            and (tipo_propiedad is None or fila[1] == tipo_propiedad)
+            and (correo is None or fila[8] == correo))
+
+
+class AlmacenSheets(AlmacenProspectos):
+    # The service client is built on first use and then reused
+    def __init__(self, crear_servicio, spreadsheet_id, sheet_name):
+        self.crear_servicio = crear_servicio
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_name = sheet_name
+        self.rango = f"{sheet_name}!A:{_columna_hoja(len(COLUMNAS_PROSPECTO))}"
+        self._servicio = None
+
+    def _obtener_servicio(self):
+        if self._servicio is None:
+            self._servicio = self.crear_servicio()
+        return self._servicio
+
+    def guardar_lote(self, filas):
+        self._obtener_servicio().spreadsheets().values().append(
+            spreadsheetId=self.spreadsheet_id,
+            range=self.rango,
+            valueInputOption='RAW',
+            insertDataOption='INSERT_ROWS',
+            body={'values': filas}
+        ).execute()
+
+    def exportar(self, desde=None, hasta=None, tipo_propiedad=None, correo=None):
+        respuesta = self._obtener_servicio().spreadsheets().values().get(
+            spreadsheetId=self.spreadsheet_id, range=self.rango
+        ).execute()
+        for fila in respuesta.get('values', []):
+            if len(fila) == len(COLUMNAS_PROSPECTO) and _coincide_filtros(fila, desde, hasta, tipo_propiedad, correo):
+                yield fila
+
+
+class AlmacenSQLite(AlmacenProspectos):
+    def __init__(self, ruta):
+        os.makedirs(os.path.dirname(os.path.abspath(ruta)), exist_ok=True)
+        self.ruta = ruta
+        self._conexion = sqlite3.connect(ruta, check_same_thread=False)
+        self._candado = threading.Lock()
+        with self._candado, self._conexion:
+            self._conexion.execute("PRAGMA journal_mode=WAL")
+            self._conexion.execute(
+                "CREATE TABLE IF NOT EXISTS prospectos ("
+                "timestamp TEXT NOT NULL, tipo_propiedad TEXT, direccion TEXT, terreno REAL, "
+                "construccion REAL, habitaciones REAL, banos REAL, nombre TEXT, correo TEXT, "
+                "telefono TEXT, interes_venta TEXT, precio_estimado REAL)"
+            )
+            for columna in ('timestamp', 'tipo_propiedad', 'correo'):
+                self._conexion.execute(f"CREATE INDEX IF NOT EXISTS idx_prospectos_{columna} ON prospectos ({columna})")
+
+    def guardar_lote(self, filas):
+        marcadores = ", ".join("?" * len(COLUMNAS_PROSPECTO))
+        with self._candado, self._conexion:
+            self._conexion.executemany(f"INSERT INTO prospectos VALUES ({marcadores})", filas)
+
+    def exportar(self, desde=None, hasta=None, tipo_propiedad=None, correo=None, tamano_bloque=10000):
+        condiciones, parametros = [], []
+        for condicion, valor in (("timestamp >= ?", desde), ("timestamp < ?", hasta),
+                                 ("tipo_propiedad = ?", tipo_propiedad), ("correo = ?", correo)):
+            if valor is not None:
+                condiciones.append(condicion)
+                parametros.append(valor)
+        consulta = f"SELECT {', '.join(COLUMNAS_PROSPECTO)} FROM prospectos"
+        if condiciones:
+            consulta += " WHERE " + " AND ".join(condiciones)
+        consulta += " ORDER BY timestamp"
+
+        # A separate read connection lets the export stream while the writer keeps inserting
+        conexion = sqlite3.connect(self.ruta)
+        try:
+            cursor = conexion.execute(consulta, parametros)
+            while True:
+                bloque = cursor.fetchmany(tamano_bloque)
+                if not bloque:
+                    break
+                yield from bloque
+        finally:
+            conexion.close()
+
+
+class AlmacenParquet(AlmacenProspectos):
+    # One Parquet file per batch under a mes=YYYY-MM partition, so a month export only reads
+    # that month's files; compactar() merges a month's small files into one
+    def __init__(self, directorio):
+        os.makedirs(directorio, exist_ok=True)
+        self.directorio = directorio
+
+    @staticmethod
+    def _esquema():
+        import pyarrow as pa
+
+        tipos = {'terreno': pa.float64(), 'construccion': pa.float64(), 'habitaciones': pa.float64(),
+                 'banos': pa.float64(), 'precio_estimado': pa.float64()}
+        return pa.schema([(columna, tipos.get(columna, pa.string())) for columna in COLUMNAS_PROSPECTO])
+
+    def _tabla(self, filas):
+        import pyarrow as pa
+
+        esquema = self._esquema()
+        columnas = list(zip(*filas))
+        return pa.table([pa.array(valores, type=campo.type) for valores, campo in zip(columnas, esquema)],
+                        schema=esquema)
+
+    def guardar_lote(self, filas):
+        import pyarrow.parquet as pq
+
+        por_mes = {}
+        for fila in filas:
+            por_mes.setdefault(str(fila[0])[:7], []).append(fila)
+        for mes, filas_mes in por_mes.items():
+            directorio_mes = os.path.join(self.directorio, f"mes={mes}")
+            os.makedirs(directorio_mes, exist_ok=True)
+            nombre = f"parte-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet"
+            temporal = os.path.join(directorio_mes, f".{nombre}.tmp")
+            pq.write_table(self._tabla(filas_mes), temporal)
+            os.replace(temporal, os.path.join(directorio_mes, nombre))
+
+    def _archivos(self, desde=None, hasta=None):
+        for particion in sorted(os.listdir(self.directorio)):
+            if not particion.startswith("mes="):
+                continue
+            mes = particion[4:]
+            if (desde is not None and mes < desde[:7]) or (hasta is not None and mes > hasta[:7]):
+                continue
+            directorio_mes = os.path.join(self.directorio, particion)
+            for nombre in sorted(os.listdir(directorio_mes)):
+                if nombre.endswith(".parquet"):
+                    yield os.path.join(directorio_mes, nombre)
+
+    def exportar(self, desde=None, hasta=None, tipo_propiedad=None, correo=None):
+        import pyarrow.parquet as pq
+
+        for ruta in self._archivos(desde, hasta):
+            archivo = pq.ParquetFile(ruta)
+            for lote in archivo.iter_batches():
+                for fila in zip(*(columna.to_pylist() for columna in lote.columns)):
+                    if _coincide_filtros(fila, desde, hasta, tipo_propiedad, correo):
+                        yield list(fila)
+
+    def compactar(self, mes):
+        import pyarrow.parquet as pq
+
+        directorio_mes = os.path.join(self.directorio, f"mes={mes}")
+        archivos = sorted(ruta for ruta in self._archivos(mes, mes) if ruta.startswith(directorio_mes + os.sep))
+        if len(archivos) < 2:
+            return
+        tabla = pq.ParquetDataset(archivos).read()
+        nombre = f"parte-{time.time_ns()}-compactado.parquet"
+        temporal = os.path.join(directorio_mes, f".{nombre}.tmp")
+        pq.write_table(tabla, temporal)
+        os.replace(temporal, os.path.join(directorio_mes, nombre))
+        for ruta in archivos:
+            os.remove(ruta)
+
+
+def crear_almacen(configuracion, crear_servicio=None):
+    # configuracion["tipo"]: "sheets" (default, uses id and sheet_name), "sqlite" or "parquet" (use ruta)
+    tipo = configuracion.get("tipo", "sheets")
+    if tipo == "sheets":
+        return AlmacenSheets(crear_servicio, configuracion["id"], configuracion["sheet_name"])
+    if tipo == "sqlite":
+        return AlmacenSQLite(configuracion.get("ruta", RUTA_SQLITE))
+    if tipo == "parquet":
+        return AlmacenParquet(configuracion.get("ruta", RUTA_PARQUET))
+    raise ValueError(f"Almacén de prospectos desconocido: {tipo}")
+
+
+class EscritorProspectos:
+    # Background lead writer. encolar() journals the row to a local spool file and returns
+    # immediately; a worker thread sends rows in batches when TAMANO_LOTE rows are waiting or
+    # INTERVALO_ENVIO seconds have passed, retrying with backoff while the sink is down.
+    # Rows still pending in the spool are sent again after a restart.
+    def __init__(self, escribir_lote, ruta_spool=RUTA_SPOOL, tamano_lote=TAMANO_LOTE,
+                 intervalo=INTERVALO_ENVIO, capacidad=CAPACIDAD_COLA):
+        self.escribir_lote = escribir_lote
+        self.ruta_spool = ruta_spool
+        self.tamano_lote = tamano_lote
+        self.intervalo = intervalo
+        self._cola = queue.Queue(maxsize=capacidad)
+        self._pendientes = {}
+        # Insertion-ordered so compaction keeps the most recent confirmations
+        self._confirmados = {}
+        self._desbordados = False
+        self._confirmaciones_en_spool = 0
+        self._candado = threading.Lock()
+        self._detener = threading.Event()
+        self.enviados = 0
+        self.lotes_enviados = 0
+        self.errores = 0
+
+        if ruta_spool:
+            os.makedirs(os.path.dirname(os.path.abspath(ruta_spool)), exist_ok=True)
+            self._recuperar_spool()
+        for identificador, fila in self._pendientes.items():
+            if self._cola.full():
+                self._desbordados = True
+                break
+            self._cola.put_nowait((identificador, fila))
+
+        self._hilo = threading.Thread(target=self._trabajar, name="escritor-prospectos", daemon=True)
+        self._hilo.start()
+
+    def encolar(self, data, timestamp=None):
+        identificador = identificador_prospecto(data)
+        fila = fila_prospecto(data, timestamp)
+        with self._candado:
+            if identificador in self._pendientes or identificador in self._confirmados:
+                return identificador
+            self._pendientes[identificador] = fila
+            self._anotar({'id': identificador, 'fila': fila})
+        try:
+            self._cola.put_nowait((identificador, fila))
+        except queue.Full:
+            # The row is already journaled; the worker picks it up from the spool later
+            logger.warning("Cola de prospectos llena, el prospecto queda en el spool")
+            self._desbordados = True
+        return identificador
+
+    def pendientes(self):
+        with self._candado:
+            return len(self._pendientes)
+
+    def detener(self, espera=None):
+        self._detener.set()
+        self._hilo.join(espera)
+
+    def _trabajar(self):
+        lote = {}
+        fecha_limite = None
+        espera_reintento = self.intervalo
+        reintentando = False
+        while True:
+            deteniendo = self._detener.is_set()
+            if not lote and self._desbordados and self._cola.empty():
+                lote.update(self._leer_desbordados())
+
+            if len(lote) < self.tamano_lote:
+                espera = 0 if deteniendo else 0.5
+                if fecha_limite is not None:
+                    espera = min(espera, max(0.0, fecha_limite - time.monotonic()))
+                try:
+                    identificador, fila = self._cola.get(timeout=espera) if espera else self._cola.get_nowait()
+                    lote[identificador] = fila
+                    while len(lote) < self.tamano_lote:
+                        identificador, fila = self._cola.get_nowait()
+                        lote[identificador] = fila
+                except queue.Empty:
+                    pass
+            elif fecha_limite is not None and not deteniendo:
+                self._detener.wait(min(0.5, max(0.0, fecha_limite - time.monotonic())))
+
+            if not lote:
+                if deteniendo:
+                    return
+                continue
+            if fecha_limite is None:
+                fecha_limite = time.monotonic() + self.intervalo
+            lleno = len(lote) >= self.tamano_lote and not reintentando
+            if not (lleno or deteniendo or time.monotonic() >= fecha_limite):
+                continue
+
+            if self._enviar(list(lote.items())):
+                lote = {}
+                fecha_limite = None
+                reintentando = False
+                espera_reintento = self.intervalo
+            elif deteniendo:
+                # Rows stay in the spool and are retried after the next start
+                return
+            else:
+                reintentando = True
+                espera_reintento = min(espera_reintento * 2, ESPERA_MAXIMA_REINTENTO)
+                fecha_limite = time.monotonic() + espera_reintento
+
+    def _enviar(self, lote):
+        with self._candado:
+            lote = [(identificador, fila) for identificador, fila in lote if identificador in self._pendientes]
+        if not lote:
+            return True
+        try:
+            with tramo('persistir'):
+                self.escribir_lote([fila for _, fila in lote])
+        except Exception as e:
+            self.errores += 1
+            logger.error(f"Error al enviar {len(lote)} prospectos: {str(e)}")
+            return False
+
+        identificadores = [identificador for identificador, _ in lote]
+        with self._candado:
+            for identificador in identificadores:
+                self._pendientes.pop(identificador, None)
+                self._confirmados[identificador] = None
+            self._anotar({'confirmados': identificadores})
+            self._confirmaciones_en_spool += len(identificadores)
+            if self._confirmaciones_en_spool >= CONFIRMACIONES_POR_COMPACTACION:
+                self._compactar_spool()
+        self.enviados += len(lote)
+        self.lotes_enviados += 1
+        PROSPECTOS_ENVIADOS.incrementar(cantidad=len(lote))
+        logger.debug("%d prospectos enviados", len(lote))
+        return True
+
+    def _leer_desbordados(self):
+        with self._candado:
+            pendientes = list(self._pendientes.items())
+            self._desbordados = len(pendientes) > self.tamano_lote
+            return pendientes[:self.tamano_lote]
+
+    def _anotar(self, registro):
+        if not self.ruta_spool:
+            return
+        with open(self.ruta_spool, 'a', encoding='utf-8') as spool:
+            spool.write(json.dumps(registro, ensure_ascii=False) + "\n")
+            spool.flush()
+            os.fsync(spool.fileno())
+
+    def _recuperar_spool(self):
+        if not os.path.exists(self.ruta_spool):
+            return
+        with open(self.ruta_spool, encoding='utf-8') as spool:
+            for linea in spool:
+                try:
+                    registro = json.loads(linea)
+                except ValueError:
+                    # A crash can leave a truncated last line
+                    continue
+                if 'fila' in registro:
+                    if registro['id'] not in self._confirmados:
+                        self._pendientes[registro['id']] = registro['fila']
+                else:
+                    for identificador in registro['confirmados']:
+                        self._pendientes.pop(identificador, None)
+                        self._confirmados[identificador] = None
+        logger.info(f"{len(self._pendientes)} prospectos pendientes recuperados del spool")
+        self._compactar_spool()
+
+    def _compactar_spool(self):
+        # Keeps the pending rows and the most recent confirmed ids so idempotency survives restarts
+        if not self.ruta_spool:
+            return
+        confirmados = list(self._confirmados)[-CONFIRMACIONES_POR_COMPACTACION:]
+        self._confirmados = dict.fromkeys(confirmados)
+        temporal = self.ruta_spool + '.tmp'
+        with open(temporal, 'w', encoding='utf-8') as spool:
+            if confirmados:
+                spool.write(json.dumps({'confirmados': confirmados}) + "\n")
+            for identificador, fila in self._pendientes.items():
+                spool.write(json.dumps({'id': identificador, 'fila': fila}, ensure_ascii=False) + "\n")
+            spool.flush()
+            os.fsync(spool.fileno())
+        os.replace(temporal, self.ruta_spool)
+        self._confirmaciones_en_spool = 0
+
+
+def main(argumentos=None):
+    parser = argparse.ArgumentParser(description="Exporta prospectos de un almacén local.")
+    subcomandos = parser.add_subparsers(dest='comando', required=True)
+    exportar = subcomandos.add_parser('exportar', help="Exporta prospectos a CSV en orden de llegada")
+    exportar.add_argument('--almacen', choices=['sqlite', 'parquet'], default='sqlite')
+    exportar.add_argument('--ruta', help="Base SQLite o directorio Parquet")
+    exportar.add_argument('--desde', help="Fecha inicial incluida, p. ej. 2026-09-01")
+    exportar.add_argument('--hasta', help="Fecha final excluida, p. ej. 2026-10-01")
+    exportar.add_argument('--tipo-propiedad')
+    exportar.add_argument('--correo')
+    exportar.add_argument('--salida', help="Archivo CSV de salida (por defecto la salida estándar)")
+    compactar = subcomandos.add_parser('compactar', help="Une los archivos Parquet de un mes")
+    compactar.add_argument('mes', help="Mes en formato YYYY-MM")
+    compactar.add_argument('--ruta', default=RUTA_PARQUET)
+    argumentos = parser.parse_args(argumentos)
+
+    if argumentos.comando == 'compactar':
+        AlmacenParquet(argumentos.ruta).compactar(argumentos.mes)
+        return
+
+    configuracion = {'tipo': argumentos.almacen}
+    if argumentos.ruta:
+        configuracion['ruta'] = argumentos.ruta
+    almacen = crear_almacen(configuracion)
+    salida = open(argumentos.salida, 'w', newline='', encoding='utf-8') if argumentos.salida else sys.stdout
+    try:
+        escritor = csv.writer(salida)
+        escritor.writerow(COLUMNAS_PROSPECTO)
+        escritor.writerows(almacen.exportar(argumentos.desde, argumentos.hasta,
+                                            argumentos.tipo_propiedad, argumentos.correo))
+    finally:
+        if salida is not sys.stdout:
+            salida.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
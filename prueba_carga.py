@@ -0,0 +1,340 @@
+import argparse
+import atexit
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cache_predicciones import CachePredicciones
+from comparables import RUTA_COMPARABLES, cargar_comparables
+from geocodificacion import (TASA_SOLICITUDES, CacheGeocodificacion, ClienteGeocodificacion, GeocodificadorCacheado,
+                             LimitadorTasa)
+from monitor_deriva import MonitorDeriva
+from paso_resultados import PasoResultados
+from prospectos import AlmacenSheets, EscritorProspectos
+from registro_modelos import RUTA_MANIFIESTO, RegistroModelos
+from rendimiento import percentil
+from simulados import GeocodificadorSimulado, ServicioSheetsSimulado
+
+logger = logging.getLogger(__name__)
+
+# Load test of one Streamlit replica. Streamlit runs the script of every session in its own thread
+# of a single server process, so each simulated session is a thread that replays the wizard from
+# step 1 to step 3 against the resources the app shares through cache_resource: the cached
+# geocoding client, the model registry, the prediction cache, the drift monitor, the comparables
+# index and the lead writer. Step 3 runs through paso_resultados.py, the same code as the page.
+# Nominatim and Google Sheets are replaced by the stand-ins of simulados.py with a configurable
+# latency.
+# The number of sessions grows level by level until throughput stops growing or the latency
+# target is missed; the last level before that is the capacity of one replica
+
+RUTA_RESULTADOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'prueba_carga.json')
+ETAPAS = ('sugerir', 'geocodificar', 'cargar_modelos', 'predecir', 'sensibilidad', 'comparables', 'prospecto')
+SESIONES = [1, 2, 4, 8, 16, 32, 64]
+DURACION_NIVEL = 20.0
+# Seconds between two submissions of the address field and spent filling each later step
+PAUSA_ESCRITURA = 1.0
+PAUSA_PASO = 5.0
+LATENCIA_NOMINATIM = 0.25
+LATENCIA_SHEETS = 0.4
+# A level saturates when it adds less than GANANCIA_MINIMA throughput over the previous one or
+# when the p95 of the time a user waits during a flow exceeds OBJETIVO_P95
+GANANCIA_MINIMA = 0.10
+OBJETIVO_P95 = 2.0
+
+
+class Replica:
+    # The per-process resources of the app. The registry is loaded once and shared by every
+    # level, as in a running server, and so are the comparables; caches, the drift monitor and
+    # the lead writer start empty on each level
+    def __init__(self, registro, directorio, latencia_geocodificacion=LATENCIA_NOMINATIM,
+                 latencia_sheets=LATENCIA_SHEETS, tasa_geocodificacion=TASA_SOLICITUDES, comparables=None):
+        self.registro = registro
+        self.nominatim = GeocodificadorSimulado(latencia=latencia_geocodificacion)
+        self.cliente = ClienteGeocodificacion(self.nominatim, LimitadorTasa(tasa=tasa_geocodificacion))
+        self.geolocalizador = GeocodificadorCacheado(self.cliente, CacheGeocodificacion(ruta=None))
+        self.cache_predicciones = CachePredicciones(lambda tipo: registro.versiones().get(tipo))
+        self.monitor_deriva = MonitorDeriva(os.path.join(directorio, 'deriva.json'))
+        self.resultados = PasoResultados(lambda tipo: registro.obtener(tipo).modelos, self.cache_predicciones,
+                                         self.monitor_deriva, comparables)
+        self.sheets = ServicioSheetsSimulado(latencia=latencia_sheets)
+        self.escritor = EscritorProspectos(AlmacenSheets(lambda: self.sheets, "simulado", "Hoja 1"),
+                                           ruta_spool=os.path.join(directorio, f'spool-{id(self)}.jsonl'))
+
+    def cerrar(self):
+        self.escritor.detener()
+        # The checkpoint directory is removed with the level
+        atexit.unregister(self.monitor_deriva.guardar)
+
+
+class Sesion:
+    # One simulated user repeating the wizard; latencies are kept per stage, plus the total time
+    # the user waited on the app during each completed flow
+    def __init__(self, replica, numero, pausa_escritura=PAUSA_ESCRITURA, pausa_paso=PAUSA_PASO, semilla=0):
+        self.replica = replica
+        self.numero = numero
+        self.pausa_escritura = pausa_escritura
+        self.pausa_paso = pausa_paso
+        self.aleatorio = random.Random(semilla * 100003 + numero)
+        self.latencias = {etapa: [] for etapa in ETAPAS}
+        self.latencias['flujo'] = []
+        self.errores = {etapa: 0 for etapa in ETAPAS}
+        self.flujos = 0
+
+    def _medir(self, etapa, funcion, *argumentos):
+        inicio = time.perf_counter()
+        try:
+            resultado = funcion(*argumentos)
+        except Exception as e:
+            logger.debug("Error en la etapa %s: %s", etapa, e)
+            self.errores[etapa] += 1
+            resultado = None
+        segundos = time.perf_counter() - inicio
+        self.latencias[etapa].append(segundos)
+        return resultado, segundos
+
+    def _pausar(self, segundos, limite):
+        # Think times are jittered so that sessions do not move in lockstep
+        time.sleep(max(0.0, min(segundos * self.aleatorio.uniform(0.5, 1.5), limite - time.monotonic())))
+
+    def recorrer(self, limite):
+        while time.monotonic() < limite:
+            if self.recorrer_flujo(limite):
+                self.flujos += 1
+        return self
+
+    def recorrer_flujo(self, limite):
+        replica = self.replica
+        direccion, _, _ = self.aleatorio.choice(replica.nominatim.direcciones)
+        tipo_propiedad = self.aleatorio.choice(replica.registro.disponibles())
+        espera = 0.0
+
+        # Step 1: every submission of the address field reruns the page, which loads the models
+        # and asks for suggestions; the first suggestion is then geocoded
+        calle, _, ciudad, _ = [parte.strip() for parte in direccion.split(",")]
+        palabras = calle.split() + [ciudad]
+        sugerencias = None
+        for numero_palabras in range(2, len(palabras) + 1):
+            consulta = " ".join(palabras[:numero_palabras])
+            _, segundos = self._medir('cargar_modelos', lambda: replica.registro.obtener(tipo_propiedad).modelos)
+            espera += segundos
+            sugerencias, segundos = self._medir(
+                'sugerir', replica.geolocalizador.geocode, consulta + ", México", False, 5)
+            espera += segundos
+            self._pausar(self.pausa_escritura, limite)
+        seleccionada = sugerencias[0].address if sugerencias else direccion
+        ubicacion, segundos = self._medir('geocodificar', replica.geolocalizador.geocode, seleccionada)
+        espera += segundos
+        if ubicacion is None:
+            return False
+
+        # Steps 1 and 2: property features and contact details
+        terreno = float(self.aleatorio.randint(60, 600))
+        construccion = float(self.aleatorio.randint(45, 450))
+        habitaciones = float(self.aleatorio.randint(1, 5))
+        banos = float(self.aleatorio.randint(1, 4))
+        self._pausar(2 * self.pausa_paso, limite)
+        if time.monotonic() >= limite:
+            return False
+
+        # Step 3, in the order of the page: prediction through the shared cache (observed by the
+        # drift monitor), the lead, the sensitivity curves and the comparable properties
+        _, segundos = self._medir('cargar_modelos', lambda: replica.registro.obtener(tipo_propiedad).modelos)
+        espera += segundos
+        caracteristicas = (tipo_propiedad, ubicacion.latitude, ubicacion.longitude, terreno, construccion,
+                           habitaciones, banos)
+        prediccion, segundos = self._medir('predecir', replica.resultados.predecir, *caracteristicas)
+        espera += segundos
+        if not prediccion or prediccion[0] is None:
+            return False
+        _, segundos = self._medir('prospecto', replica.escritor.encolar, {
+            'tipo_propiedad': tipo_propiedad, 'direccion': seleccionada, 'terreno': terreno,
+            'construccion': construccion, 'habitaciones': habitaciones, 'banos': banos,
+            'nombre': f"Sesión {self.numero}", 'correo': f"sesion{self.numero}.{self.flujos}@ejemplo.com",
+            'telefono': "5555555555", 'interes_venta': "Sí", 'precio_estimado': prediccion[0],
+            'id_envio': f"{self.numero}-{self.flujos}",
+        })
+        espera += segundos
+        _, segundos = self._medir('sensibilidad', replica.resultados.sensibilidad, *caracteristicas)
+        espera += segundos
+        _, segundos = self._medir('comparables', replica.resultados.buscar_comparables, *caracteristicas)
+        espera += segundos
+        self.latencias['flujo'].append(espera)
+        return True
+
+
+def resumir_etapa(segundos, duracion):
+    if not segundos:
+        return {'solicitudes': 0}
+    ordenados = sorted(segundos)
+    return {
+        'solicitudes': len(ordenados),
+        'por_segundo': len(ordenados) / duracion,
+        'p50_ms': percentil(ordenados, 0.50) * 1000,
+        'p95_ms': percentil(ordenados, 0.95) * 1000,
+        'p99_ms': percentil(ordenados, 0.99) * 1000,
+    }
+
+
+def ejecutar_nivel(registro, sesiones, duracion=DURACION_NIVEL, pausa_escritura=PAUSA_ESCRITURA,
+                   pausa_paso=PAUSA_PASO, latencia_geocodificacion=LATENCIA_NOMINATIM,
+                   latencia_sheets=LATENCIA_SHEETS, tasa_geocodificacion=TASA_SOLICITUDES, semilla=0,
+                   comparables=None):
+    with tempfile.TemporaryDirectory() as directorio:
+        replica = Replica(registro, directorio, latencia_geocodificacion, latencia_sheets, tasa_geocodificacion,
+                          comparables)
+        try:
+            inicio = time.monotonic()
+            limite = inicio + duracion
+            with ThreadPoolExecutor(sesiones, thread_name_prefix="sesion") as ejecutor:
+                futuros = [ejecutor.submit(Sesion(replica, numero, pausa_escritura, pausa_paso, semilla).recorrer,
+                                           limite)
+                           for numero in range(sesiones)]
+                completadas = [futuro.result() for futuro in futuros]
+            transcurrido = time.monotonic() - inicio
+            pendientes = replica.escritor.pendientes()
+        finally:
+            replica.cerrar()
+
+    latencias = {etapa: [] for etapa in ETAPAS + ('flujo',)}
+    errores = dict.fromkeys(ETAPAS, 0)
+    for sesion in completadas:
+        for etapa, segundos in sesion.latencias.items():
+            latencias[etapa] += segundos
+        for etapa, cuenta in sesion.errores.items():
+            errores[etapa] += cuenta
+    flujos = sum(sesion.flujos for sesion in completadas)
+    return {
+        'sesiones': sesiones,
+        'duracion_s': transcurrido,
+        'flujos': flujos,
+        'flujos_por_segundo': flujos / transcurrido,
+        'espera_flujo': resumir_etapa(latencias.pop('flujo'), transcurrido),
+        'etapas': {etapa: dict(resumir_etapa(segundos, transcurrido), errores=errores[etapa])
+                   for etapa, segundos in latencias.items()},
+        'solicitudes_nominatim': replica.nominatim.llamadas,
+        'filas_sheets': len(replica.sheets.filas),
+        'prospectos_pendientes': pendientes,
+    }
+
+
+def abrir_comparables(ruta):
+    # As in the page, a missing file only hides the comparables section
+    try:
+        return cargar_comparables(ruta)
+    except FileNotFoundError:
+        logger.info(f"Sin archivo de comparables en {ruta}")
+        return {}
+
+
+def punto_saturacion(niveles, ganancia_minima=GANANCIA_MINIMA, objetivo_p95=OBJETIVO_P95):
+    # (sessions of the first saturated level, reason), or (None, None) when every level scaled
+    anterior = None
+    for nivel in niveles:
+        p95 = nivel['espera_flujo'].get('p95_ms')
+        if p95 is not None and p95 / 1000 > objetivo_p95:
+            return nivel['sesiones'], f"p95 de espera {p95 / 1000:.2f} s > {objetivo_p95:.2f} s"
+        if anterior is not None and nivel['flujos_por_segundo'] < anterior['flujos_por_segundo'] * (1 + ganancia_minima):
+            return nivel['sesiones'], (f"rendimiento {nivel['flujos_por_segundo']:.2f} flujos/s frente a "
+                                       f"{anterior['flujos_por_segundo']:.2f} con {anterior['sesiones']} sesiones")
+        anterior = nivel
+    return None, None
+
+
+def probar(manifiesto=RUTA_MANIFIESTO, sesiones=SESIONES, duracion=DURACION_NIVEL, pausa_escritura=PAUSA_ESCRITURA,
+           pausa_paso=PAUSA_PASO, latencia_geocodificacion=LATENCIA_NOMINATIM, latencia_sheets=LATENCIA_SHEETS,
+           tasa_geocodificacion=TASA_SOLICITUDES, ganancia_minima=GANANCIA_MINIMA, objetivo_p95=OBJETIVO_P95,
+           semilla=0, ruta_comparables=RUTA_COMPARABLES):
+    registro = RegistroModelos(manifiesto).cargar()
+    if not registro.disponibles():
+        raise RuntimeError(f"Ningún conjunto de modelos disponible: {registro.errores}")
+    comparables = abrir_comparables(ruta_comparables)
+    niveles = []
+    for numero_sesiones in sorted(sesiones):
+        logger.info(f"Nivel de {numero_sesiones} sesiones durante {duracion:.0f} s")
+        nivel = ejecutar_nivel(registro, numero_sesiones, duracion, pausa_escritura, pausa_paso,
+                               latencia_geocodificacion, latencia_sheets, tasa_geocodificacion, semilla,
+                               comparables)
+        niveles.append(nivel)
+        informar_nivel(nivel)
+        saturacion, motivo = punto_saturacion(niveles, ganancia_minima, objetivo_p95)
+        if saturacion is not None:
+            break
+    capacidad = None
+    if saturacion is None:
+        capacidad = niveles[-1]['sesiones']
+    elif len(niveles) > 1:
+        capacidad = niveles[-2]['sesiones']
+    return {
+        'parametros': {
+            'sesiones': sorted(sesiones), 'duracion_s': duracion, 'pausa_escritura_s': pausa_escritura,
+            'pausa_paso_s': pausa_paso, 'latencia_geocodificacion_s': latencia_geocodificacion,
+            'latencia_sheets_s': latencia_sheets, 'tasa_geocodificacion': tasa_geocodificacion,
+            'ganancia_minima': ganancia_minima, 'objetivo_p95_s': objetivo_p95, 'semilla': semilla,
+            'versiones_modelos': registro.versiones(), 'comparables': sorted(comparables),
+        },
+        'niveles': niveles,
+        'saturacion': {'sesiones': saturacion, 'motivo': motivo, 'capacidad_sesiones': capacidad},
+    }
+
+
+def informar_nivel(nivel):
+    espera = nivel['espera_flujo']
+    logger.info(f"{nivel['sesiones']} sesiones: {nivel['flujos_por_segundo']:.2f} flujos/s, espera por flujo "
+                f"p50 {espera.get('p50_ms', 0):.0f} ms, p95 {espera.get('p95_ms', 0):.0f} ms, "
+                f"p99 {espera.get('p99_ms', 0):.0f} ms")
+    for etapa, resumen in nivel['etapas'].items():
+        if resumen['solicitudes']:
+            logger.info(f"  {etapa}: {resumen['por_segundo']:.1f}/s, p50 {resumen['p50_ms']:.1f} ms, "
+                        f"p95 {resumen['p95_ms']:.1f} ms, p99 {resumen['p99_ms']:.1f} ms, "
+                        f"{resumen['errores']} errores")
+
+
+def main(argumentos=None):
+    parser = argparse.ArgumentParser(description="Prueba de carga de una réplica del asistente con servicios simulados.")
+    parser.add_argument('--manifiesto', default=RUTA_MANIFIESTO)
+    parser.add_argument('--salida', default=RUTA_RESULTADOS)
+    parser.add_argument('--comparables', default=RUTA_COMPARABLES, help="Archivo de comparables de comparables.py")
+    parser.add_argument('--sesiones', type=int, nargs='+', default=SESIONES,
+                        help="Sesiones concurrentes de cada nivel, en orden creciente")
+    parser.add_argument('--duracion', type=float, default=DURACION_NIVEL, help="Segundos por nivel")
+    parser.add_argument('--pausa-escritura', type=float, default=PAUSA_ESCRITURA,
+                        help="Segundos entre dos envíos del campo de dirección")
+    parser.add_argument('--pausa-paso', type=float, default=PAUSA_PASO, help="Segundos para llenar cada paso")
+    parser.add_argument('--latencia-geocodificacion', type=float, default=LATENCIA_NOMINATIM,
+                        help="Segundos por consulta del Nominatim simulado")
+    parser.add_argument('--latencia-sheets', type=float, default=LATENCIA_SHEETS,
+                        help="Segundos por escritura de la hoja simulada")
+    parser.add_argument('--tasa-geocodificacion', type=float, default=TASA_SOLICITUDES,
+                        help="Solicitudes por segundo permitidas al geocodificador (la política de Nominatim por defecto)")
+    parser.add_argument('--ganancia-minima', type=float, default=GANANCIA_MINIMA)
+    parser.add_argument('--objetivo-p95', type=float, default=OBJETIVO_P95,
+                        help="Segundos de espera por flujo tolerados en el percentil 95")
+    parser.add_argument('--semilla', type=int, default=0)
+    argumentos = parser.parse_args(argumentos)
+
+    resultados = probar(argumentos.manifiesto, argumentos.sesiones, argumentos.duracion, argumentos.pausa_escritura,
+                        argumentos.pausa_paso, argumentos.latencia_geocodificacion, argumentos.latencia_sheets,
+                        argumentos.tasa_geocodificacion, argumentos.ganancia_minima, argumentos.objetivo_p95,
+                        argumentos.semilla, argumentos.comparables)
+    os.makedirs(os.path.dirname(os.path.abspath(argumentos.salida)), exist_ok=True)
+    with open(argumentos.salida, 'w', encoding='utf-8') as archivo:
+        json.dump(resultados, archivo, indent=2, ensure_ascii=False)
+        archivo.write("\n")
+    logger.info(f"Resultados escritos en {argumentos.salida}")
+
+    saturacion = resultados['saturacion']
+    if saturacion['sesiones'] is None:
+        logger.info(f"Sin saturación hasta {saturacion['capacidad_sesiones']} sesiones")
+    else:
+        capacidad = saturacion['capacidad_sesiones'] or f"menos de {saturacion['sesiones']}"
+        logger.info(f"Saturación con {saturacion['sesiones']} sesiones ({saturacion['motivo']}); "
+                    f"capacidad por réplica: {capacidad} sesiones")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,336 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+from estimador import (CUANTILES_RANGO, DIRECTORIO_MODELOS, MODELOS_REQUERIDOS, Estimador, prefijo_modelos,
+                       validar_cuantiles)
+
+logger = logging.getLogger(__name__)
+
+RUTA_MANIFIESTO = os.path.join(DIRECTORIO_MODELOS, 'modelos.json')
+# Published copies of the artifacts, relative to the manifest directory
+DIRECTORIO_VERSIONES = 'versiones'
+INTERVALO_VIGILANCIA = 30.0
+
+
+class ErrorRegistro(Exception):
+    pass
+
+
+def sha256_archivo(ruta):
+    huella = hashlib.sha256()
+    with open(ruta, 'rb') as archivo:
+        for bloque in iter(lambda: archivo.read(1 << 20), b''):
+            huella.update(bloque)
+    return huella.hexdigest()
+
+
+def leer_manifiesto(ruta=RUTA_MANIFIESTO):
+    with open(ruta, encoding='utf-8') as archivo:
+        manifiesto = json.load(archivo)
+    if not isinstance(manifiesto.get('conjuntos'), dict):
+        raise ErrorRegistro(f"{ruta} no tiene una sección 'conjuntos'")
+    return manifiesto
+
+
+def validar_conjunto(tipo_propiedad, conjunto, directorio):
+    errores = []
+    artefactos = conjunto.get('artefactos', {})
+    if not conjunto.get('version'):
+        errores.append("sin versión")
+    try:
+        validar_cuantiles(conjunto.get('cuantiles', CUANTILES_RANGO))
+    except (TypeError, ValueError) as e:
+        errores.append(f"cuantiles: {str(e)}")
+    # A bundle holds the whole set; of the artifacts declared next to it only the sklearn forest
+    # is used, for large batches
+    requeridos = ['paquete'] if 'paquete' in artefactos else MODELOS_REQUERIDOS
+    faltantes = [nombre for nombre in requeridos if nombre not in artefactos]
+    if faltantes:
+        errores.append(f"artefactos no declarados: {', '.join(faltantes)}")
+    for nombre, artefacto in artefactos.items():
+        ruta = os.path.join(directorio, artefacto['archivo'])
+        if not os.path.exists(ruta):
+            errores.append(f"{nombre}: archivo no encontrado {artefacto['archivo']}")
+        elif artefacto.get('sha256') != sha256_archivo(ruta):
+            errores.append(f"{nombre}: la suma sha256 de {artefacto['archivo']} no coincide")
+    return errores
+
+
+def generar_manifiesto(directorio=DIRECTORIO_MODELOS, tipos=("Casa", "Departamento"), version=None,
+                       compilar=True):
+    # Declares every required artifact of each set, including the ones not present yet, so
+    # that validation reports them at startup instead of at request time. A set with a bundle
+    # is declared as that file, under the version recorded in the bundle, plus the sklearn forest
+    # it was built from, which serves large batches. Otherwise, with compilar, the forest is
+    # compiled when there is no current compiled copy, since only the compiled arrays can be
+    # shared through mmap
+    from bosque_compilado import ARCHIVO_COMPILADO, cargar_bosque_compilado, compilar_bosque
+    from paquete_modelos import ARCHIVO_PAQUETE, leer_cabecera
+
+    conjuntos = {}
+    for tipo_propiedad in tipos:
+        prefijo = prefijo_modelos(tipo_propiedad)
+        ruta_paquete = os.path.join(directorio, f"{prefijo}{ARCHIVO_PAQUETE}")
+        if os.path.exists(ruta_paquete):
+            artefactos = {'paquete': {'archivo': f"{prefijo}{ARCHIVO_PAQUETE}", 'sha256': sha256_archivo(ruta_paquete)}}
+            ruta_modelo = os.path.join(directorio, f"{prefijo}{MODELOS_REQUERIDOS['modelo']}")
+            if os.path.exists(ruta_modelo):
+                artefactos['modelo'] = {'archivo': f"{prefijo}{MODELOS_REQUERIDOS['modelo']}",
+                                        'sha256': sha256_archivo(ruta_modelo)}
+            conjuntos[tipo_propiedad] = {
+                'version': version or leer_cabecera(ruta_paquete)[0]['version'],
+                'artefactos': artefactos,
+            }
+            continue
+        archivos = dict(MODELOS_REQUERIDOS)
+        if (compilar and os.path.exists(os.path.join(directorio, f"{prefijo}{MODELOS_REQUERIDOS['modelo']}"))
+                and cargar_bosque_compilado(tipo_propiedad, directorio) is None):
+            compilar_bosque(tipo_propiedad, directorio)
+            logger.info(f"Bosque de {tipo_propiedad} compilado")
+        if os.path.exists(os.path.join(directorio, f"{prefijo}{ARCHIVO_COMPILADO}")):
+            archivos['bosque_compilado'] = ARCHIVO_COMPILADO
+        artefactos = {}
+        for nombre, archivo in archivos.items():
+            ruta = os.path.join(directorio, f"{prefijo}{archivo}")
+            artefactos[nombre] = {
+                'archivo': f"{prefijo}{archivo}",
+                'sha256': sha256_archivo(ruta) if os.path.exists(ruta) else None,
+            }
+        huella = hashlib.sha256(json.dumps(artefactos, sort_keys=True).encode()).hexdigest()[:12]
+        conjuntos[tipo_propiedad] = {'version': version or huella, 'artefactos': artefactos}
+    return {'conjuntos': conjuntos}
+
+
+def publicar_artefactos(manifiesto, directorio=DIRECTORIO_MODELOS):
+    # Points every declared artifact at a copy named after its sha256 under DIRECTORIO_VERSIONES.
+    # Published files are never written again, so retraining over the working file names cannot
+    # change pages that running processes have mapped, and replacing modelos.json is the only
+    # switch between versions. The sum recorded is the one of the copy
+    destino = os.path.join(directorio, DIRECTORIO_VERSIONES)
+    os.makedirs(destino, exist_ok=True)
+    for conjunto in manifiesto['conjuntos'].values():
+        for artefacto in conjunto['artefactos'].values():
+            origen = os.path.join(directorio, artefacto['archivo'])
+            if not os.path.exists(origen):
+                continue
+            temporal = os.path.join(destino, f".{os.path.basename(artefacto['archivo'])}.tmp")
+            shutil.copyfile(origen, temporal)
+            suma = sha256_archivo(temporal)
+            nombre = f"{suma[:12]}-{os.path.basename(artefacto['archivo'])}"
+            if os.path.exists(os.path.join(destino, nombre)):
+                os.remove(temporal)
+            else:
+                os.replace(temporal, os.path.join(destino, nombre))
+            artefacto['archivo'] = f"{DIRECTORIO_VERSIONES}/{nombre}"
+            artefacto['sha256'] = suma
+    return manifiesto
+
+
+def limpiar_versiones(manifiestos, directorio=DIRECTORIO_MODELOS):
+    # Removes the published copies no manifest in manifiestos refers to. Processes that still
+    # map a removed file keep reading it until they let it go
+    directorio_versiones = os.path.join(directorio, DIRECTORIO_VERSIONES)
+    if not os.path.isdir(directorio_versiones):
+        return []
+    en_uso = {os.path.normpath(os.path.join(directorio, artefacto['archivo']))
+              for manifiesto in manifiestos for conjunto in manifiesto['conjuntos'].values()
+              for artefacto in conjunto['artefactos'].values()}
+    eliminados = []
+    for nombre in sorted(os.listdir(directorio_versiones)):
+        ruta = os.path.normpath(os.path.join(directorio_versiones, nombre))
+        if ruta not in en_uso and not nombre.startswith('.'):
+            os.remove(ruta)
+            eliminados.append(nombre)
+    return eliminados
+
+
+class RegistroModelos:
+    # Named model sets described by a manifest (modelos.json) with versions and sha256 sums.
+    # Arrays are loaded with mmap_mode='r' so processes that load the same files share the
+    # pages. That holds for the compiled forest, which replaces the sklearn one when the manifest
+    # lists it, and for bundles; a plain sklearn forest copies its node arrays when unpickled, so
+    # only its small scaler and KMeans arrays stay mapped. A set declared with a "paquete" is
+    # mapped from that file; sklearn is only loaded for its first large batch. A set may also
+    # declare the "cuantiles" of the tree predictions that bound its price range.
+    # recargar() builds the new Estimador objects first and then swaps the whole mapping in one
+    # assignment: requests already holding the previous Estimador finish with it. With calentar,
+    # every set runs one estimate as soon as it is loaded, so no request pays for the first one
+    def __init__(self, ruta_manifiesto=RUTA_MANIFIESTO, mmap=True, tipos=None, calentar=False):
+        self.ruta_manifiesto = ruta_manifiesto
+        # Restricts loading to some of the declared sets, e.g. to measure one in isolation
+        self.tipos = None if tipos is None else set(tipos)
+        self.directorio = os.path.dirname(os.path.abspath(ruta_manifiesto))
+        self.mmap_mode = 'r' if mmap else None
+        self.calentar = calentar
+        self.errores = {}
+        self._estimadores = {}
+        self._estado_manifiesto = None
+        self._candado_recarga = threading.Lock()
+        self._detener = threading.Event()
+
+    def validar(self):
+        manifiesto = leer_manifiesto(self.ruta_manifiesto)
+        return {
+            tipo_propiedad: validar_conjunto(tipo_propiedad, conjunto, self.directorio)
+            for tipo_propiedad, conjunto in manifiesto['conjuntos'].items()
+        }
+
+    def cargar(self, estricto=False):
+        with self._candado_recarga:
+            estado = os.stat(self.ruta_manifiesto).st_mtime_ns
+            manifiesto = leer_manifiesto(self.ruta_manifiesto)
+            estimadores, errores = {}, {}
+            for tipo_propiedad, conjunto in manifiesto['conjuntos'].items():
+                if self.tipos is not None and tipo_propiedad not in self.tipos:
+                    continue
+                actual = self._estimadores.get(tipo_propiedad)
+                errores_conjunto = validar_conjunto(tipo_propiedad, conjunto, self.directorio)
+                if not errores_conjunto:
+                    cuantiles = validar_cuantiles(conjunto.get('cuantiles', CUANTILES_RANGO))
+                    if actual is not None and actual.version == conjunto['version'] and actual.cuantiles == cuantiles:
+                        estimadores[tipo_propiedad] = actual
+                        continue
+                    inicio = time.perf_counter()
+                    try:
+                        estimadores[tipo_propiedad] = self._cargar_conjunto(tipo_propiedad, conjunto)
+                        if self.calentar:
+                            estimadores[tipo_propiedad].calentar()
+                        logger.info(f"Conjunto de modelos {tipo_propiedad} versión {conjunto['version']} cargado "
+                                    f"en {(time.perf_counter() - inicio) * 1000:.0f} ms")
+                        continue
+                    except Exception as e:
+                        estimadores.pop(tipo_propiedad, None)
+                        errores_conjunto = [f"error al cargar: {str(e)}"]
+
+                # An invalid set that was already loaded keeps serving its previous version
+                errores[tipo_propiedad] = errores_conjunto
+                if actual is not None:
+                    estimadores[tipo_propiedad] = actual
+                    logger.warning(f"Conjunto de modelos {tipo_propiedad} inválido, se mantiene la versión "
+                                   f"{actual.version}: {'; '.join(errores_conjunto)}")
+                else:
+                    logger.error(f"Conjunto de modelos {tipo_propiedad} inválido: {'; '.join(errores_conjunto)}")
+
+            if estricto and errores:
+                raise ErrorRegistro(f"Conjuntos de modelos inválidos: {', '.join(errores)}")
+            self._estimadores = estimadores
+            self.errores = errores
+            self._estado_manifiesto = estado
+        return self
+
+    # Reloading is the same operation: unchanged versions keep their loaded Estimador
+    recargar = cargar
+
+    def _cargar_conjunto(self, tipo_propiedad, conjunto):
+        artefactos = conjunto['artefactos']
+        cuantiles = conjunto.get('cuantiles', CUANTILES_RANGO)
+        if 'paquete' in artefactos:
+            from paquete_modelos import cargar_paquete
+
+            modelos, _ = cargar_paquete(os.path.join(self.directorio, artefactos['paquete']['archivo']),
+                                        mmap=self.mmap_mode is not None)
+            if 'modelo' in artefactos:
+                import joblib
+
+                if modelos['modelo'].huella_origen != artefactos['modelo']['sha256']:
+                    raise ValueError("el paquete se construyó a partir de otro bosque")
+                ruta_modelo = os.path.join(self.directorio, artefactos['modelo']['archivo'])
+                modelos['modelo'].cargar_lotes = lambda: joblib.load(ruta_modelo)
+            else:
+                logger.warning(f"El paquete de {tipo_propiedad} no declara el bosque de sklearn; los lotes "
+                               f"usarán el recorrido compilado, varias veces más lento")
+            return Estimador(tipo_propiedad, modelos, conjunto['version'], cuantiles)
+
+        import joblib
+
+        modelos = {}
+        for nombre, artefacto in artefactos.items():
+            if nombre == 'modelo' and 'bosque_compilado' in artefactos:
+                continue
+            ruta = os.path.join(self.directorio, artefacto['archivo'])
+            if nombre == 'bosque_compilado':
+                from bosque_compilado import BosqueCompilado
+
+                modelos['modelo'] = BosqueCompilado.cargar(ruta, artefactos['modelo']['sha256'], self.mmap_mode)
+                # Large batches use the sklearn forest, loaded only when the first one arrives
+                ruta_modelo = os.path.join(self.directorio, artefactos['modelo']['archivo'])
+                modelos['modelo'].cargar_lotes = lambda ruta_modelo=ruta_modelo: joblib.load(ruta_modelo)
+            else:
+                modelos[nombre] = joblib.load(ruta, mmap_mode=self.mmap_mode)
+        return Estimador(tipo_propiedad, modelos, conjunto['version'], cuantiles)
+
+    def obtener(self, tipo_propiedad):
+        estimador = self._estimadores.get(tipo_propiedad)
+        if estimador is None:
+            detalle = "; ".join(self.errores.get(tipo_propiedad, ["no declarado en el manifiesto"]))
+            raise ErrorRegistro(f"Modelo no disponible para {tipo_propiedad}: {detalle}")
+        return estimador
+
+    def disponibles(self):
+        return sorted(self._estimadores)
+
+    def versiones(self):
+        return {tipo_propiedad: estimador.version for tipo_propiedad, estimador in self._estimadores.items()}
+
+    def vigilar(self, intervalo=INTERVALO_VIGILANCIA):
+        # Polls the manifest and reloads when it changes; a failed reload keeps the current sets
+        def revisar():
+            while not self._detener.wait(intervalo):
+                try:
+                    if os.stat(self.ruta_manifiesto).st_mtime_ns != self._estado_manifiesto:
+                        self.recargar()
+                except Exception as e:
+                    logger.error(f"Error al recargar el registro de modelos: {str(e)}")
+
+        hilo = threading.Thread(target=revisar, name="registro-modelos", daemon=True)
+        hilo.start()
+        return hilo
+
+    def detener(self):
+        self._detener.set()
+
+
+def main(argumentos=None):
+    parser = argparse.ArgumentParser(description="Genera y valida el manifiesto de conjuntos de modelos.")
+    parser.add_argument('comando', choices=['generar', 'validar'])
+    parser.add_argument('--manifiesto', default=RUTA_MANIFIESTO)
+    parser.add_argument('--version', help="Versión para todos los conjuntos (por defecto, huella de las sumas)")
+    parser.add_argument('--sin-compilar', action='store_true',
+                        help="No compila los bosques que no tengan una copia compilada vigente")
+    argumentos = parser.parse_args(argumentos)
+
+    if argumentos.comando == 'generar':
+        directorio = os.path.dirname(os.path.abspath(argumentos.manifiesto))
+        anterior = leer_manifiesto(argumentos.manifiesto) if os.path.exists(argumentos.manifiesto) else None
+        manifiesto = publicar_artefactos(
+            generar_manifiesto(directorio, version=argumentos.version, compilar=not argumentos.sin_compilar),
+            directorio)
+        temporal = argumentos.manifiesto + '.tmp'
+        with open(temporal, 'w', encoding='utf-8') as archivo:
+            json.dump(manifiesto, archivo, indent=2, ensure_ascii=False)
+            archivo.write("\n")
+        # The registry may be watching the manifest, so it is replaced in one step
+        os.replace(temporal, argumentos.manifiesto)
+        logger.info(f"Manifiesto escrito en {argumentos.manifiesto}")
+        # The previous version stays published for processes that have not reloaded yet
+        eliminados = limpiar_versiones([manifiesto] + ([anterior] if anterior else []), directorio)
+        if eliminados:
+            logger.info(f"Copias sin uso eliminadas: {', '.join(eliminados)}")
+
+    errores = RegistroModelos(argumentos.manifiesto).validar()
+    for tipo_propiedad, errores_conjunto in errores.items():
+        estado = "; ".join(errores_conjunto) if errores_conjunto else "correcto"
+        logger.info(f"{tipo_propiedad}: {estado}")
+    if argumentos.comando == 'validar' and any(errores.values()):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,341 @@
+import argparse
+import importlib
+import json
+import logging
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from estimador import agregar_caracteristica_grupo, predecir_precio, preprocesar_datos
+from geocodificacion import CacheGeocodificacion, ClienteGeocodificacion, GeocodificadorCacheado, LimitadorTasa
+from prospectos import AlmacenSheets, EscritorProspectos
+from registro_modelos import RUTA_MANIFIESTO, RegistroModelos
+from simulados import GeocodificadorSimulado, ServicioSheetsSimulado, generar_direcciones
+
+logger = logging.getLogger(__name__)
+
+# Offline benchmark of the estimation hot path. Geocoding and Google Sheets are replaced by the
+# stand-ins of simulados.py and every input comes from a fixed seed, so two runs on the same
+# machine measure the same work. Results are a flat {metric: value} mapping that can be stored
+# as a baseline and compared against later runs.
+# The committed baseline is rendimiento_base.json, which 'medir' compares against by default. It
+# is produced on the reference machine with `python rendimiento.py medir --salida
+# rendimiento_base.json` and committed together with the change that moves the numbers
+
+RUTA_RESULTADOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'rendimiento.json')
+RUTA_BASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rendimiento_base.json')
+# Imported before the model set is loaded, see medir_proceso
+MODULOS_PESADOS = ('joblib', 'numpy', 'pandas', 'sklearn.ensemble')
+MUESTRAS = 2000
+CALENTAMIENTO = 50
+TAMANOS_LOTE = [1, 64, 1024, 16384]
+TIEMPO_MINIMO_LOTE = 0.5
+PROSPECTOS = 500
+TOLERANCIA = 0.10
+# Metrics with these suffixes improve when they grow; every other metric is a time or a size
+SUFIJOS_MAYOR_ES_MEJOR = ('por_segundo',)
+
+
+def percentil(valores_ordenados, fraccion):
+    # Nearest-rank percentile of an already sorted list
+    return valores_ordenados[max(0, math.ceil(fraccion * len(valores_ordenados)) - 1)]
+
+
+def resumir(segundos, prefijo):
+    ordenados = sorted(segundos)
+    return {
+        f"{prefijo}.p50_ms": percentil(ordenados, 0.50) * 1000,
+        f"{prefijo}.p95_ms": percentil(ordenados, 0.95) * 1000,
+        f"{prefijo}.p99_ms": percentil(ordenados, 0.99) * 1000,
+        f"{prefijo}.media_ms": sum(ordenados) / len(ordenados) * 1000,
+    }
+
+
+def cronometrar(funcion, argumentos, calentamiento=CALENTAMIENTO):
+    for argumento in argumentos[:calentamiento]:
+        funcion(*argumento)
+    segundos = []
+    for argumento in argumentos:
+        inicio = time.perf_counter()
+        funcion(*argumento)
+        segundos.append(time.perf_counter() - inicio)
+    return segundos
+
+
+def propiedades_muestra(n_propiedades, semilla=0):
+    # (latitud, longitud, terreno, construccion, habitaciones, banos) around the simulated addresses
+    aleatorio = random.Random(semilla)
+    direcciones = generar_direcciones()
+    propiedades = []
+    for _ in range(n_propiedades):
+        _, latitud, longitud = aleatorio.choice(direcciones)
+        propiedades.append((latitud + aleatorio.uniform(-0.01, 0.01), longitud + aleatorio.uniform(-0.01, 0.01),
+                            float(aleatorio.randint(60, 600)), float(aleatorio.randint(45, 450)),
+                            float(aleatorio.randint(1, 5)), float(aleatorio.randint(1, 4))))
+    return propiedades
+
+
+def lote_muestra(n_filas, semilla=0):
+    import numpy as np
+
+    generador = np.random.default_rng(semilla)
+    return {
+        'Latitud': generador.uniform(19.0, 26.0, n_filas),
+        'Longitud': generador.uniform(-104.0, -89.0, n_filas),
+        'Terreno': generador.integers(60, 601, n_filas).astype(np.float64),
+        'Construccion': generador.integers(45, 451, n_filas).astype(np.float64),
+        'Habitaciones': generador.integers(1, 6, n_filas).astype(np.float64),
+        'Banos': generador.integers(1, 5, n_filas).astype(np.float64),
+    }
+
+
+def pico_rss_mb():
+    import resource
+
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return pico / (1024 * 1024) if sys.platform == 'darwin' else pico / 1024
+
+
+def medir_proceso(tipo_propiedad, manifiesto, mmap=True):
+    # Runs in a fresh interpreter: the heavy libraries are imported first so that the RSS
+    # growth afterwards belongs to the model set itself
+    for modulo in MODULOS_PESADOS:
+        importlib.import_module(modulo)
+
+    rss_base = pico_rss_mb()
+    inicio = time.perf_counter()
+    estimador = RegistroModelos(manifiesto, mmap=mmap, tipos=[tipo_propiedad]).cargar().obtener(tipo_propiedad)
+    carga = time.perf_counter() - inicio
+    inicio = time.perf_counter()
+    estimador.estimar(*propiedades_muestra(1)[0])
+    primera = time.perf_counter() - inicio
+    return {
+        'carga_s': carga,
+        'primera_estimacion_ms': primera * 1000,
+        'rss_base_mb': rss_base,
+        'rss_pico_mb': pico_rss_mb(),
+    }
+
+
+def medir_arranque(tipo_propiedad, manifiesto, mmap=True):
+    comando = [sys.executable, os.path.abspath(__file__), 'proceso', '--tipo', tipo_propiedad,
+               '--manifiesto', manifiesto]
+    if not mmap:
+        comando.append('--sin-mmap')
+    inicio = time.perf_counter()
+    salida = subprocess.run(comando, check=True, capture_output=True, text=True).stdout
+    total = time.perf_counter() - inicio
+    resultado = json.loads(salida.strip().splitlines()[-1])
+    metricas = {f"{tipo_propiedad}.arranque.{nombre}": valor for nombre, valor in resultado.items()}
+    metricas[f"{tipo_propiedad}.arranque.total_s"] = total
+    metricas[f"{tipo_propiedad}.rss_modelos_mb"] = resultado['rss_pico_mb'] - resultado['rss_base_mb']
+    return metricas
+
+
+def medir_estimacion(estimador, muestras=MUESTRAS, semilla=0):
+    # Warm per-stage latencies of the single-estimate path used by the wizard
+    modelos = estimador.modelos
+    propiedades = propiedades_muestra(muestras, semilla)
+    procesados = [(preprocesar_datos(*propiedad, modelos),) for propiedad in propiedades]
+    etapas = {
+        'agrupar': (lambda latitud, longitud, *_: agregar_caracteristica_grupo(latitud, longitud, modelos), propiedades),
+        'preprocesar': (lambda *propiedad: preprocesar_datos(*propiedad, modelos), propiedades),
+        'predecir': (lambda datos: predecir_precio(datos, modelos), procesados),
+        'estimar': (estimador.estimar, propiedades),
+    }
+    metricas = {}
+    for etapa, (funcion, argumentos) in etapas.items():
+        metricas.update(resumir(cronometrar(funcion, argumentos), f"{estimador.tipo_propiedad}.caliente.{etapa}"))
+    return metricas
+
+
+def medir_lotes(estimador, tamanos=TAMANOS_LOTE, semilla=0):
+    metricas = {}
+    for tamano in tamanos:
+        entradas = lote_muestra(tamano, semilla)
+        estimador.estimar_lote(entradas)
+        segundos = []
+        while len(segundos) < 3 or sum(segundos) < TIEMPO_MINIMO_LOTE:
+            inicio = time.perf_counter()
+            estimador.estimar_lote(entradas)
+            segundos.append(time.perf_counter() - inicio)
+        mediana = sorted(segundos)[len(segundos) // 2]
+        metricas[f"{estimador.tipo_propiedad}.lote.{tamano}.filas_por_segundo"] = tamano / mediana
+    return metricas
+
+
+def medir_geocodificacion(latencia=0.0, semilla=0):
+    # Cold: every address misses the cache and reaches the simulated geocoder; warm: the same
+    # addresses again, answered from the in-memory cache
+    simulado = GeocodificadorSimulado(latencia=latencia, semilla=semilla)
+    geocodificador = GeocodificadorCacheado(
+        ClienteGeocodificacion(simulado, LimitadorTasa(tasa=1e9, capacidad=1e9)),
+        CacheGeocodificacion(ruta=None)
+    )
+    direcciones = [(direccion,) for direccion, _, _ in simulado.direcciones]
+    random.Random(semilla).shuffle(direcciones)
+    metricas = resumir(cronometrar(geocodificador.geocode, direcciones, calentamiento=0), "geocodificacion.fria")
+    metricas.update(resumir(cronometrar(geocodificador.geocode, direcciones, calentamiento=0), "geocodificacion.caliente"))
+    return metricas
+
+
+def medir_prospectos(n_prospectos=PROSPECTOS, latencia=0.0):
+    # encolar() is what the results page waits for; drenado is the time until the background
+    # writer has delivered every row to the simulated sheet
+    with tempfile.TemporaryDirectory() as directorio:
+        servicio = ServicioSheetsSimulado(latencia=latencia)
+        escritor = EscritorProspectos(AlmacenSheets(lambda: servicio, "simulado", "Hoja 1"),
+                                      ruta_spool=os.path.join(directorio, 'spool.jsonl'), intervalo=0.05)
+        prospectos = []
+        for indice, propiedad in enumerate(propiedades_muestra(n_prospectos)):
+            _, _, terreno, construccion, habitaciones, banos = propiedad
+            prospectos.append(({
+                'tipo_propiedad': "Casa", 'direccion': f"Calle Principal {indice}, Ciudad de México",
+                'terreno': terreno, 'construccion': construccion, 'habitaciones': habitaciones, 'banos': banos,
+                'nombre': f"Prospecto {indice}", 'correo': f"prospecto{indice}@ejemplo.com",
+                'telefono': "5555555555", 'interes_venta': "Sí", 'precio_estimado': 1000000,
+                'id_envio': str(indice),
+            },))
+        inicio = time.perf_counter()
+        metricas = resumir(cronometrar(escritor.encolar, prospectos, calentamiento=0), "prospectos.encolar")
+        while escritor.pendientes() and time.perf_counter() - inicio < 60:
+            time.sleep(0.005)
+        metricas["prospectos.drenado_s"] = time.perf_counter() - inicio
+        escritor.detener()
+    return metricas
+
+
+def entorno():
+    versiones = {}
+    for modulo in ('numpy', 'pandas', 'sklearn', 'joblib'):
+        try:
+            versiones[modulo] = __import__(modulo).__version__
+        except ImportError:
+            versiones[modulo] = None
+    return {
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'procesadores': os.cpu_count(),
+        'versiones': versiones,
+    }
+
+
+def medir(manifiesto=RUTA_MANIFIESTO, muestras=MUESTRAS, tamanos=TAMANOS_LOTE, mmap=True,
+          latencia_geocodificacion=0.0, latencia_sheets=0.0, semilla=0):
+    registro = RegistroModelos(manifiesto, mmap=mmap).cargar()
+    metricas = {}
+    for tipo_propiedad in registro.disponibles():
+        logger.info(f"Midiendo {tipo_propiedad}")
+        metricas.update(medir_arranque(tipo_propiedad, manifiesto, mmap))
+        estimador = registro.obtener(tipo_propiedad)
+        metricas.update(medir_estimacion(estimador, muestras, semilla))
+        metricas.update(medir_lotes(estimador, tamanos, semilla))
+    logger.info("Midiendo geocodificación y prospectos")
+    metricas.update(medir_geocodificacion(latencia_geocodificacion, semilla))
+    metricas.update(medir_prospectos(latencia=latencia_sheets))
+    return {
+        'entorno': entorno(),
+        'parametros': {'muestras': muestras, 'tamanos': list(tamanos), 'mmap': mmap, 'semilla': semilla,
+                       'versiones_modelos': registro.versiones(), 'errores_modelos': registro.errores},
+        'metricas': metricas,
+    }
+
+
+def comparar(actual, base, tolerancia=TOLERANCIA):
+    # One row per baseline metric: (metrica, base, actual, cambio relativo, estado)
+    filas = []
+    for metrica, valor_base in sorted(base['metricas'].items()):
+        valor = actual['metricas'].get(metrica)
+        if valor is None:
+            filas.append((metrica, valor_base, None, None, "ausente"))
+            continue
+        if not valor_base:
+            filas.append((metrica, valor_base, valor, None, "sin referencia"))
+            continue
+        cambio = valor / valor_base - 1
+        mejora = cambio if metrica.endswith(SUFIJOS_MAYOR_ES_MEJOR) else -cambio
+        estado = "regresión" if mejora < -tolerancia else "mejora" if mejora > tolerancia else "igual"
+        filas.append((metrica, valor_base, valor, cambio, estado))
+    return filas
+
+
+def informar(filas, actual, base):
+    if actual['entorno'] != base['entorno']:
+        logger.warning("La línea base se midió en otro entorno; las diferencias pueden no deberse al código")
+    for metrica, valor_base, valor, cambio, estado in filas:
+        if cambio is None:
+            logger.info(f"{metrica}: {estado}")
+        else:
+            logger.info(f"{metrica}: {valor_base:.4g} -> {valor:.4g} ({cambio:+.1%}) {estado}")
+    regresiones = [fila[0] for fila in filas if fila[4] == "regresión"]
+    if regresiones:
+        logger.error(f"{len(regresiones)} regresiones: {', '.join(regresiones)}")
+    return regresiones
+
+
+def leer_resultados(ruta):
+    with open(ruta, encoding='utf-8') as archivo:
+        return json.load(archivo)
+
+
+def main(argumentos=None):
+    parser = argparse.ArgumentParser(description="Pruebas de rendimiento del estimador sin servicios externos.")
+    subcomandos = parser.add_subparsers(dest='comando', required=True)
+    medicion = subcomandos.add_parser('medir', help="Mide latencias, rendimiento por lotes y memoria")
+    medicion.add_argument('--manifiesto', default=RUTA_MANIFIESTO)
+    medicion.add_argument('--salida', default=RUTA_RESULTADOS)
+    medicion.add_argument('--base', default=RUTA_BASE if os.path.exists(RUTA_BASE) else None,
+                          help="Resultados anteriores contra los que comparar (por defecto la línea base versionada)")
+    medicion.add_argument('--tolerancia', type=float, default=TOLERANCIA)
+    medicion.add_argument('--muestras', type=int, default=MUESTRAS)
+    medicion.add_argument('--tamanos', type=int, nargs='+', default=TAMANOS_LOTE)
+    medicion.add_argument('--sin-mmap', action='store_true')
+    medicion.add_argument('--latencia-geocodificacion', type=float, default=0.0,
+                          help="Segundos por consulta del geocodificador simulado")
+    medicion.add_argument('--latencia-sheets', type=float, default=0.0,
+                          help="Segundos por escritura de la hoja simulada")
+    comparacion = subcomandos.add_parser('comparar', help="Compara dos archivos de resultados")
+    comparacion.add_argument('actual')
+    comparacion.add_argument('base')
+    comparacion.add_argument('--tolerancia', type=float, default=TOLERANCIA)
+    # Used by 'medir' to load one model set in a fresh interpreter
+    proceso = subcomandos.add_parser('proceso', help="Carga un conjunto en este proceso y reporta su memoria")
+    proceso.add_argument('--tipo', required=True)
+    proceso.add_argument('--manifiesto', default=RUTA_MANIFIESTO)
+    proceso.add_argument('--sin-mmap', action='store_true')
+    argumentos = parser.parse_args(argumentos)
+
+    if argumentos.comando == 'proceso':
+        print(json.dumps(medir_proceso(argumentos.tipo, argumentos.manifiesto, not argumentos.sin_mmap)))
+        return
+
+    if argumentos.comando == 'comparar':
+        actual, base = leer_resultados(argumentos.actual), leer_resultados(argumentos.base)
+    else:
+        # Read first, since --salida may be the baseline being refreshed
+        base = leer_resultados(argumentos.base) if argumentos.base else None
+        actual = medir(argumentos.manifiesto, argumentos.muestras, argumentos.tamanos, not argumentos.sin_mmap,
+                       argumentos.latencia_geocodificacion, argumentos.latencia_sheets)
+        os.makedirs(os.path.dirname(os.path.abspath(argumentos.salida)), exist_ok=True)
+        with open(argumentos.salida, 'w', encoding='utf-8') as archivo:
+            json.dump(actual, archivo, indent=2, ensure_ascii=False)
+            archivo.write("\n")
+        logger.info(f"Resultados escritos en {argumentos.salida}")
+        if base is None:
+            for metrica, valor in sorted(actual['metricas'].items()):
+                logger.info(f"{metrica}: {valor:.4g}")
+            return
+
+    if informar(comparar(actual, base, argumentos.tolerancia), actual, base):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,163 @@
+import argparse
+import collections
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from estimador import COLUMNAS_ENTRADA
+from registro_modelos import RUTA_MANIFIESTO, ErrorRegistro, RegistroModelos
+
+logger = logging.getLogger(__name__)
+
+# Portfolio re-valuation: the input is read in blocks, each block is estimated in a worker
+# process and the results are written back in input order as soon as they are ready. At most
+# BLOQUES_EN_VUELO blocks per worker are in memory at any time, whatever the input size.
+# Workers load the models themselves through the registry with mmap, so the arrays are shared
+# through the page cache instead of being pickled to every process
+
+FILAS_POR_BLOQUE = 50000
+BLOQUES_EN_VUELO = 2
+
+_estimador = None
+
+
+def _iniciar_trabajador(ruta_manifiesto, tipo_propiedad):
+    global _estimador
+
+    _estimador = RegistroModelos(ruta_manifiesto, mmap=True, tipos=[tipo_propiedad]).cargar(
+        estricto=True).obtener(tipo_propiedad)
+    # Parallelism comes from the processes; a forest fitted with n_jobs would oversubscribe the cores
+    if hasattr(_estimador.modelos['modelo'], 'n_jobs'):
+        _estimador.modelos['modelo'].n_jobs = 1
+
+
+def _estimar_bloque(entradas):
+    return _estimador.estimar_lote(entradas)
+
+
+def leer_bloques(ruta, filas_por_bloque=FILAS_POR_BLOQUE):
+    import pandas as pd
+
+    if ruta.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        for lote in pq.ParquetFile(ruta).iter_batches(batch_size=filas_por_bloque):
+            yield lote.to_pandas()
+    else:
+        yield from pd.read_csv(ruta, chunksize=filas_por_bloque)
+
+
+class EscritorIncremental:
+    # Appends blocks to a CSV or Parquet file; the header or schema comes from the first block
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.temporal = ruta + '.tmp'
+        self.filas = 0
+        self._parquet = None
+        self._primero = True
+
+    def escribir(self, tabla):
+        if self.ruta.endswith('.parquet'):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            lote = pa.Table.from_pandas(tabla, preserve_index=False)
+            if self._parquet is None:
+                self._parquet = pq.ParquetWriter(self.temporal, lote.schema)
+            self._parquet.write_table(lote.cast(self._parquet.schema))
+        else:
+            tabla.to_csv(self.temporal, mode='w' if self._primero else 'a', header=self._primero, index=False)
+        self._primero = False
+        self.filas += len(tabla)
+
+    def cerrar(self, completo=True):
+        # The output only appears under its final name once it is complete
+        if self._parquet is not None:
+            self._parquet.close()
+        if self._primero:
+            return
+        if completo:
+            os.replace(self.temporal, self.ruta)
+        else:
+            os.remove(self.temporal)
+
+
+def _agregar_resultados(bloque, resultados):
+    import pandas as pd
+
+    precios, minimos, maximos = resultados
+    bloque['precio_estimado'] = pd.Series(precios, index=bloque.index).astype('Int64')
+    bloque['precio_minimo'] = pd.Series(minimos, index=bloque.index).astype('Int64')
+    bloque['precio_maximo'] = pd.Series(maximos, index=bloque.index).astype('Int64')
+    return bloque
+
+
+def revaluar(entrada, salida, tipo_propiedad, ruta_manifiesto=RUTA_MANIFIESTO, procesos=None,
+             filas_por_bloque=FILAS_POR_BLOQUE, bloques_en_vuelo=BLOQUES_EN_VUELO):
+    procesos = procesos or os.cpu_count() or 1
+    # Checked once here so that an invalid set fails fast instead of breaking every worker
+    errores = RegistroModelos(ruta_manifiesto).validar().get(tipo_propiedad, ["no declarado en el manifiesto"])
+    if errores:
+        raise ErrorRegistro(f"Modelo no disponible para {tipo_propiedad}: {'; '.join(errores)}")
+    escritor = EscritorIncremental(salida)
+    inicio = time.perf_counter()
+
+    def escribir(bloque, resultados):
+        escritor.escribir(_agregar_resultados(bloque, resultados))
+        logger.info(f"{escritor.filas} propiedades revaluadas "
+                    f"({escritor.filas / (time.perf_counter() - inicio):,.0f} por segundo)")
+
+    def validar(bloque):
+        faltantes = [columna for columna in COLUMNAS_ENTRADA if columna not in bloque.columns]
+        if faltantes:
+            raise ValueError(f"Columnas faltantes en {entrada}: {', '.join(faltantes)}")
+        return {columna: bloque[columna].to_numpy() for columna in COLUMNAS_ENTRADA}
+
+    completo = False
+    try:
+        if procesos == 1:
+            _iniciar_trabajador(ruta_manifiesto, tipo_propiedad)
+            for bloque in leer_bloques(entrada, filas_por_bloque):
+                escribir(bloque, _estimar_bloque(validar(bloque)))
+        else:
+            with ProcessPoolExecutor(procesos, initializer=_iniciar_trabajador,
+                                     initargs=(ruta_manifiesto, tipo_propiedad)) as ejecutor:
+                # Futures are consumed in submission order, so the output keeps the input order and
+                # reading pauses while the oldest block is still being estimated
+                en_vuelo = collections.deque()
+                for bloque in leer_bloques(entrada, filas_por_bloque):
+                    en_vuelo.append((bloque, ejecutor.submit(_estimar_bloque, validar(bloque))))
+                    if len(en_vuelo) >= procesos * bloques_en_vuelo:
+                        bloque, futuro = en_vuelo.popleft()
+                        escribir(bloque, futuro.result())
+                while en_vuelo:
+                    bloque, futuro = en_vuelo.popleft()
+                    escribir(bloque, futuro.result())
+        completo = True
+    finally:
+        escritor.cerrar(completo)
+    return escritor.filas
+
+
+def main(argumentos=None):
+    parser = argparse.ArgumentParser(description="Revalúa una cartera de propiedades en paralelo.")
+    parser.add_argument('entrada', help="Archivo CSV o Parquet con columnas " + ", ".join(COLUMNAS_ENTRADA))
+    parser.add_argument('salida', help="Archivo CSV o Parquet de resultados")
+    parser.add_argument('--tipo', choices=["Casa", "Departamento"], default="Casa")
+    parser.add_argument('--manifiesto', default=RUTA_MANIFIESTO)
+    parser.add_argument('--procesos', type=int, help="Procesos de estimación (por defecto, uno por núcleo)")
+    parser.add_argument('--filas-por-bloque', type=int, default=FILAS_POR_BLOQUE)
+    parser.add_argument('--bloques-en-vuelo', type=int, default=BLOQUES_EN_VUELO,
+                        help="Bloques pendientes por proceso; limita la memoria usada")
+    argumentos = parser.parse_args(argumentos)
+
+    inicio = time.perf_counter()
+    filas = revaluar(argumentos.entrada, argumentos.salida, argumentos.tipo, argumentos.manifiesto,
+                     argumentos.procesos, argumentos.filas_por_bloque, argumentos.bloques_en_vuelo)
+    logger.info(f"{filas} propiedades escritas en {argumentos.salida} en {time.perf_counter() - inicio:.1f} s")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,263 @@
+import argparse
+import asyncio
+import logging
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+from estimador import COLUMNAS_ENTRADA
+from instrumentacion import METRICAS, TIPO_CONTENIDO
+from registro_modelos import RUTA_MANIFIESTO, RegistroModelos
+
+logger = logging.getLogger(__name__)
+
+CAMPOS_PROPIEDAD = ['latitud', 'longitud', 'terreno', 'construccion', 'habitaciones', 'banos']
+
+FILAS_POR_LOTE = 512
+ESPERA_LOTE = 0.002
+HILOS_INFERENCIA = 4
+MAXIMO_LOTE_HTTP = 10000
+# Rows admitted and not yet estimated, per property type
+CAPACIDAD_FILAS = 4 * MAXIMO_LOTE_HTTP
+
+FILAS_POR_LOTE_SERVIDO = METRICAS.histograma('servicio_filas_por_lote', "Filas de cada lote enviado al modelo",
+                                             ('tipo_propiedad',), limites=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512,
+                                                                           1024, 4096, 10000))
+RECHAZOS = METRICAS.contador('servicio_rechazos_total', "Solicitudes rechazadas por exceder las filas pendientes",
+                             ('tipo_propiedad',))
+
+
+class ColaLlena(Exception):
+    pass
+
+
+class AgrupadorLotes:
+    # Micro-batching front of one property type: concurrent requests wait in a queue and are
+    # merged into a single estimar_lote call of up to FILAS_POR_LOTE rows, waiting at most
+    # ESPERA_LOTE seconds for company. One consumer per inference thread keeps the pool busy.
+    # Admission is bounded by rows, since one request may carry up to MAXIMO_LOTE_HTTP of them:
+    # a request is rejected when the rows queued or being estimated would exceed the capacity,
+    # unless nothing is pending. The Estimador is looked up per batch, so a registry reload
+    # applies to the next one
+    def __init__(self, tipo_propiedad, obtener_estimador, ejecutor, filas_por_lote=FILAS_POR_LOTE,
+                 espera=ESPERA_LOTE, capacidad=CAPACIDAD_FILAS, consumidores=HILOS_INFERENCIA):
+        self.tipo_propiedad = tipo_propiedad
+        self.obtener_estimador = obtener_estimador
+        self.ejecutor = ejecutor
+        self.filas_por_lote = filas_por_lote
+        self.espera = espera
+        self.capacidad = capacidad
+        self.n_consumidores = consumidores
+        self._cola = None
+        self._consumidores = []
+        self.filas_pendientes = 0
+        self.lotes = 0
+        self.filas = 0
+
+    def iniciar(self):
+        self._cola = asyncio.Queue()
+        self._consumidores = [asyncio.create_task(self._consumir()) for _ in range(self.n_consumidores)]
+
+    async def detener(self):
+        for consumidor in self._consumidores:
+            consumidor.cancel()
+        await asyncio.gather(*self._consumidores, return_exceptions=True)
+
+    async def estimar(self, propiedades):
+        if self.filas_pendientes and self.filas_pendientes + len(propiedades) > self.capacidad:
+            RECHAZOS.incrementar(self.tipo_propiedad)
+            raise ColaLlena()
+        futuro = asyncio.get_running_loop().create_future()
+        self.filas_pendientes += len(propiedades)
+        self._cola.put_nowait((propiedades, futuro))
+        return await futuro
+
+    async def _consumir(self):
+        bucle = asyncio.get_running_loop()
+        while True:
+            pendientes = [await self._cola.get()]
+            filas = len(pendientes[0][0])
+            limite = bucle.time() + self.espera
+            while filas < self.filas_por_lote:
+                restante = limite - bucle.time()
+                try:
+                    elemento = self._cola.get_nowait() if restante <= 0 else await asyncio.wait_for(self._cola.get(), restante)
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+                pendientes.append(elemento)
+                filas += len(elemento[0])
+
+            propiedades = [propiedad for lote, _ in pendientes for propiedad in lote]
+            try:
+                resultados = await bucle.run_in_executor(self.ejecutor, self._estimar, propiedades)
+            except Exception as e:
+                logger.error(f"Error al estimar un lote de {len(propiedades)} propiedades: {str(e)}")
+                for _, futuro in pendientes:
+                    if not futuro.done():
+                        futuro.set_exception(e)
+                continue
+            finally:
+                self.filas_pendientes -= len(propiedades)
+
+            self.lotes += 1
+            self.filas += len(propiedades)
+            FILAS_POR_LOTE_SERVIDO.observar(len(propiedades), self.tipo_propiedad)
+            inicio = 0
+            for lote, futuro in pendientes:
+                if not futuro.done():
+                    futuro.set_result(resultados[inicio:inicio + len(lote)])
+                inicio += len(lote)
+
+    def _estimar(self, propiedades):
+        import numpy as np
+
+        entradas = {
+            columna: np.array([propiedad[campo] for propiedad in propiedades], dtype=np.float64)
+            for columna, campo in zip(COLUMNAS_ENTRADA, CAMPOS_PROPIEDAD)
+        }
+        precios, minimos, maximos = self.obtener_estimador().estimar_lote(entradas)
+        return [_resultado(precio, minimo, maximo) for precio, minimo, maximo in zip(precios, minimos, maximos)]
+
+
+def _resultado(precio, minimo, maximo):
+    if math.isnan(precio):
+        return {'precio': None, 'precio_min': None, 'precio_max': None, 'error': "No se pudo estimar el precio"}
+    return {'precio': int(precio), 'precio_min': int(minimo), 'precio_max': int(maximo)}
+
+
+def _leer_propiedad(datos):
+    propiedad = {}
+    for campo in CAMPOS_PROPIEDAD:
+        valor = datos.get(campo)
+        if isinstance(valor, bool) or not isinstance(valor, (int, float)):
+            raise ValueError(f"El campo '{campo}' debe ser numérico")
+        propiedad[campo] = float(valor)
+    return propiedad
+
+
+async def _leer_json(solicitud):
+    try:
+        datos = await solicitud.json()
+    except ValueError:
+        raise web.HTTPBadRequest(text="El cuerpo debe ser JSON válido")
+    if not isinstance(datos, dict):
+        raise web.HTTPBadRequest(text="El cuerpo debe ser un objeto JSON")
+    return datos
+
+
+def _agrupador(solicitud, datos):
+    disponibles = solicitud.app['registro'].disponibles()
+    tipo_propiedad = datos.get('tipo_propiedad')
+    if tipo_propiedad is None:
+        raise web.HTTPBadRequest(text=f"El campo 'tipo_propiedad' es obligatorio: {', '.join(disponibles)}")
+    if tipo_propiedad not in disponibles:
+        raise web.HTTPBadRequest(text=f"Tipo de propiedad no disponible: {tipo_propiedad}")
+    agrupadores = solicitud.app['agrupadores']
+    agrupador = agrupadores.get(tipo_propiedad)
+    if agrupador is None:
+        # A set added to the manifest after startup gets its batcher on its first request
+        agrupador = agrupadores[tipo_propiedad] = solicitud.app['crear_agrupador'](tipo_propiedad)
+        agrupador.iniciar()
+    return agrupador
+
+
+async def _estimar(agrupador, propiedades):
+    try:
+        return await agrupador.estimar(propiedades)
+    except ColaLlena:
+        raise web.HTTPServiceUnavailable(text="Servicio saturado, intente de nuevo", headers={'Retry-After': '1'})
+
+
+async def estimar(solicitud):
+    datos = await _leer_json(solicitud)
+    agrupador = _agrupador(solicitud, datos)
+    try:
+        propiedad = _leer_propiedad(datos)
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    resultados = await _estimar(agrupador, [propiedad])
+    return web.json_response(resultados[0])
+
+
+async def estimar_lote(solicitud):
+    datos = await _leer_json(solicitud)
+    agrupador = _agrupador(solicitud, datos)
+    propiedades = datos.get('propiedades')
+    if not isinstance(propiedades, list) or not propiedades:
+        raise web.HTTPBadRequest(text="'propiedades' debe ser una lista no vacía")
+    if len(propiedades) > MAXIMO_LOTE_HTTP:
+        raise web.HTTPRequestEntityTooLarge(max_size=MAXIMO_LOTE_HTTP, actual_size=len(propiedades))
+    try:
+        propiedades = [_leer_propiedad(propiedad) for propiedad in propiedades]
+    except (ValueError, AttributeError) as e:
+        raise web.HTTPBadRequest(text=f"Propiedad inválida: {str(e)}")
+    return web.json_response({'resultados': await _estimar(agrupador, propiedades)})
+
+
+async def salud(solicitud):
+    versiones = solicitud.app['registro'].versiones()
+    return web.json_response({
+        tipo: {'version': versiones.get(tipo), 'lotes': agrupador.lotes, 'filas': agrupador.filas}
+        for tipo, agrupador in solicitud.app['agrupadores'].items()
+    })
+
+
+async def metricas(solicitud):
+    return web.Response(body=METRICAS.exponer().encode('utf-8'), headers={'Content-Type': TIPO_CONTENIDO})
+
+
+def crear_aplicacion(registro, hilos=HILOS_INFERENCIA, filas_por_lote=FILAS_POR_LOTE,
+                     espera=ESPERA_LOTE, capacidad=CAPACIDAD_FILAS):
+    if not registro.disponibles():
+        raise RuntimeError("No hay ningún modelo disponible")
+    aplicacion = web.Application(client_max_size=16 * 1024 * 1024)
+    ejecutor = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="inferencia")
+    aplicacion['registro'] = registro
+    aplicacion['crear_agrupador'] = lambda tipo: AgrupadorLotes(
+        tipo, lambda: registro.obtener(tipo), ejecutor, filas_por_lote, espera, capacidad, hilos)
+    aplicacion['agrupadores'] = {tipo: aplicacion['crear_agrupador'](tipo) for tipo in registro.disponibles()}
+
+    async def iniciar(aplicacion):
+        for agrupador in aplicacion['agrupadores'].values():
+            agrupador.iniciar()
+
+    async def detener(aplicacion):
+        for agrupador in aplicacion['agrupadores'].values():
+            await agrupador.detener()
+        ejecutor.shutdown(wait=True)
+
+    aplicacion.on_startup.append(iniciar)
+    aplicacion.on_cleanup.append(detener)
+    aplicacion.router.add_post('/estimar', estimar)
+    aplicacion.router.add_post('/estimar/lote', estimar_lote)
+    aplicacion.router.add_get('/salud', salud)
+    aplicacion.router.add_get('/metricas', metricas)
+    return aplicacion
+
+
+def main(argumentos=None):
+    parser = argparse.ArgumentParser(description="Servicio HTTP de estimación de precios.")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--puerto', type=int, default=8080)
+    parser.add_argument('--hilos', type=int, default=HILOS_INFERENCIA)
+    parser.add_argument('--filas-por-lote', type=int, default=FILAS_POR_LOTE)
+    parser.add_argument('--espera-lote-ms', type=float, default=ESPERA_LOTE * 1000)
+    parser.add_argument('--capacidad-filas', type=int, default=CAPACIDAD_FILAS,
+                        help="Filas pendientes por tipo de propiedad antes de responder 503")
+    parser.add_argument('--manifiesto', default=RUTA_MANIFIESTO)
+    parser.add_argument('--estricto', action='store_true',
+                        help="No arranca si algún conjunto del manifiesto es inválido")
+    argumentos = parser.parse_args(argumentos)
+
+    # Every set is loaded and warmed up before the server accepts requests
+    registro = RegistroModelos(argumentos.manifiesto, calentar=True).cargar(estricto=argumentos.estricto)
+    registro.vigilar()
+    aplicacion = crear_aplicacion(registro, argumentos.hilos, argumentos.filas_por_lote,
+                                  argumentos.espera_lote_ms / 1000, argumentos.capacidad_filas)
+    web.run_app(aplicacion, host=argumentos.host, port=argumentos.puerto)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,121 @@
+import random
+import threading
+import time
+
+from geopy.exc import GeocoderUnavailable
+from geopy.location import Location
+
+from geocodificacion import normalizar_direccion
+
+# Local stand-ins for the external services, used by benchmarks and load tests
+
+CALLES = ["Calle Principal", "Avenida Reforma", "Calle Hidalgo", "Avenida Juárez", "Calle Morelos",
+          "Calle Allende", "Avenida Insurgentes", "Calle Madero", "Calle Zaragoza", "Avenida Revolución"]
+
+CIUDADES = [
+    ("Colonia Centro", "Ciudad de México", 19.4326, -99.1332),
+    ("Colonia Roma Norte", "Ciudad de México", 19.4194, -99.1617),
+    ("Colonia Americana", "Guadalajara", 20.6736, -103.3700),
+    ("Colonia Obispado", "Monterrey", 25.6751, -100.3385),
+    ("Colonia Centro", "Querétaro", 20.5888, -100.3899),
+    ("Colonia García Ginerés", "Mérida", 20.9863, -89.6385),
+]
+
+
+def generar_direcciones(numeros=(10, 123, 250, 480, 1001)):
+    direcciones = []
+    for indice_ciudad, (colonia, ciudad, latitud, longitud) in enumerate(CIUDADES):
+        for indice_calle, calle in enumerate(CALLES):
+            for indice_numero, numero in enumerate(numeros):
+                desplazamiento = 0.002 * indice_calle + 0.0004 * indice_numero
+                direcciones.append((
+                    f"{calle} {numero}, {colonia}, {ciudad}, México",
+                    latitud + desplazamiento,
+                    longitud - desplazamiento,
+                ))
+    return direcciones
+
+
+class GeocodificadorSimulado:
+    # geopy-compatible fake: answers from a fixed list of addresses with configurable
+    # latency and a failure rate, and counts the calls it receives
+    def __init__(self, direcciones=None, latencia=0.0, tasa_fallos=0.0, semilla=0):
+        self.direcciones = direcciones or generar_direcciones()
+        self._indice = [(normalizar_direccion(direccion).split(), direccion, latitud, longitud)
+                        for direccion, latitud, longitud in self.direcciones]
+        self.latencia = latencia
+        self.tasa_fallos = tasa_fallos
+        self._aleatorio = random.Random(semilla)
+        self._candado = threading.Lock()
+        self.llamadas = 0
+
+    def geocode(self, consulta, exactly_one=True, limit=None, **kwargs):
+        with self._candado:
+            self.llamadas += 1
+            falla = self._aleatorio.random() < self.tasa_fallos
+        if self.latencia:
+            time.sleep(self.latencia)
+        if falla:
+            raise GeocoderUnavailable("Fallo simulado")
+
+        palabras = [p for p in normalizar_direccion(consulta).split() if p != "mexico"]
+        ubicaciones = []
+        for palabras_direccion, direccion, latitud, longitud in self._indice:
+            if all(any(candidata.startswith(p) for candidata in palabras_direccion) for p in palabras):
+                ubicaciones.append(Location(direccion, (latitud, longitud), {'display_name': direccion}))
+                if exactly_one or (limit and len(ubicaciones) >= limit):
+                    break
+        if not ubicaciones:
+            return None
+        return ubicaciones[0] if exactly_one else ubicaciones
+
+
+class ServicioSheetsSimulado:
+    # Mimics service.spreadsheets().values().append(...).execute() and keeps appended rows in memory
+    def __init__(self, latencia=0.0, tasa_fallos=0.0, semilla=0):
+        self.latencia = latencia
+        self.tasa_fallos = tasa_fallos
+        self._aleatorio = random.Random(semilla)
+        self._candado = threading.Lock()
+        self.filas = []
+        self.llamadas = 0
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def append(self, spreadsheetId, range, valueInputOption, insertDataOption, body):
+        return _SolicitudSheetsSimulada(self, body['values'])
+
+    def get(self, spreadsheetId, range):
+        return _LecturaSheetsSimulada(self)
+
+
+class _LecturaSheetsSimulada:
+    def __init__(self, servicio):
+        self.servicio = servicio
+
+    def execute(self):
+        with self.servicio._candado:
+            return {'values': [list(fila) for fila in self.servicio.filas]}
+
+
+class _SolicitudSheetsSimulada:
+    def __init__(self, servicio, filas):
+        self.servicio = servicio
+        self.filas = filas
+
+    def execute(self):
+        servicio = self.servicio
+        with servicio._candado:
+            servicio.llamadas += 1
+            falla = servicio._aleatorio.random() < servicio.tasa_fallos
+        if servicio.latencia:
+            time.sleep(servicio.latencia)
+        if falla:
+            raise ConnectionError("Fallo simulado de Google Sheets")
+        with servicio._candado:
+            servicio.filas.extend(self.filas)
+        return {'updates': {'updatedRows': len(self.filas)}}
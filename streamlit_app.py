@@ -1,28 +1,52 @@
 import streamlit as st
-import pandas as pd
-import numpy as np
-import joblib
-import os
-import math
 import plotly.graph_objects as go
-from geopy.geocoders import Nominatim
+from plotly.subplots import make_subplots
 from geopy.exc import GeocoderTimedOut, GeocoderUnavailable
 import re
+import uuid
 import logging
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
-from datetime import datetime
+from geocodificacion import crear_geocodificador
+from prospectos import EscritorProspectos, crear_almacen
+from cache_predicciones import CachePredicciones
+from registro_modelos import RegistroModelos
+from mosaicos import MosaicosPrecio, crear_mapa
+from streamlit_folium import st_folium
+from flujo_sesion import FlujoSesion
+from comparables import RUTA_COMPARABLES, cargar_comparables
+from monitor_deriva import DIRECTORIO_DERIVA, MonitorDeriva, ruta_replica
+from paso_resultados import PasoResultados
+import instrumentacion
+from instrumentacion import depurar, tramo
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-# Initialize geocoder
-geolocalizador = Nominatim(user_agent="aplicacion_propiedades")
-
 # Page configuration
 st.set_page_config(page_title="Estimador de Valor de Propiedades", layout="wide")
 
+def leer_configuracion(seccion):
+    try:
+        return dict(st.secrets.get(seccion, {}))
+    except FileNotFoundError:
+        return {}
+
+# Logging level, sampled debug payloads and the optional metrics port come from the
+# [instrumentacion] secrets section; by default only INFO is logged and no payload is built
+@st.cache_resource
+def configurar_instrumentacion():
+    return instrumentacion.configurar(leer_configuracion("instrumentacion"))
+
+configurar_instrumentacion()
+
+# Initialize the geocoder shared by all sessions; the [geocodificacion] secrets section
+# selects the live Nominatim client or the offline gazetteer
+@st.cache_resource
+def obtener_geolocalizador():
+    return crear_geocodificador(leer_configuracion("geocodificacion"))
+
+geolocalizador = obtener_geolocalizador()
+
 # Basic color scheme
 PRIMARY_COLOR = "#1f77b4"  # Blue
 SECONDARY_COLOR = "#2ca02c"  # Green
@@ -75,43 +99,19 @@ def get_google_sheets_service():
     )
     return build('sheets', 'v4', credentials=credentials)
 
+# The [prospectos] secrets section selects the lead store; Google Sheets is the default
+@st.cache_resource
+def obtener_escritor_prospectos():
+    configuracion = leer_configuracion("prospectos")
+    if configuracion.get("tipo", "sheets") == "sheets":
+        configuracion.update(leer_configuracion("spreadsheet"))
+    return EscritorProspectos(crear_almacen(configuracion, get_google_sheets_service))
+
 def save_to_sheets(data):
+    # Queues the lead for the background writer; repeated calls for the same estimate are ignored
     try:
-        service = get_google_sheets_service()
-        spreadsheet_id = st.secrets["spreadsheet"]["id"]
-        sheet_name = st.secrets["spreadsheet"]["sheet_name"]
-        range_name = f"{sheet_name}!A:L"
-        
-        # Format timestamp
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
-        # Prepare data row
-        row = [[
-            timestamp,
-            data['tipo_propiedad'],
-            data['direccion'],
-            data['terreno'],
-            data['construccion'],
-            data['habitaciones'],
-            data['banos'],
-            data['nombre'],
-            data['correo'],
-            data['telefono'],
-            data['interes_venta'],
-            data['precio_estimado']
-        ]]
-        
-        body = {'values': row}
-        
-        service.spreadsheets().values().append(
-            spreadsheetId=spreadsheet_id,
-            range=range_name,
-            valueInputOption='RAW',
-            insertDataOption='INSERT_ROWS',
-            body=body
-        ).execute()
-        
-        logger.debug("Data successfully saved to Google Sheets")
+        obtener_escritor_prospectos().encolar(data)
+        logger.debug("Data queued for Google Sheets")
         return True
     except Exception as e:
         logger.error(f"Error saving to Google Sheets: {str(e)}")
@@ -129,124 +129,166 @@ def create_tooltip(label, explanation):
     </div>
     """
 
+# Model sets come from the modelos.json registry, validated and loaded once per server process
+# and reloaded in place when the manifest changes
 @st.cache_resource
+def obtener_registro():
+    registro = RegistroModelos(calentar=True).cargar()
+    registro.vigilar()
+    return registro
+
+# Loaded with the server's first script run rather than inside a step 3 prediction
+try:
+    obtener_registro()
+except Exception as e:
+    logger.error(f"Error al cargar el registro de modelos: {str(e)}")
+
+def version_modelos(tipo_propiedad):
+    try:
+        return obtener_registro().versiones().get(tipo_propiedad)
+    except Exception:
+        return None
+
 def cargar_modelos(tipo_propiedad):
-    directorio_actual = os.path.dirname(os.path.abspath(__file__))
-    prefijo = "renta_" if tipo_propiedad == "Departamento" else ""
-    logger.debug(f"Cargando modelos para {tipo_propiedad} con prefijo: '{prefijo}'")
     modelos = {}
-    modelos_requeridos = {
-        'modelo': 'bosque_aleatorio.joblib',
-        'escalador': 'escalador.joblib',
-        'imputador': 'imputador.joblib',
-        'agrupamiento': 'agrupamiento.joblib'
-    }
     try:
-        for nombre_modelo, nombre_archivo in modelos_requeridos.items():
-            ruta_archivo = os.path.join(directorio_actual, f"{prefijo}{nombre_archivo}")
-            logger.debug(f"Intentando cargar modelo: {nombre_modelo} desde archivo: {ruta_archivo}")
-            if os.path.exists(ruta_archivo):
-                modelos[nombre_modelo] = joblib.load(ruta_archivo)
-                logger.debug(f"Modelo {nombre_modelo} cargado exitosamente")
-            else:
-                logger.error(f"Archivo de modelo no encontrado: {ruta_archivo}")
-                raise FileNotFoundError(f"Archivo de modelo no encontrado: {ruta_archivo}")
+        modelos = obtener_registro().obtener(tipo_propiedad).modelos
     except Exception as e:
         logger.error(f"Error al cargar los modelos: {str(e)}")
         st.error(f"Error al cargar los modelos: {str(e)}. Por favor contacte al soporte.")
     return modelos
 
+@st.cache_resource
+def obtener_cache_predicciones():
+    return CachePredicciones(version_modelos)
+
+# Each server process checkpoints its own drift summaries under the [deriva] "directorio";
+# monitor_deriva.py combines the files of every replica and evaluates them
+@st.cache_resource
+def obtener_monitor_deriva():
+    directorio = leer_configuracion("deriva").get("directorio", DIRECTORIO_DERIVA)
+    return MonitorDeriva(ruta_replica(directorio))
+
+# Price map tiles are generated offline with mosaicos.py for each model version; without them
+# the map only shows the location
+@st.cache_resource
+def obtener_mosaicos(tipo_propiedad, version):
+    return MosaicosPrecio.abrir(tipo_propiedad, version)
+
+def mostrar_mapa(tipo_propiedad, latitud, longitud):
+    mosaicos = None
+    try:
+        version = obtener_registro().versiones().get(tipo_propiedad)
+        if version:
+            mosaicos = obtener_mosaicos(tipo_propiedad, version)
+    except Exception as e:
+        logger.error(f"Error al abrir los mosaicos de precio: {str(e)}")
+    perfil = 0
+    if mosaicos is not None:
+        perfil = mosaicos.perfiles.index(st.selectbox(
+            "Perfil de referencia del mapa",
+            options=mosaicos.perfiles,
+            index=len(mosaicos.perfiles) // 2
+        ))
+        mapa = crear_mapa(mosaicos, latitud, longitud, perfil)
+    else:
+        import folium
+        mapa = folium.Map(location=[latitud, longitud], zoom_start=15)
+        folium.Marker([latitud, longitud]).add_to(mapa)
+    # returned_objects=[] keeps map interactions from triggering a rerun
+    st_folium(mapa, height=400, use_container_width=True, returned_objects=[])
+
+# The reference file is produced with comparables.py; the spatial index is built once per
+# server process and the section is hidden when the file is missing
+@st.cache_resource
+def obtener_comparables():
+    ruta = leer_configuracion("comparables").get("ruta", RUTA_COMPARABLES)
+    try:
+        return cargar_comparables(ruta)
+    except FileNotFoundError:
+        logger.info(f"Sin archivo de comparables en {ruta}")
+    except Exception as e:
+        logger.error(f"Error al cargar los comparables: {str(e)}")
+    return {}
+
+# The step 3 computations live in paso_resultados.py, which the load test runs as well
+@st.cache_resource
+def obtener_paso_resultados():
+    return PasoResultados(cargar_modelos, obtener_cache_predicciones(), obtener_monitor_deriva(),
+                          obtener_comparables())
+
+def mostrar_comparables(comparables):
+    st.subheader("Propiedades comparables")
+    if not comparables:
+        st.caption("No hay propiedades comparables registradas cerca de esta ubicación.")
+        return
+    st.dataframe(
+        [{
+            'Dirección': comparable['Direccion'],
+            'Distancia (km)': round(comparable['distancia_km'], 2),
+            'Terreno': comparable['Terreno'],
+            'Construcción': comparable['Construccion'],
+            'Habitaciones': int(comparable['Habitaciones']),
+            'Baños': comparable['Banos'],
+            'Precio': f"${comparable['Precio']:,.0f}",
+        } for comparable in comparables],
+        hide_index=True,
+        use_container_width=True
+    )
+
+ETIQUETAS_SENSIBILIDAD = {
+    'Construccion': "Construcción (m²)",
+    'Terreno': "Terreno (m²)",
+    'Habitaciones': "Habitaciones",
+    'Banos': "Baños",
+}
+
+def mostrar_sensibilidad(curvas, actuales):
+    # One panel per feature: the estimate as a line inside the band of its range, and the
+    # user's current value marked
+    nombres = list(curvas)
+    fig = make_subplots(rows=2, cols=2, subplot_titles=[ETIQUETAS_SENSIBILIDAD[nombre] for nombre in nombres])
+    for indice, nombre in enumerate(nombres):
+        valores, precios, minimos, maximos = curvas[nombre]
+        fila, columna = indice // 2 + 1, indice % 2 + 1
+        fig.add_trace(go.Scatter(x=valores, y=maximos, mode='lines', line_width=0, hoverinfo='skip'),
+                      row=fila, col=columna)
+        fig.add_trace(go.Scatter(x=valores, y=minimos, mode='lines', line_width=0, fill='tonexty',
+                                 fillcolor='rgba(44, 160, 44, 0.2)', hoverinfo='skip'),
+                      row=fila, col=columna)
+        fig.add_trace(go.Scatter(x=valores, y=precios, mode='lines+markers', line_color=PRIMARY_COLOR,
+                                 hovertemplate='%{x}: $%{y:,.0f}<extra></extra>'),
+                      row=fila, col=columna)
+        # The zero offset of every curve is exactly the user's value
+        actual = list(valores).index(actuales[nombre])
+        fig.add_trace(go.Scatter(x=[valores[actual]], y=[precios[actual]], mode='markers',
+                                 marker=dict(color=SECONDARY_COLOR, size=12),
+                                 hovertemplate='Actual: $%{y:,.0f}<extra></extra>'),
+                      row=fila, col=columna)
+    fig.update_layout(height=600, showlegend=False, margin=dict(t=40))
+    fig.update_yaxes(tickprefix='$', tickformat=',.0f')
+    st.plotly_chart(fig, use_container_width=True)
+
 def geocodificar_direccion(direccion):
-    logger.debug(f"Intentando geocodificar dirección: {direccion}")
     try:
-        ubicacion = geolocalizador.geocode(direccion)
+        with tramo('geocodificar'):
+            ubicacion = geolocalizador.geocode(direccion)
         if ubicacion:
-            logger.debug(f"Geocodificación exitosa: {ubicacion.latitude}, {ubicacion.longitude}")
             return ubicacion.latitude, ubicacion.longitude, ubicacion
     except (GeocoderTimedOut, GeocoderUnavailable):
         logger.warning("Servicio de geocodificación no disponible")
     return None, None, None
 
 def obtener_sugerencias_direccion(consulta):
-    logger.debug(f"Obteniendo sugerencias para: {consulta}")
     try:
-        ubicaciones = geolocalizador.geocode(consulta + ", México", exactly_one=False, limit=5)
+        with tramo('sugerir'):
+            ubicaciones = geolocalizador.geocode(consulta + ", México", exactly_one=False, limit=5)
         if ubicaciones:
             return [ubicacion.address for ubicacion in ubicaciones]
     except (GeocoderTimedOut, GeocoderUnavailable):
         logger.warning("Servicio de geocodificación no disponible")
     return []
 
-def agregar_caracteristica_grupo(latitud, longitud, modelos):
-    logger.debug(f"Agregando característica de grupo para: {latitud}, {longitud}")
-    try:
-        grupo = modelos['agrupamiento'].predict(pd.DataFrame({'Latitud': [latitud], 'Longitud': [longitud]}))[0]
-        logger.debug(f"Grupo obtenido: {grupo}")
-        return grupo
-    except Exception as e:
-        logger.error(f"Error al agregar característica de grupo: {str(e)}")
-        return None
-
-def preprocesar_datos(latitud, longitud, terreno, construccion, habitaciones, banos, modelos):
-    logger.debug(f"Preprocesando datos para tipo de propiedad: {st.session_state.tipo_propiedad}")
-    logger.debug(f"Valores recibidos: terreno={terreno}, construccion={construccion}, habitaciones={habitaciones}, banos={banos}")
-    try:
-        grupo_ubicacion = agregar_caracteristica_grupo(latitud, longitud, modelos)
-        
-        # Convert all values to float explicitly
-        terreno_val = float(terreno) if terreno is not None else 0.0
-        construccion_val = float(construccion) if construccion is not None else 0.0
-        habitaciones_val = float(habitaciones) if habitaciones is not None else 0.0
-        banos_val = float(banos) if banos is not None else 0.0
-        grupo_val = float(grupo_ubicacion) if grupo_ubicacion is not None else 0.0
-
-        datos_entrada = pd.DataFrame({
-            'Terreno': [terreno_val],
-            'Construccion': [construccion_val],
-            'Habitaciones': [habitaciones_val],
-            'Banos': [banos_val],
-            'GrupoUbicacion': [grupo_val],
-        })
-        
-        logger.debug(f"Datos de entrada antes de imputación: {datos_entrada.to_dict()}")
-        datos_imputados = modelos['imputador'].transform(datos_entrada)
-        logger.debug(f"Datos después de imputación: {datos_imputados}")
-        datos_escalados = modelos['escalador'].transform(datos_imputados)
-        logger.debug(f"Datos después de escalado: {datos_escalados}")
-        
-        return pd.DataFrame(datos_escalados, columns=datos_entrada.columns)
-    except Exception as e:
-        logger.error(f"Error al preprocesar datos: {str(e)}")
-        return None
-
-def predecir_precio(datos_procesados, modelos):
-    logger.debug(f"Prediciendo precio para tipo de propiedad: {st.session_state.tipo_propiedad}")
-    try:
-        precio_bruto = modelos['modelo'].predict(datos_procesados)[0]
-        logger.debug(f"Precio bruto predicho: {precio_bruto}")
-        
-        # Apply 63% adjustment to the raw prediction
-        precio_ajustado = precio_bruto * 0.63
-        logger.debug(f"Precio ajustado (63%): {precio_ajustado}")
-        
-        # Round the adjusted price
-        precio_redondeado = math.floor(precio_ajustado / 1000) * 1000
-        logger.debug(f"Precio redondeado después de ajuste: {precio_redondeado}")
-
-        # Calculate range factors
-        factor_escala_bajo = math.exp(-0.05)
-        factor_escala_alto = math.exp(0.01 * math.log(precio_redondeado / 1000 + 1))
-
-        # Calculate price ranges
-        rango_precio_min = max(0, math.floor((precio_redondeado * factor_escala_bajo) / 1000) * 1000)
-        rango_precio_max = math.ceil((precio_redondeado * factor_escala_alto) / 1000) * 1000
-
-        logger.debug(f"Precio final: {precio_redondeado}, Rango: [{rango_precio_min}, {rango_precio_max}]")
-        return precio_redondeado, rango_precio_min, rango_precio_max
-    except Exception as e:
-        logger.error(f"Error al predecir el precio: {str(e)}")
-        return None, None, None
-
 def validar_correo(correo):
     patron = r'^[\w\.-]+@[\w\.-]+\.\w+$'
     return re.match(patron, correo) is not None
@@ -296,6 +338,9 @@ if 'telefono' not in st.session_state:
 if 'interes_venta' not in st.session_state:
    st.session_state.interes_venta = ""
 
+# Stage results live in session_state, so reruns that do not change a stage's inputs reuse them
+flujo = FlujoSesion(st.session_state)
+
 # Main UI
 st.title("Estimador de Valor de Propiedades")
 
@@ -328,10 +373,8 @@ if st.session_state.step == 1:
         )
         if tipo_propiedad != st.session_state.get('tipo_propiedad'):
             st.session_state.tipo_propiedad = tipo_propiedad
-            logger.debug(f"Updated tipo_propiedad to: {tipo_propiedad}")
             
         modelos = cargar_modelos(st.session_state.tipo_propiedad)
-        logger.debug(f"Tipo de propiedad seleccionado: {st.session_state.tipo_propiedad}")
     
     with col2:
         st.markdown(create_tooltip("Dirección de la Propiedad", 
@@ -359,13 +402,20 @@ if st.session_state.step == 1:
             if direccion_seleccionada:
                 st.session_state.direccion_seleccionada = direccion_seleccionada
 
-    # Geocodificación (sin mapa)
+    # Geocodificación y mapa de precio por m²
     if st.session_state.get('direccion_seleccionada'):
-        latitud, longitud, ubicacion = geocodificar_direccion(st.session_state.direccion_seleccionada)
+        def calcular_coordenadas():
+            latitud, longitud, _ = geocodificar_direccion(st.session_state.direccion_seleccionada)
+            return (latitud, longitud) if latitud and longitud else None
+
+        latitud, longitud = flujo.calcular(
+            'coordenadas', st.session_state.direccion_seleccionada, calcular_coordenadas
+        ) or (None, None)
         if latitud and longitud:
             st.session_state.latitud = latitud
             st.session_state.longitud = longitud
             st.success(f"Ubicación encontrada: {st.session_state.direccion_seleccionada}")
+            mostrar_mapa(st.session_state.tipo_propiedad, latitud, longitud)
         else:
             st.error("No se pudo geocodificar la dirección seleccionada.")
     
@@ -426,16 +476,10 @@ if st.session_state.step == 1:
         )
         st.session_state.banos = banos
 
-    logger.debug("=== STEP 1 VALUES BEING SET ===")
-    logger.debug(f"Tipo de propiedad: {st.session_state.tipo_propiedad}")
-    logger.debug(f"Terreno input value: {terreno}")
-    logger.debug(f"Terreno session state: {st.session_state.terreno}")
-    logger.debug(f"Construccion input value: {construccion}")
-    logger.debug(f"Construccion session state: {st.session_state.construccion}")
-    logger.debug(f"Habitaciones input value: {habitaciones}")
-    logger.debug(f"Habitaciones session state: {st.session_state.habitaciones}")
-    logger.debug(f"Baños input value: {banos}")
-    logger.debug(f"Baños session state: {st.session_state.banos}")
+    depurar(logger, "paso1", lambda: {
+        'tipo_propiedad': st.session_state.tipo_propiedad,
+        'terreno': terreno, 'construccion': construccion, 'habitaciones': habitaciones, 'banos': banos,
+    })
 
     # Navigation buttons
     st.write("")  # Add spacing before buttons
@@ -529,6 +573,8 @@ elif st.session_state.step == 2:
        elif not interes_venta:
            st.error("Por favor, seleccione su nivel de interés.")
        else:
+           # A new submission is a new lead, even with the same data as an earlier one
+           st.session_state.id_envio = uuid.uuid4().hex
            st.session_state.step = 3
            st.rerun()
 
@@ -536,32 +582,32 @@ elif st.session_state.step == 2:
 elif st.session_state.step == 3:
     st.subheader("Resultados")
     
-    logger.debug("=== VERIFYING VALUES BEFORE PROCESSING ===")
-    logger.debug(f"Tipo de propiedad: {st.session_state.tipo_propiedad}")
-    logger.debug(f"Terreno: {st.session_state.terreno}")
-    logger.debug(f"Construccion: {st.session_state.construccion}")
-    logger.debug(f"Habitaciones: {st.session_state.habitaciones}")
-    logger.debug(f"Baños: {st.session_state.banos}")
-    logger.debug(f"Latitud: {st.session_state.latitud}")
-    logger.debug(f"Longitud: {st.session_state.longitud}")
-    
-    # Load models based on final property type
-    modelos = cargar_modelos(st.session_state.tipo_propiedad)
+    depurar(logger, "paso3", lambda: {
+        campo: st.session_state.get(campo)
+        for campo in ('tipo_propiedad', 'terreno', 'construccion', 'habitaciones', 'banos', 'latitud', 'longitud')
+    })
     
     with st.spinner('Calculando...'):
-        # Use data from session state for prediction
-        datos_procesados = preprocesar_datos(
-            st.session_state.latitud, 
-            st.session_state.longitud, 
-            float(st.session_state.terreno), 
-            float(st.session_state.construccion), 
-            float(st.session_state.habitaciones), 
-            float(st.session_state.banos), 
-            modelos
+        caracteristicas = (
+            st.session_state.tipo_propiedad,
+            st.session_state.latitud,
+            st.session_state.longitud,
+            st.session_state.terreno,
+            st.session_state.construccion,
+            st.session_state.habitaciones,
+            st.session_state.banos,
         )
+        # The model version is part of the inputs so a reloaded model set refreshes the result
+        prediccion = flujo.calcular(
+            'prediccion',
+            caracteristicas + (version_modelos(st.session_state.tipo_propiedad),),
+            lambda: obtener_paso_resultados().predecir(*caracteristicas),
+            valido=lambda resultado: resultado[0] is not None
+        )
+        depurar(logger, "cache_predicciones", obtener_cache_predicciones().estadisticas)
         
-        if datos_procesados is not None:
-            precio, precio_min, precio_max = predecir_precio(datos_procesados, modelos)
+        if prediccion is not None:
+            precio, precio_min, precio_max = prediccion
             if precio is not None:
                 # Save to Google Sheets with all required data
                 data = {
@@ -575,10 +621,12 @@ elif st.session_state.step == 3:
                     'correo': st.session_state.correo,
                     'telefono': st.session_state.telefono,
                     'interes_venta': st.session_state.interes_venta,
-                    'precio_estimado': precio
+                    'precio_estimado': precio,
+                    'id_envio': st.session_state.id_envio
                 }
                 
-                save_to_sheets(data)
+                # Only queued again when the lead itself changes; a failed attempt is retried on the next rerun
+                flujo.calcular('prospecto', tuple(data.items()), lambda: save_to_sheets(data) or None)
                 
                 col1, col2 = st.columns(2)
                 
@@ -606,6 +654,26 @@ elif st.session_state.step == 3:
                 )
                 st.plotly_chart(fig)
 
+                # The whole grid is predicted in one batch; reruns reuse the curves
+                curvas = flujo.calcular(
+                    'sensibilidad',
+                    caracteristicas + (version_modelos(st.session_state.tipo_propiedad),),
+                    lambda: obtener_paso_resultados().sensibilidad(*caracteristicas)
+                )
+                if curvas:
+                    st.subheader("¿Cuánto cambiaría el valor?")
+                    mostrar_sensibilidad(curvas, {
+                        'Construccion': float(st.session_state.construccion),
+                        'Terreno': float(st.session_state.terreno),
+                        'Habitaciones': float(st.session_state.habitaciones),
+                        'Banos': float(st.session_state.banos),
+                    })
+
+                comparables = flujo.calcular('comparables', caracteristicas,
+                                             lambda: obtener_paso_resultados().buscar_comparables(*caracteristicas))
+                if comparables is not None:
+                    mostrar_comparables(comparables)
+
                 if st.button("Nueva Estimación"):
                     for key in st.session_state.keys():
                         del st.session_state[key]
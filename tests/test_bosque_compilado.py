@@ -0,0 +1,47 @@
+import time
+
+import pytest
+
+np = pytest.importorskip("numpy")
+ensemble = pytest.importorskip("sklearn.ensemble")
+
+from bosque_compilado import BosqueCompilado
+
+
+def test_fila_identica_a_sklearn():
+    aleatorio = np.random.default_rng(0)
+    X = aleatorio.normal(size=(400, 5))
+    y = X[:, 0] * 3 + np.sin(X[:, 1]) + aleatorio.normal(scale=0.1, size=400)
+    bosque = ensemble.RandomForestRegressor(n_estimators=20, max_depth=8, random_state=0).fit(X, y)
+    compilado = BosqueCompilado.desde_sklearn(bosque)
+
+    for fila in X[:50]:
+        assert compilado.predecir(fila[None, :])[0] == bosque.predict(fila[None, :])[0]
+        assert np.array_equal(compilado.hojas_fila(fila), compilado.hojas(fila[None, :])[0])
+
+
+def test_lotes_tan_rapidos_como_sklearn():
+    # Guards the batch path: with the sklearn forest attached, large batches must not fall back
+    # to the level-by-level descent, which is several times slower
+    aleatorio = np.random.default_rng(1)
+    X = aleatorio.normal(size=(5000, 5))
+    y = X[:, 0] * 3 + np.sin(X[:, 1]) + aleatorio.normal(scale=0.1, size=5000)
+    bosque = ensemble.RandomForestRegressor(n_estimators=100, random_state=0).fit(X, y)
+    compilado = BosqueCompilado.desde_sklearn(bosque)
+    compilado.cargar_lotes = lambda: bosque
+    datos = aleatorio.normal(size=(10000, 5))
+
+    def mejor_tiempo(funcion):
+        tiempos = []
+        for _ in range(3):
+            inicio = time.perf_counter()
+            resultado = funcion(datos)
+            tiempos.append(time.perf_counter() - inicio)
+        return min(tiempos), resultado
+
+    tiempo_sklearn, esperado = mejor_tiempo(bosque.predict)
+    tiempo_compilado, obtenido = mejor_tiempo(compilado.predecir)
+
+    assert np.array_equal(obtenido, esperado)
+    assert np.array_equal(compilado.hojas(datos), compilado.hojas_compiladas(datos))
+    assert tiempo_compilado <= 2 * tiempo_sklearn
@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+
+pytest.importorskip("geopy")
+
+from geocodificacion import ClienteGeocodificacion, GeocodificadorLocal, LimitadorTasa
+from simulados import GeocodificadorSimulado
+
+
+def crear_cliente(latencia=0.0):
+    simulado = GeocodificadorSimulado(latencia=latencia)
+    return ClienteGeocodificacion(simulado, LimitadorTasa(tasa=1000, capacidad=1000)), simulado
+
+
+def direcciones(ubicaciones):
+    return [ubicacion.address for ubicacion in ubicaciones]
+
+
+def test_sugerencias_reutilizan_la_consulta_anterior():
+    cliente, simulado = crear_cliente()
+    cliente.geocode("Calle Prin, México", exactly_one=False, limit=100)
+    sugerencias = cliente.geocode("Calle Princ, México", exactly_one=False, limit=100)
+
+    assert simulado.llamadas == 1
+    assert cliente.respuestas_por_prefijo == 1
+    assert direcciones(sugerencias) == direcciones(simulado.geocode("Calle Princ, México", False, 100))
+
+
+def test_respuesta_truncada_no_se_reutiliza():
+    # The five answers of "Calle M" are all on Calle Morelos, so they say nothing about "Calle Ma"
+    cliente, simulado = crear_cliente()
+    cliente.geocode("Calle M, México", exactly_one=False, limit=5)
+    sugerencias = cliente.geocode("Calle Ma, México", exactly_one=False, limit=5)
+
+    assert simulado.llamadas == 2
+    assert cliente.respuestas_por_prefijo == 0
+    assert all("Madero" in direccion for direccion in direcciones(sugerencias))
+
+
+def test_consultas_simultaneas_se_fusionan():
+    cliente, simulado = crear_cliente(latencia=0.2)
+    n_hilos = 8
+    barrera = threading.Barrier(n_hilos)
+    resultados = [None] * n_hilos
+
+    def consultar(indice):
+        barrera.wait()
+        resultados[indice] = cliente.geocode("Avenida Reforma 123, Guadalajara")
+
+    hilos = [threading.Thread(target=consultar, args=(indice,)) for indice in range(n_hilos)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    assert simulado.llamadas == 1
+    assert cliente.consultas_fusionadas == n_hilos - 1
+    assert {resultado.address for resultado in resultados} == {"Avenida Reforma 123, Colonia Americana, Guadalajara, México"}
+
+
+NOMENCLATOR = [
+    ("Avenida Juárez 10, Centro, Ciudad de México, México", 19.43, -99.14),
+    ("Calle Principal 250, Centro, Querétaro, México", 20.59, -100.39),
+    ("Calle Principal 10, Centro, Querétaro, México", 20.58, -100.38),
+    ("Calle Prieto 5, Centro, Querétaro, México", 20.57, -100.37),
+    ("Calle Morelos 3, Centro, Mérida, México", 20.97, -89.62),
+]
+
+
+def test_nomenclator_busca_por_prefijos():
+    local = GeocodificadorLocal(NOMENCLATOR)
+    sugerencias = local.geocode("Calle Princ, México", exactly_one=False, limit=5)
+
+    # Both numbers of Calle Principal, the shorter address first
+    assert [ubicacion.address for ubicacion in sugerencias] == [NOMENCLATOR[2][0], NOMENCLATOR[1][0]]
+    assert local.geocode("Calle Pri 5, Querétaro").address == NOMENCLATOR[3][0]
+    assert local.geocode("Calle Inexistente 1") is None
+
+
+def test_nomenclator_ignora_acentos_y_mayusculas():
+    local = GeocodificadorLocal(NOMENCLATOR)
+
+    assert local.geocode("AVENIDA JUAREZ 10").address == NOMENCLATOR[0][0]
+    assert local.geocode("calle morelos, merida").address == NOMENCLATOR[4][0]
+
+
+def test_nomenclator_respeta_el_limite():
+    local = GeocodificadorLocal(NOMENCLATOR)
+
+    assert len(local.geocode("Calle, Querétaro", exactly_one=False, limit=2)) == 2
+    assert len(local.geocode("Calle, Querétaro", exactly_one=False)) == 3
+    assert len(local.geocode("Centro", exactly_one=False, limit=10)) == 5
@@ -0,0 +1,73 @@
+import os
+import threading
+
+from monitor_deriva import DURACION_VENTANA, MonitorDeriva
+
+
+class Reloj:
+    def __init__(self, ahora=0.0):
+        self.ahora = ahora
+
+    def __call__(self):
+        return self.ahora
+
+
+def monitor_con_observaciones(reloj, n):
+    monitor = MonitorDeriva(reloj=reloj)
+    for _ in range(n):
+        monitor.observar("Casa", 0, {'Terreno': 200.0}, 1_000_000.0)
+    return monitor
+
+
+def cuentas(monitor):
+    historico = sum(resumen.cuenta for resumen in monitor._historico.get(("Casa", 0), {}).values())
+    ventana = sum(resumen.cuenta for resumen in monitor._ventana.get(("Casa", 0), {}).values())
+    return historico, ventana
+
+
+def test_ventana_vencida_pasa_al_historico():
+    reloj = Reloj()
+    anterior = monitor_con_observaciones(reloj, 3)
+    reloj.ahora = 2 * DURACION_VENTANA
+    actual = monitor_con_observaciones(reloj, 2)
+
+    actual.combinar(MonitorDeriva.desde_dict(anterior.a_dict()))
+
+    assert cuentas(actual) == (6, 4)
+    assert actual.inicio_ventana == 2 * DURACION_VENTANA
+
+
+def test_ventana_reciente_se_combina_con_la_actual():
+    reloj = Reloj()
+    anterior = monitor_con_observaciones(reloj, 3)
+    reloj.ahora = DURACION_VENTANA / 2
+    actual = monitor_con_observaciones(reloj, 2)
+
+    actual.combinar(anterior)
+
+    assert cuentas(actual) == (0, 10)
+    assert actual.inicio_ventana == 0.0
+
+
+def test_puntos_de_control_concurrentes(tmp_path):
+    ruta = str(tmp_path / "replica.json")
+    monitor = MonitorDeriva(ruta, intervalo=0)
+    errores = []
+
+    def observar():
+        try:
+            for _ in range(200):
+                monitor.observar("Casa", 0, {'Terreno': 200.0}, 1_000_000.0)
+        except Exception as e:
+            errores.append(e)
+
+    hilos = [threading.Thread(target=observar) for _ in range(8)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    monitor.guardar()
+
+    assert errores == []
+    assert os.listdir(tmp_path) == ["replica.json"]
+    assert cuentas(MonitorDeriva.cargar(ruta)) == (0, 2 * 8 * 200)
@@ -0,0 +1,63 @@
+from prospectos import CAMPOS_PROSPECTO, EscritorProspectos
+
+
+def prospecto(numero, envio=None):
+    data = {campo: f"{campo}-{numero}" for campo in CAMPOS_PROSPECTO}
+    data['precio_estimado'] = 1_000_000 + numero
+    data['id_envio'] = envio or f"envio-{numero}"
+    return data
+
+
+class Almacen:
+    def __init__(self, disponible=True):
+        self.disponible = disponible
+        self.filas = []
+
+    def __call__(self, filas):
+        if not self.disponible:
+            raise ConnectionError("Almacén no disponible")
+        self.filas.extend(filas)
+
+
+def test_prospecto_repetido_se_envia_una_vez(tmp_path):
+    almacen = Almacen()
+    escritor = EscritorProspectos(almacen, ruta_spool=str(tmp_path / "spool.jsonl"), intervalo=0.05)
+    identificadores = {escritor.encolar(prospecto(1)) for _ in range(3)}
+    escritor.detener()
+
+    assert len(identificadores) == 1
+    assert len(almacen.filas) == 1
+
+
+def test_pendientes_se_reenvian_una_vez_tras_reiniciar(tmp_path):
+    ruta = str(tmp_path / "spool.jsonl")
+    caido = Almacen(disponible=False)
+    escritor = EscritorProspectos(caido, ruta_spool=ruta, intervalo=0.05)
+    for numero in range(3):
+        escritor.encolar(prospecto(numero))
+    escritor.detener()
+    assert caido.filas == []
+
+    almacen = Almacen()
+    escritor = EscritorProspectos(almacen, ruta_spool=ruta, intervalo=0.05)
+    escritor.encolar(prospecto(0))
+    escritor.detener()
+    assert sorted(fila[-1] for fila in almacen.filas) == [1_000_000, 1_000_001, 1_000_002]
+
+    # Confirmed ids are kept in the spool, so a later rerun of the same estimate is not sent again
+    escritor = EscritorProspectos(almacen, ruta_spool=ruta, intervalo=0.05)
+    escritor.encolar(prospecto(1))
+    escritor.detener()
+    assert len(almacen.filas) == 3
+    assert escritor.pendientes() == 0
+
+
+def test_misma_estimacion_en_otro_envio_es_otro_prospecto(tmp_path):
+    almacen = Almacen()
+    escritor = EscritorProspectos(almacen, ruta_spool=str(tmp_path / "spool.jsonl"), intervalo=0.05)
+    primero = escritor.encolar(prospecto(1, envio="a"))
+    segundo = escritor.encolar(prospecto(1, envio="b"))
+    escritor.detener()
+
+    assert primero != segundo
+    assert len(almacen.filas) == 2
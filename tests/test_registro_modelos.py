@@ -0,0 +1,31 @@
+import os
+
+from registro_modelos import DIRECTORIO_VERSIONES, limpiar_versiones, publicar_artefactos, sha256_archivo
+
+
+def manifiesto_con(archivo):
+    return {'conjuntos': {'Casa': {'version': "1", 'artefactos': {'modelo': {'archivo': archivo, 'sha256': None}}}}}
+
+
+def test_publicar_no_sobrescribe_versiones_anteriores(tmp_path):
+    ruta = tmp_path / "bosque_aleatorio.joblib"
+    ruta.write_bytes(b"version 1")
+    primero = publicar_artefactos(manifiesto_con("bosque_aleatorio.joblib"), str(tmp_path))
+    ruta.write_bytes(b"version 2")
+    segundo = publicar_artefactos(manifiesto_con("bosque_aleatorio.joblib"), str(tmp_path))
+
+    artefacto_1 = primero['conjuntos']['Casa']['artefactos']['modelo']
+    artefacto_2 = segundo['conjuntos']['Casa']['artefactos']['modelo']
+    assert artefacto_1['archivo'].startswith(f"{DIRECTORIO_VERSIONES}/")
+    assert artefacto_1['archivo'] != artefacto_2['archivo']
+    assert (tmp_path / artefacto_1['archivo']).read_bytes() == b"version 1"
+    assert artefacto_2['sha256'] == sha256_archivo(str(tmp_path / artefacto_2['archivo']))
+
+    # Only the copies of the given manifests are kept
+    ruta.write_bytes(b"version 3")
+    tercero = publicar_artefactos(manifiesto_con("bosque_aleatorio.joblib"), str(tmp_path))
+    eliminados = limpiar_versiones([tercero, segundo], str(tmp_path))
+    assert eliminados == [os.path.basename(artefacto_1['archivo'])]
+    assert sorted(os.listdir(tmp_path / DIRECTORIO_VERSIONES)) == sorted(
+        os.path.basename(manifiesto['conjuntos']['Casa']['artefactos']['modelo']['archivo'])
+        for manifiesto in (segundo, tercero))
@@ -0,0 +1,113 @@
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from servicio import crear_aplicacion
+
+
+class EstimadorFalso:
+    # Prices each row by its land area; estimar_lote can be held until liberar is set
+    def __init__(self):
+        self.lotes = []
+        self.liberar = threading.Event()
+        self.liberar.set()
+
+    def estimar_lote(self, entradas):
+        self.liberar.wait(5)
+        terrenos = entradas['Terreno']
+        self.lotes.append(len(terrenos))
+        return terrenos * 1000, terrenos * 900, terrenos * 1100
+
+
+class RegistroFalso:
+    def __init__(self, estimador):
+        self.estimador = estimador
+
+    def disponibles(self):
+        return ["Departamento"]
+
+    def versiones(self):
+        return {"Departamento": "1"}
+
+    def obtener(self, tipo_propiedad):
+        return self.estimador
+
+
+def propiedad(terreno=100):
+    return {'latitud': 19.43, 'longitud': -99.13, 'terreno': terreno, 'construccion': 80, 'habitaciones': 2,
+            'banos': 1}
+
+
+def con_cliente(prueba, estimador, **opciones):
+    async def ejecutar():
+        cliente = TestClient(TestServer(crear_aplicacion(RegistroFalso(estimador), **opciones)))
+        await cliente.start_server()
+        try:
+            await prueba(cliente)
+        finally:
+            await cliente.close()
+
+    asyncio.run(ejecutar())
+
+
+def test_solicitudes_simultaneas_comparten_lote():
+    pytest.importorskip("numpy")
+    estimador = EstimadorFalso()
+
+    async def prueba(cliente):
+        respuestas = await asyncio.gather(*[
+            cliente.post('/estimar', json=dict(propiedad(terreno), tipo_propiedad="Departamento"))
+            for terreno in range(100, 110)
+        ])
+        cuerpos = [await respuesta.json() for respuesta in respuestas]
+        assert [cuerpo['precio'] for cuerpo in cuerpos] == [terreno * 1000 for terreno in range(100, 110)]
+
+    con_cliente(prueba, estimador, hilos=1, espera=0.05)
+    assert sum(estimador.lotes) == 10
+    assert len(estimador.lotes) < 10
+
+
+def test_entrada_invalida_responde_400():
+    async def prueba(cliente):
+        sin_tipo = await cliente.post('/estimar', json=propiedad())
+        assert sin_tipo.status == 400
+        assert "tipo_propiedad" in await sin_tipo.text()
+        no_disponible = await cliente.post('/estimar', json=dict(propiedad(), tipo_propiedad="Casa"))
+        assert no_disponible.status == 400
+        no_numerico = await cliente.post('/estimar', json=dict(propiedad("cien"), tipo_propiedad="Departamento"))
+        assert no_numerico.status == 400
+        lote_vacio = await cliente.post('/estimar/lote', json={'tipo_propiedad': "Departamento", 'propiedades': []})
+        assert lote_vacio.status == 400
+
+    con_cliente(prueba, EstimadorFalso())
+
+
+def test_filas_pendientes_sobre_la_capacidad_responden_503():
+    pytest.importorskip("numpy")
+    estimador = EstimadorFalso()
+    estimador.liberar.clear()
+
+    async def prueba(cliente):
+        # The first batch holds the only inference thread with its 3 rows pending
+        retenida = asyncio.ensure_future(cliente.post('/estimar/lote', json={
+            'tipo_propiedad': "Departamento", 'propiedades': [propiedad()] * 3}))
+        while not cliente.app['agrupadores']["Departamento"].filas_pendientes:
+            await asyncio.sleep(0.01)
+        rechazada = await cliente.post('/estimar/lote', json={
+            'tipo_propiedad': "Departamento", 'propiedades': [propiedad()] * 3})
+        assert rechazada.status == 503
+        assert rechazada.headers['Retry-After'] == '1'
+        admitida = asyncio.ensure_future(cliente.post('/estimar', json=dict(propiedad(), tipo_propiedad="Departamento")))
+        await asyncio.sleep(0.05)
+        assert not admitida.done()
+
+        estimador.liberar.set()
+        assert (await retenida).status == 200
+        assert (await admitida).status == 200
+
+    con_cliente(prueba, estimador, hilos=1, capacidad=4)
@@ -0,0 +1,22 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+impute = pytest.importorskip("sklearn.impute")
+preprocessing = pytest.importorskip("sklearn.preprocessing")
+
+from estimador import TransformacionFusionada
+
+
+def test_transformacion_identica_a_sklearn():
+    aleatorio = np.random.default_rng(0)
+    X = aleatorio.normal(loc=[200, 150, 3, 2, 10], scale=[80, 60, 1, 1, 5], size=(2000, 5))
+    X[aleatorio.random(X.shape) < 0.1] = np.nan
+    imputador = impute.SimpleImputer(strategy='median').fit(X)
+    escalador = preprocessing.StandardScaler().fit(imputador.transform(X))
+    transformacion = TransformacionFusionada.desde_modelos({'imputador': imputador, 'escalador': escalador})
+
+    datos = aleatorio.normal(loc=[200, 150, 3, 2, 10], scale=[80, 60, 1, 1, 5], size=(500, 5))
+    datos[aleatorio.random(datos.shape) < 0.2] = np.nan
+    esperado = escalador.transform(imputador.transform(datos))
+
+    assert np.array_equal(transformacion.transformar(np.array(datos)), esperado)